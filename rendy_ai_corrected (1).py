@@ -7,14 +7,29 @@ import json
 import re
 import logging
 from datetime import datetime, timedelta
+import sys
 import pytz
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import plotly.graph_objects as go
 import plotly.express as px
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict, field, fields
 import warnings
 import concurrent.futures
 import time
+import threading
+import atexit
+import tempfile
+import shutil
+import sqlite3
+import queue
+from contextlib import contextmanager
+from collections import deque, defaultdict, OrderedDict
+import unicodedata
+import hashlib
+import hmac
+import getpass
+import secrets
+import zlib
 
 warnings.filterwarnings("ignore")
 
@@ -30,10 +45,23 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATA_DIR = 'data'
+BANCO_USUARIOS = os.path.join(DATA_DIR, 'rendy.db')
+# Arquivos do armazenamento antigo (usuário único), lidos apenas na migração para o SQLite
 USUARIO_JSON = os.path.join(DATA_DIR, 'usuario.json')
 HISTORICO_JSON = os.path.join(DATA_DIR, 'historico_interacoes.json')
+HISTORICO_JSONL = os.path.join(DATA_DIR, 'historico_interacoes.jsonl')
 FAVORITOS_JSON = os.path.join(DATA_DIR, 'favoritos.json')
+SNAPSHOTS_DIR = os.path.join(DATA_DIR, 'snapshots')
+VALIDADE_SNAPSHOT = 60 * 60  # Mesmo TTL do cache de analisar_ativo
+HISTORICOS_NPZ = os.path.join(DATA_DIR, 'historicos.npz')
+JANELA_HISTORICO_DIAS = 365  # Janela exposta em AnaliseAtivo.historico (equivale ao antigo period="1y")
+HISTORICO_LONGO_NPZ = os.path.join(DATA_DIR, 'historico_longo.npz')
+DIVIDENDOS_NPZ = os.path.join(DATA_DIR, 'dividendos.npz')
+ESTATISTICAS_NPZ = os.path.join(DATA_DIR, 'estatisticas.npz')
+TOLERANCIA_AJUSTE = 1e-4  # Diferença relativa no pregão sobreposto que indica ajuste por provento/desdobramento
 FUSO_BR = pytz.timezone('America/Sao_Paulo')
+TAMANHO_MINIMO_SENHA = 8
+ITERACOES_SENHA = 200_000  # PBKDF2-SHA256
 
 # Lista completa de tickers do IBOV (atualizada)
 LISTA_TICKERS_IBOV = [
@@ -79,6 +107,98 @@ GLOSSARIO = {
     "Dividend CAGR": "Taxa composta de crescimento anual de dividendos. Indica consistência nos pagamentos."
 }
 
+# Regras declarativas da explicação do score (XAI). Cada regra é avaliada como
+# máscara booleana sobre o DataFrame de fundamentos, de uma vez para todos os ativos.
+REGRAS_XAI = [
+    {'id': 'dy_alto', 'categoria': 'fatores_positivos',
+     'condicao': lambda df: df['dy'] > 0.08,
+     'mensagem': "Dividend Yield de {dy:.2%} está acima da média do mercado (8%)"},
+    {'id': 'dy_medio', 'categoria': 'fatores_neutros',
+     'condicao': lambda df: (df['dy'] > 0.05) & (df['dy'] <= 0.08),
+     'mensagem': "Dividend Yield de {dy:.2%} está na média do mercado"},
+    {'id': 'dy_baixo', 'categoria': 'fatores_negativos',
+     'condicao': lambda df: df['dy'] <= 0.05,
+     'mensagem': "Dividend Yield de {dy:.2%} está abaixo da média desejável"},
+    {'id': 'pl_atrativo', 'categoria': 'fatores_positivos',
+     'condicao': lambda df: (df['pl'] > 0) & (df['pl'] < 15),
+     'mensagem': "P/L de {pl:.1f} indica ação com preço atrativo"},
+    {'id': 'pl_caro', 'categoria': 'fatores_negativos',
+     'condicao': lambda df: df['pl'] > 25,
+     'mensagem': "P/L de {pl:.1f} pode indicar ação cara"},
+    {'id': 'roe_alto', 'categoria': 'fatores_positivos',
+     'condicao': lambda df: df['roe'] > 0.15,
+     'mensagem': "ROE de {roe:.2%} demonstra boa eficiência da empresa"},
+    {'id': 'roe_baixo', 'categoria': 'fatores_negativos',
+     'condicao': lambda df: df['roe'] < 0.10,
+     'mensagem': "ROE de {roe:.2%} está abaixo do ideal"},
+    {'id': 'payout_insustentavel', 'categoria': 'fatores_negativos',
+     'condicao': lambda df: df['payout_ratio'] > 0.6,
+     'mensagem': "Payout ratio de {payout_ratio:.1%} pode ser insustentável"},
+    {'id': 'payout_saudavel', 'categoria': 'fatores_positivos',
+     'condicao': lambda df: (df['payout_ratio'] >= 0.3) & (df['payout_ratio'] <= 0.6),
+     'mensagem': "Payout ratio de {payout_ratio:.1%} está em nível saudável"},
+    {'id': 'beta_baixo', 'categoria': 'fatores_positivos',
+     'condicao': lambda df: df['beta'] < 0.8,
+     'mensagem': "Beta de {beta:.2f} indica menor volatilidade que o mercado"},
+    {'id': 'beta_alto', 'categoria': 'riscos',
+     'condicao': lambda df: df['beta'] > 1.2,
+     'mensagem': "Beta de {beta:.2f} indica maior volatilidade que o mercado"},
+    {'id': 'risco_baixo', 'categoria': 'fatores_positivos',
+     'condicao': lambda df: df['risco_nivel'] == 'baixo',
+     'mensagem': "Classificado como investimento de baixo risco"},
+    {'id': 'risco_alto', 'categoria': 'riscos',
+     'condicao': lambda df: df['risco_nivel'] == 'alto',
+     'mensagem': "Classificado como investimento de alto risco"},
+]
+
+# Faixas de score -> recomendação (avaliadas em ordem)
+FAIXAS_RECOMENDACAO = [
+    (8, "Excelente oportunidade de investimento"),
+    (6, "Boa opção para carteira diversificada"),
+    (4, "Considere com cautela, analise outros fatores"),
+]
+RECOMENDACAO_PADRAO = "Não recomendado no momento atual"
+
+# Cenários determinísticos da simulação (crescimento anual de preço e de dividendos)
+CENARIOS_SIMULACAO = {
+    'conservador': {'crescimento_preco': 0.05, 'crescimento_dividendo': 0.02},
+    'realista': {'crescimento_preco': 0.08, 'crescimento_dividendo': 0.05},
+    'otimista': {'crescimento_preco': 0.12, 'crescimento_dividendo': 0.08}
+}
+
+# Horizonte calculado (e mantido em cache) para cada simulação; prazos menores são prefixos
+HORIZONTE_MAXIMO_SIMULACAO = 50
+# Séries proporcionais à quantidade inicial de ações (o preço por ação não escala)
+CAMPOS_PROPORCIONAIS_QTD = ['qtd_acoes', 'valor_carteira', 'renda_anual', 'dividendos_recebidos']
+
+# Parâmetros do modo Monte Carlo
+PERCENTIS_MONTE_CARLO = [5, 25, 50, 75, 95]
+VOLATILIDADE_PADRAO = 0.25  # Usada quando o histórico é insuficiente
+FATOR_VOL_DIVIDENDO = 0.5  # Volatilidade dos dividendos relativa à do preço
+TAMANHO_LOTE_MONTE_CARLO = 20_000  # Caminhos por lote, limita a memória intermediária
+
+# Limites de concentração (os mesmos que o compliance cobra na carteira)
+LIMITE_PESO_SETOR = 0.4
+LIMITE_PESO_ATIVO = 0.3
+METODOS_ALOCACAO = {
+    'min_variancia': 'Mínima variância',
+    'media_variancia': 'Média-variância',
+    'paridade_risco': 'Paridade de risco',
+    'max_dy': 'Máximo dividend yield',
+}
+METODO_ALOCACAO_PERFIL = {'conservador': 'min_variancia', 'moderado': 'paridade_risco', 'agressivo': 'media_variancia'}
+AVERSAO_RISCO_PERFIL = {'conservador': 8.0, 'moderado': 4.0, 'agressivo': 2.0}
+PESO_MINIMO_SUGESTAO = 0.005  # Pesos menores que isso saem da sugestão
+LOTE_PADRAO_B3 = 100  # Mercado à vista; no fracionário o lote é 1 ação
+
+# Rebalanceamento
+CUSTO_OPERACAO = 0.0003  # Emolumentos/liquidação da B3 sobre o valor negociado
+CUSTO_FIXO_OPERACAO = 0.0  # Corretagem por ordem (zero na maioria das corretoras)
+VALOR_MINIMO_OPERACAO = 100.0  # Ordens menores não compensam o esforço
+# Regra 5/25: opera o ativo cujo peso desviou mais de 5 p.p. ou de 25% do peso-alvo (o menor dos dois)
+BANDA_ABSOLUTA_REBALANCEAMENTO = 0.05
+BANDA_RELATIVA_REBALANCEAMENTO = 0.25
+
 # Dados simulados para TODAY NEWS
 TODAY_NEWS_DATA = {
     'data_atualizacao': datetime.now(FUSO_BR).strftime('%d/%m/%Y %H:%M'),
@@ -98,8 +218,12 @@ TODAY_NEWS_DATA = {
     ]
 }
 
+# Orçamento de memória por ativo em cache: objeto + campos + histórico de ~1 ano
+ORCAMENTO_MEMORIA_ANALISE = 4 * 1024
+
 # =================== DATACLASSES ===================
-@dataclass
+# slots=True: sem __dict__ por instância (requer Python 3.10+)
+@dataclass(slots=True)
 class PerfilUsuario:
     nome: str
     email: str
@@ -117,7 +241,7 @@ class PerfilUsuario:
         if self.favoritos is None:
             self.favoritos = []
 
-@dataclass
+@dataclass(slots=True)
 class AnaliseAtivo:
     ticker: str
     nome_empresa: str
@@ -129,7 +253,7 @@ class AnaliseAtivo:
     score: float
     score_bruto: float
     super_investimento: bool
-    historico: Optional[pd.Series] = None
+    historico_ref: int = -1  # Segmento no ArmazemHistoricos compartilhado
     alerta_dy: str = ""
     free_cash_flow: float = 0.0
     payout_ratio: float = 0.0
@@ -141,7 +265,260 @@ class AnaliseAtivo:
     beta: float = 0.0
     volume_medio: float = 0.0
     dividend_cagr: float = 0.0
+    volatilidade: float = 0.0  # Anualizada, do histórico longo quando disponível
+    max_drawdown: float = 0.0
     ultima_atualizacao: datetime = None
+    
+    @property
+    def historico(self) -> Optional[pd.Series]:
+        armazem = obter_armazem_historicos()
+        return armazem.serie(self.historico_ref, inicio=armazem.inicio_janela())
+
+# =================== HISTÓRICOS DE PREÇOS ===================
+def dias_do_indice(indice: pd.DatetimeIndex) -> np.ndarray:
+    """Datas de pregão (datetime64[D]) sem fuso, como usadas no calendário"""
+    if indice.tz is not None:
+        indice = indice.tz_localize(None)
+    return indice.to_numpy(dtype='datetime64[D]')
+
+class ArmazemHistoricos:
+    """Históricos de fechamento de todos os ativos numa matriz float32 ativos x pregões.
+    
+    O calendário (datas de pregão da B3 vistas em qualquer ativo) é único e
+    compartilhado; dias sem cotação ficam NaN. Cada AnaliseAtivo guarda apenas
+    o número da sua linha e o pd.Series só é montado quando alguém pede
+    `analise.historico`.
+    
+    Calendário e matriz ficam juntos numa única tupla, trocada de uma vez pelas
+    escritas: leitores (sem lock, em paralelo) pegam `self._dados` uma vez e
+    nunca misturam um calendário novo com a matriz antiga."""
+    
+    def __init__(self, capacidade_inicial: int = 128):
+        self._dados: Tuple[np.ndarray, np.ndarray] = (
+            np.array([], dtype='datetime64[D]'), np.empty((capacidade_inicial, 0), dtype=np.float32)
+        )
+        self.tickers: List[str] = []
+        self._por_ticker: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def calendario(self) -> np.ndarray:
+        return self._dados[0]
+    
+    @property
+    def precos(self) -> np.ndarray:
+        return self._dados[1]
+    
+    def __len__(self) -> int:
+        return len(self.tickers)
+    
+    def _ampliar_calendario(self, dias: np.ndarray):
+        calendario_atual, precos_atuais = self._dados
+        novos = np.setdiff1d(dias, calendario_atual, assume_unique=False)
+        if not len(novos):
+            return
+        calendario = np.union1d(calendario_atual, novos)
+        precos = np.full((precos_atuais.shape[0], len(calendario)), np.nan, dtype=np.float32)
+        precos[:, np.searchsorted(calendario, calendario_atual)] = precos_atuais
+        # Uma única atribuição; leitores em andamento seguem com o par antigo
+        self._dados = (calendario, precos)
+    
+    def _linha(self, ticker: str) -> int:
+        ref = self._por_ticker.get(ticker)
+        if ref is None:
+            ref = len(self.tickers)
+            calendario, precos = self._dados
+            if ref == precos.shape[0]:
+                extra = np.full((max(ref, 1), precos.shape[1]), np.nan, dtype=np.float32)
+                self._dados = (calendario, np.vstack([precos, extra]))
+            self.tickers.append(ticker)
+            self._por_ticker[ticker] = ref
+        return ref
+    
+    def registrar(self, ticker: str, serie: Optional[pd.Series], substituir: bool = True) -> int:
+        """Grava o histórico de `ticker` e devolve a linha dele na matriz.
+        
+        Com `substituir=False` só os pregões presentes em `serie` são sobrescritos."""
+        if serie is None or serie.empty:
+            return self._por_ticker.get(ticker, -1)
+        dias = dias_do_indice(serie.index)
+        with self._lock:
+            self._ampliar_calendario(dias)
+            ref = self._linha(ticker)
+            if substituir:
+                self.precos[ref] = np.nan
+            self.precos[ref, np.searchsorted(self.calendario, dias)] = serie.to_numpy(dtype=np.float32)
+        return ref
+    
+    def registrar_lote(self, tickers: List[str], datas: np.ndarray, precos: np.ndarray) -> List[int]:
+        """Registra uma matriz ativos x datas de uma vez (ex.: vinda de um snapshot)"""
+        datas = np.asarray(datas, dtype='datetime64[D]')
+        with self._lock:
+            self._ampliar_calendario(datas)
+            refs = [self._linha(ticker) for ticker in tickers]
+            colunas = np.searchsorted(self.calendario, datas)
+            bloco = np.full((len(refs), self.precos.shape[1]), np.nan, dtype=np.float32)
+            bloco[:, colunas] = precos
+            self.precos[refs] = bloco
+        return refs
+    
+    def referencia(self, ticker: str) -> int:
+        return self._por_ticker.get(ticker, -1)
+    
+    def valores(self, ref: int) -> Optional[np.ndarray]:
+        """Visão (sem cópia) da linha do ativo sobre o calendário inteiro"""
+        if ref < 0:
+            return None
+        calendario, precos = self._dados
+        return precos[ref, :len(calendario)]
+    
+    def serie(self, ref: int, inicio=None, fim=None) -> Optional[pd.Series]:
+        if ref < 0:
+            return None
+        datas, precos = self.periodo([ref], inicio, fim)
+        linha = precos[0]
+        validos = ~np.isnan(linha)
+        if not validos.any():
+            return None
+        return pd.Series(linha[validos], index=pd.DatetimeIndex(datas[validos]), name='Close')
+    
+    def fatia_datas(self, inicio=None, fim=None, calendario: Optional[np.ndarray] = None) -> slice:
+        """Colunas do calendário (o atual, se não for passado) entre `inicio` e `fim` (inclusive)"""
+        calendario = self.calendario if calendario is None else calendario
+        a = np.searchsorted(calendario, np.datetime64(pd.Timestamp(inicio).date(), 'D')) if inicio is not None else 0
+        b = np.searchsorted(calendario, np.datetime64(pd.Timestamp(fim).date(), 'D'), side='right') if fim is not None else len(calendario)
+        return slice(a, b)
+    
+    def periodo(self, refs: Optional[List[int]] = None, inicio=None, fim=None) -> Tuple[np.ndarray, np.ndarray]:
+        """(datas, matriz ativos x datas) do período; sem `refs`, todos os ativos (visão sem cópia)"""
+        calendario, precos = self._dados
+        colunas = self.fatia_datas(inicio, fim, calendario)
+        if refs is None:
+            return calendario[colunas], precos[:len(self.tickers), colunas]
+        return calendario[colunas], precos[np.asarray(refs, dtype=int), colunas]
+    
+    def retornos(self, refs: List[int], inicio=None, fim=None) -> np.ndarray:
+        """Log-retornos diários (dias x ativos) nos pregões em que todos têm cotação"""
+        if any(ref < 0 for ref in refs):
+            return np.empty((0, len(refs)))
+        _, precos = self.periodo(refs, inicio, fim)
+        comuns = precos[:, ~np.isnan(precos).any(axis=0)].astype(float)
+        return np.diff(np.log(comuns), axis=1).T
+    
+    def ultimo_pregao(self, ref: int) -> Optional[Tuple[np.datetime64, float]]:
+        """Último pregão com cotação do ativo e o fechamento guardado nele"""
+        if ref < 0:
+            return None
+        calendario, precos = self._dados
+        linha = precos[ref, :len(calendario)]
+        validos = np.flatnonzero(~np.isnan(linha))
+        if not len(validos):
+            return None
+        return calendario[validos[-1]], float(linha[validos[-1]])
+    
+    def inicio_janela(self) -> Optional[np.datetime64]:
+        calendario = self.calendario
+        if not len(calendario):
+            return None
+        return calendario[-1] - np.timedelta64(JANELA_HISTORICO_DIAS, 'D')
+    
+    def bytes_referencia(self, ref: int) -> int:
+        if ref < 0:
+            return 0
+        return self.precos.shape[1] * self.precos.itemsize
+    
+    def salvar(self, caminho: Optional[str] = None):
+        caminho = caminho or HISTORICOS_NPZ
+        with self._lock:
+            calendario, precos = self._dados
+            calendario, precos = calendario.copy(), precos[:len(self.tickers)].copy()
+            tickers = np.array(self.tickers, dtype=str)
+        os.makedirs(os.path.dirname(caminho) or '.', exist_ok=True)
+        fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho) or '.', suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, calendario=calendario, precos=precos, tickers=tickers)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporario, caminho)
+        except Exception:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+            raise
+    
+    @classmethod
+    def carregar(cls, caminho: Optional[str] = None) -> 'ArmazemHistoricos':
+        caminho = caminho or HISTORICOS_NPZ
+        armazem = cls()
+        if not os.path.exists(caminho):
+            return armazem
+        try:
+            with np.load(caminho) as dados:
+                armazem.registrar_lote([str(t) for t in dados['tickers']], dados['calendario'], dados['precos'])
+        except Exception as e:
+            logger.error(f"Erro ao carregar históricos salvos: {e}")
+            return cls()
+        return armazem
+
+@st.cache_resource
+def obter_armazem_historicos() -> ArmazemHistoricos:
+    armazem = ArmazemHistoricos.carregar()
+    # Ativos que só a ingestão longa conhece entram com a janela recente: a primeira
+    # atualização deles baixa apenas os pregões novos em vez do ano inteiro
+    if os.path.exists(HISTORICO_LONGO_NPZ):
+        longo = ArmazemHistoricos.carregar(HISTORICO_LONGO_NPZ)
+        faltantes = [t for t in longo.tickers if armazem.referencia(t) < 0]
+        if faltantes:
+            datas, precos = longo.periodo([longo.referencia(t) for t in faltantes], inicio=longo.inicio_janela())
+            armazem.registrar_lote(faltantes, datas, precos)
+    return armazem
+
+def pregoes_encerrados(fechamentos: pd.Series) -> pd.Series:
+    """Descarta a barra de hoje (horário de Brasília): durante o pregão o Yahoo devolve
+    um fechamento parcial, que mudaria a cada consulta"""
+    hoje = np.datetime64(agora_brasilia().date(), 'D')
+    return fechamentos[dias_do_indice(fechamentos.index) < hoje]
+
+def atualizar_historico(ticker: str, acao=None) -> int:
+    """Traz do Yahoo só os pregões após o último guardado e devolve a linha do ativo.
+    
+    Só pregões encerrados são guardados. O último deles é pedido de novo: se o
+    fechamento mudou, os preços ajustados foram recalculados (provento ou
+    desdobramento) e o ano inteiro é baixado outra vez."""
+    armazem = obter_armazem_historicos()
+    acao = acao or yf.Ticker(ticker)
+    ref = armazem.referencia(ticker)
+    ultimo = armazem.ultimo_pregao(ref)
+    limite = np.datetime64(agora_brasilia().date(), 'D') - np.timedelta64(JANELA_HISTORICO_DIAS, 'D')
+    
+    if ultimo is not None and ultimo[0] >= limite:
+        ultima_data, ultimo_fechamento = ultimo
+        novos = acao.history(start=str(ultima_data))
+        if novos.empty:
+            return ref
+        fechamentos = pregoes_encerrados(novos['Close'])
+        sobreposto = fechamentos[dias_do_indice(fechamentos.index) == ultima_data]
+        ajustado = not sobreposto.empty and not np.isclose(
+            float(sobreposto.iloc[0]), ultimo_fechamento, rtol=TOLERANCIA_AJUSTE
+        )
+        if not ajustado:
+            ref = armazem.registrar(ticker, fechamentos, substituir=False)
+            obter_persistencia().agendar("historicos", armazem.salvar)
+            return ref
+        logger.info(f"Preços ajustados de {ticker} mudaram; baixando o histórico completo")
+    
+    historico = acao.history(period="1y")
+    if historico.empty:
+        return ref
+    ref = armazem.registrar(ticker, pregoes_encerrados(historico['Close']))
+    obter_persistencia().agendar("historicos", armazem.salvar)
+    return ref
+
+def medir_memoria_analise(analise: AnaliseAtivo) -> int:
+    """Bytes ocupados por uma análise: objeto, valores dos campos e seu trecho do histórico"""
+    tamanho = sys.getsizeof(analise)
+    tamanho += sum(sys.getsizeof(getattr(analise, campo.name)) for campo in fields(analise))
+    return tamanho + obter_armazem_historicos().bytes_referencia(analise.historico_ref)
 
 # =================== UTILITÁRIOS ===================
 def agora_brasilia():
@@ -173,40 +550,663 @@ def validar_dy(dy: float):
         )
     return dy, ""
 
-def carregar_perfil_usuario() -> Optional[PerfilUsuario]:
+# =================== PERSISTÊNCIA ===================
+def escrever_json_atomico(caminho: str, dados):
+    # Grava em arquivo temporário no mesmo diretório e troca com os.replace:
+    # uma queda no meio da escrita nunca deixa o JSON pela metade
+    inicializar_ambiente()
+    fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho) or '.', suffix='.tmp')
     try:
-        if os.path.exists(USUARIO_JSON):
-            with open(USUARIO_JSON, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return PerfilUsuario(**data)
-    except Exception as e:
-        logger.error(f"Erro ao carregar perfil: {e}")
-    return None
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(dados, f, ensure_ascii=False, indent=2, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, caminho)
+    except BaseException:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
 
-def salvar_perfil_usuario(perfil: PerfilUsuario):
-    try:
+class PersistenciaAssincrona:
+    """Grava em segundo plano (write-behind), fora da thread da interface.
+    
+    Escritas agendadas para a mesma chave antes de o worker rodar são coalescidas:
+    apenas a última é executada. Uma escrita que falha volta para a fila até
+    `max_tentativas` vezes (a menos que uma mais nova já a tenha substituído);
+    depois disso, ou em erros que não se resolvem tentando de novo, fica em
+    `falhas` até a interface consumi-la com `consumir_falhas`."""
+    
+    ERROS_DEFINITIVOS = (sqlite3.IntegrityError, ValueError, TypeError)
+    
+    def __init__(self, janela_coalescencia: float = 0.5, max_tentativas: int = 3):
+        self.janela_coalescencia = janela_coalescencia
+        self.max_tentativas = max_tentativas
+        self._pendentes: Dict[str, Tuple[Callable[[], None], object]] = {}
+        self._em_gravacao: Dict[str, Tuple[Callable[[], None], object]] = {}
+        self._tentativas: Dict[str, int] = defaultdict(int)
+        self._falhas: Dict[str, str] = {}
+        self._cond = threading.Condition()
+        self._flush_solicitado = False
+        self._parar = False
+        self._thread = threading.Thread(target=self._executar, name="rendy-persistencia", daemon=True)
+        self._thread.start()
+    
+    def agendar(self, chave: str, escrever: Callable[[], None], dados=None):
+        with self._cond:
+            self._pendentes[chave] = (escrever, dados)
+            self._tentativas.pop(chave, None)
+            self._falhas.pop(chave, None)
+            self._cond.notify_all()
+    
+    def consumir_falhas(self, chaves: List[str]) -> Dict[str, str]:
+        """Erros definitivos das chaves pedidas (removidos ao serem lidos)"""
+        with self._cond:
+            return {chave: self._falhas.pop(chave) for chave in chaves if chave in self._falhas}
+    
+    def pendente(self, chave: str):
+        """Dados ainda não gravados para a chave (leitura consistente logo após salvar)"""
+        with self._cond:
+            item = self._pendentes.get(chave) or self._em_gravacao.get(chave)
+            return item[1] if item else None
+    
+    def _executar(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pendentes or self._parar)
+                if not self._pendentes:
+                    return
+                # Janela curta para acumular atualizações rápidas (ex.: vários favoritos seguidos)
+                self._cond.wait_for(lambda: self._flush_solicitado or self._parar,
+                                    timeout=self.janela_coalescencia)
+                self._em_gravacao, self._pendentes = self._pendentes, {}
+                self._flush_solicitado = False
+            
+            erros = {}
+            for chave, (escrever, _) in self._em_gravacao.items():
+                try:
+                    escrever()
+                except Exception as e:
+                    logger.error(f"Erro ao gravar {chave}: {e}")
+                    erros[chave] = e
+            
+            with self._cond:
+                for chave, erro in erros.items():
+                    self._tentativas[chave] += 1
+                    if chave in self._pendentes:
+                        continue  # Já existe uma versão mais nova agendada
+                    if isinstance(erro, self.ERROS_DEFINITIVOS) or self._tentativas[chave] >= self.max_tentativas:
+                        self._falhas[chave] = str(erro)
+                        self._tentativas.pop(chave, None)
+                    else:
+                        self._pendentes[chave] = self._em_gravacao[chave]
+                for chave in self._em_gravacao.keys() - erros.keys():
+                    self._tentativas.pop(chave, None)
+                self._em_gravacao = {}
+                self._cond.notify_all()
+    
+    def flush(self, timeout: Optional[float] = 10.0) -> bool:
+        with self._cond:
+            self._flush_solicitado = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pendentes and not self._em_gravacao, timeout=timeout)
+    
+    def encerrar(self):
+        self.flush()
+        with self._cond:
+            self._parar = True
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+
+def hash_senha(senha: str, sal: Optional[bytes] = None) -> Tuple[str, str]:
+    """(hash, sal) em hexadecimal; sem `sal`, gera um novo"""
+    sal = sal or secrets.token_bytes(16)
+    chave = hashlib.pbkdf2_hmac('sha256', senha.encode('utf-8'), sal, ITERACOES_SENHA)
+    return chave.hex(), sal.hex()
+
+@st.cache_resource
+def obter_persistencia() -> PersistenciaAssincrona:
+    # Um único worker por processo; grava o que estiver pendente ao encerrar
+    persistencia = PersistenciaAssincrona()
+    atexit.register(persistencia.encerrar)
+    return persistencia
+
+class ArmazenamentoUsuarios:
+    """Perfis, favoritos e interações por usuário em SQLite (modo WAL).
+    
+    Conexões ficam num pool e são reutilizadas entre threads; escritas usam
+    BEGIN IMMEDIATE e busy_timeout, então vários processos gravam sem corromper."""
+    
+    ESQUEMA = """
+    CREATE TABLE IF NOT EXISTS usuarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT NOT NULL UNIQUE COLLATE NOCASE,
+        perfil TEXT NOT NULL,
+        atualizado_em TEXT NOT NULL,
+        senha_hash TEXT,
+        senha_sal TEXT
+    );
+    CREATE TABLE IF NOT EXISTS favoritos (
+        usuario_id INTEGER NOT NULL REFERENCES usuarios(id) ON DELETE CASCADE,
+        ticker TEXT NOT NULL,
+        PRIMARY KEY (usuario_id, ticker)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS interacoes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER REFERENCES usuarios(id) ON DELETE CASCADE,
+        timestamp TEXT NOT NULL,
+        tipo TEXT NOT NULL,
+        dados TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_interacoes_usuario ON interacoes(usuario_id, id);
+    """
+    
+    def __init__(self, caminho: str, tamanho_pool: int = 8):
+        self.caminho = caminho
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=tamanho_pool)
+        with self.conexao() as con:
+            con.executescript(self.ESQUEMA)
+            # Bancos criados antes das senhas: contas sem senha só entram depois de o administrador definir uma
+            colunas = {linha[1] for linha in con.execute("PRAGMA table_info(usuarios)")}
+            for coluna in ('senha_hash', 'senha_sal'):
+                if coluna not in colunas:
+                    con.execute(f"ALTER TABLE usuarios ADD COLUMN {coluna} TEXT")
+    
+    def conectar(self) -> sqlite3.Connection:
         inicializar_ambiente()
-        with open(USUARIO_JSON, 'w', encoding='utf-8') as f:
-            json.dump(perfil.__dict__, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Erro ao salvar perfil: {e}")
+        con = sqlite3.connect(self.caminho, timeout=30, check_same_thread=False, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA foreign_keys=ON")
+        return con
+    
+    @contextmanager
+    def conexao(self):
+        try:
+            con = self._pool.get_nowait()
+        except queue.Empty:
+            con = self.conectar()
+        try:
+            yield con
+        finally:
+            try:
+                self._pool.put_nowait(con)
+            except queue.Full:
+                con.close()
+    
+    @contextmanager
+    def transacao(self):
+        with self.conexao() as con:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+    
+    def carregar_perfil(self, email: str) -> Optional[Dict]:
+        with self.conexao() as con:
+            linha = con.execute("SELECT perfil FROM usuarios WHERE email = ?", (email,)).fetchone()
+        return json.loads(linha[0]) if linha else None
+    
+    def salvar_perfil(self, dados: Dict, email_anterior: Optional[str] = None, novo: bool = False,
+                      senha: Optional[str] = None):
+        """Grava o perfil (e a senha, se informada). Levanta ValueError se o e-mail
+        (num cadastro novo ou numa troca de e-mail) já pertence a outro usuário."""
+        perfil_json = json.dumps(dados, ensure_ascii=False, default=str)
+        agora = agora_brasilia().isoformat()
+        trocando_email = email_anterior and email_anterior.lower() != dados['email'].lower()
+        with self.transacao() as con:
+            if (novo or trocando_email) and con.execute(
+                    "SELECT 1 FROM usuarios WHERE email = ?", (dados['email'],)).fetchone():
+                raise ValueError(f"O e-mail {dados['email']} já está cadastrado.")
+            if trocando_email:
+                con.execute(
+                    "UPDATE usuarios SET email = ?, perfil = ?, atualizado_em = ? WHERE email = ?",
+                    (dados['email'], perfil_json, agora, email_anterior)
+                )
+            con.execute(
+                "INSERT INTO usuarios (email, perfil, atualizado_em) VALUES (?, ?, ?) "
+                "ON CONFLICT(email) DO UPDATE SET perfil = excluded.perfil, atualizado_em = excluded.atualizado_em",
+                (dados['email'], perfil_json, agora)
+            )
+            if senha:
+                con.execute("UPDATE usuarios SET senha_hash = ?, senha_sal = ? WHERE email = ?",
+                            (*hash_senha(senha), dados['email']))
+    
+    def definir_senha(self, email: str, senha: str) -> bool:
+        with self.transacao() as con:
+            cursor = con.execute("UPDATE usuarios SET senha_hash = ?, senha_sal = ? WHERE email = ?",
+                                 (*hash_senha(senha), email))
+        return cursor.rowcount > 0
+    
+    def verificar_senha(self, email: str, senha: str) -> Optional[bool]:
+        """True/False para a senha; None se a conta não existe ou ainda não tem senha"""
+        with self.conexao() as con:
+            linha = con.execute("SELECT senha_hash, senha_sal FROM usuarios WHERE email = ?", (email,)).fetchone()
+        if not linha or not linha[0]:
+            return None
+        esperado, sal = linha
+        return hmac.compare_digest(hash_senha(senha, bytes.fromhex(sal))[0], esperado)
+    
+    def carregar_favoritos(self, email: str) -> List[str]:
+        with self.conexao() as con:
+            linhas = con.execute(
+                "SELECT f.ticker FROM favoritos f JOIN usuarios u ON u.id = f.usuario_id WHERE u.email = ?",
+                (email,)
+            ).fetchall()
+        return [linha[0] for linha in linhas]
+    
+    def salvar_favoritos(self, email: str, favoritos: List[str]):
+        with self.transacao() as con:
+            linha = con.execute("SELECT id FROM usuarios WHERE email = ?", (email,)).fetchone()
+            if not linha:
+                return
+            con.execute("DELETE FROM favoritos WHERE usuario_id = ?", (linha[0],))
+            con.executemany(
+                "INSERT OR IGNORE INTO favoritos (usuario_id, ticker) VALUES (?, ?)",
+                [(linha[0], ticker) for ticker in favoritos]
+            )
+    
+    def inserir_interacoes(self, interacoes: List[Dict]):
+        with self.transacao() as con:
+            con.executemany(
+                "INSERT INTO interacoes (usuario_id, timestamp, tipo, dados) "
+                "VALUES ((SELECT id FROM usuarios WHERE email = ?), ?, ?, ?)",
+                [
+                    (i.get('usuario'), i['timestamp'], i['tipo'],
+                     json.dumps(i.get('dados'), ensure_ascii=False, default=str))
+                    for i in interacoes
+                ]
+            )
+    
+    def compactar_interacoes(self, max_por_usuario: int):
+        with self.transacao() as con:
+            con.execute(
+                "DELETE FROM interacoes WHERE id IN ("
+                "  SELECT id FROM (SELECT id, ROW_NUMBER() OVER "
+                "    (PARTITION BY usuario_id ORDER BY id DESC) AS posicao FROM interacoes)"
+                "  WHERE posicao > ?)",
+                (max_por_usuario,)
+            )
+    
+    def carregar_interacoes(self, email: str, limite: int = 100) -> List[Dict]:
+        with self.conexao() as con:
+            linhas = con.execute(
+                "SELECT i.timestamp, i.tipo, i.dados FROM interacoes i JOIN usuarios u ON u.id = i.usuario_id "
+                "WHERE u.email = ? ORDER BY i.id DESC LIMIT ?",
+                (email, limite)
+            ).fetchall()
+        return [{'timestamp': t, 'tipo': tipo, 'dados': json.loads(d)} for t, tipo, d in reversed(linhas)]
 
-def carregar_favoritos() -> List[str]:
+def migrar_json_para_sqlite(armazenamento: ArmazenamentoUsuarios):
+    """Importa os arquivos do armazenamento de usuário único e os renomeia para *.migrado"""
+    if not os.path.exists(USUARIO_JSON):
+        return
     try:
+        with open(USUARIO_JSON, 'r', encoding='utf-8') as f:
+            dados_perfil = json.load(f)
+        email = dados_perfil['email']
+        armazenamento.salvar_perfil(dados_perfil)
+        
         if os.path.exists(FAVORITOS_JSON):
             with open(FAVORITOS_JSON, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                armazenamento.salvar_favoritos(email, json.load(f))
+        
+        interacoes = []
+        if os.path.exists(HISTORICO_JSON):
+            with open(HISTORICO_JSON, 'r', encoding='utf-8') as f:
+                interacoes.extend(json.load(f))
+        if os.path.exists(HISTORICO_JSONL):
+            with open(HISTORICO_JSONL, 'r', encoding='utf-8') as f:
+                interacoes.extend(json.loads(linha) for linha in f if linha.strip())
+        if interacoes:
+            armazenamento.inserir_interacoes([dict(i, usuario=email) for i in interacoes])
+        
+        for caminho in (USUARIO_JSON, FAVORITOS_JSON, HISTORICO_JSON, HISTORICO_JSONL):
+            if os.path.exists(caminho):
+                os.replace(caminho, caminho + '.migrado')
+        logger.info(f"Dados de {email} migrados para {armazenamento.caminho}")
     except Exception as e:
-        logger.error(f"Erro ao carregar favoritos: {e}")
-    return []
+        logger.error(f"Erro ao migrar dados para SQLite: {e}")
+
+@st.cache_resource
+def obter_armazenamento() -> ArmazenamentoUsuarios:
+    armazenamento = ArmazenamentoUsuarios(BANCO_USUARIOS)
+    migrar_json_para_sqlite(armazenamento)
+    return armazenamento
+
+class RepositorioPerfil:
+    """Perfis em memória por e-mail; o banco só é relido quando outro processo grava.
+    
+    A detecção usa `PRAGMA data_version` numa conexão própria, que muda a cada
+    commit feito por qualquer outra conexão."""
+    
+    def __init__(self, armazenamento: ArmazenamentoUsuarios, persistencia: PersistenciaAssincrona):
+        self.armazenamento = armazenamento
+        self.persistencia = persistencia
+        self._cache: Dict[str, Optional[PerfilUsuario]] = {}
+        self._lock = threading.Lock()
+        self._con = armazenamento.conectar()
+        self._versao = self._versao_dados()
+    
+    def _versao_dados(self) -> int:
+        return self._con.execute("PRAGMA data_version").fetchone()[0]
+    
+    def carregar(self, email: str) -> Optional[PerfilUsuario]:
+        with self._lock:
+            versao = self._versao_dados()
+            if versao != self._versao:
+                self._cache.clear()
+                self._versao = versao
+            if email in self._cache:
+                return self._cache[email]
+            
+            perfil = None
+            try:
+                dados = self.armazenamento.carregar_perfil(email)
+                perfil = PerfilUsuario(**dados) if dados else None
+            except Exception as e:
+                logger.error(f"Erro ao carregar perfil: {e}")
+            self._cache[email] = perfil
+            return perfil
+    
+    def autenticar(self, email: str, senha: str) -> Optional[PerfilUsuario]:
+        try:
+            valida = self.armazenamento.verificar_senha(email, senha)
+        except Exception as e:
+            logger.error(f"Erro ao verificar senha: {e}")
+            return None
+        return self.carregar(email) if valida else None
+    
+    def salvar(self, perfil: PerfilUsuario, email_anterior: Optional[str] = None, novo: bool = False,
+               senha: Optional[str] = None):
+        """Grava no banco na hora (perfis mudam raramente) e só então atualiza o cache.
+        
+        Propaga o ValueError de e-mail já cadastrado sem tocar no cache."""
+        if email_anterior:
+            # Favoritos ainda na fila com o e-mail antigo precisam chegar ao banco antes da troca
+            self.persistencia.flush()
+        self.armazenamento.salvar_perfil(asdict(perfil), email_anterior, novo, senha)
+        with self._lock:
+            # A própria gravação muda o data_version; não deve esvaziar o cache
+            self._versao = self._versao_dados()
+            if email_anterior:
+                self._cache.pop(email_anterior, None)
+            self._cache[perfil.email] = perfil
+
+@st.cache_resource
+def obter_repositorio_perfil() -> RepositorioPerfil:
+    return RepositorioPerfil(obter_armazenamento(), obter_persistencia())
+
+def usuario_atual() -> Optional[str]:
+    return st.session_state.get('usuario_email')
+
+def carregar_perfil_usuario(email: Optional[str] = None) -> Optional[PerfilUsuario]:
+    email = email or usuario_atual()
+    return obter_repositorio_perfil().carregar(email) if email else None
+
+def salvar_perfil_usuario(perfil: PerfilUsuario, email_anterior: Optional[str] = None, novo: bool = False,
+                          senha: Optional[str] = None):
+    obter_repositorio_perfil().salvar(perfil, email_anterior, novo, senha)
+
+def autenticar_usuario(email: str, senha: str) -> Optional[PerfilUsuario]:
+    return obter_repositorio_perfil().autenticar(email, senha)
 
-def salvar_favoritos(favoritos: List[str]):
+def validar_senha(senha: str, confirmacao: str) -> Optional[str]:
+    """Mensagem de erro, ou None se a senha serve"""
+    if len(senha) < TAMANHO_MINIMO_SENHA:
+        return f"A senha precisa ter pelo menos {TAMANHO_MINIMO_SENHA} caracteres."
+    if senha != confirmacao:
+        return "As senhas não conferem."
+    return None
+
+def carregar_favoritos(email: Optional[str] = None) -> List[str]:
+    email = email or usuario_atual()
+    if not email:
+        return []
     try:
-        inicializar_ambiente()
-        with open(FAVORITOS_JSON, 'w', encoding='utf-8') as f:
-            json.dump(favoritos, f, ensure_ascii=False, indent=2)
+        pendente = obter_persistencia().pendente(f"favoritos:{email}")
+        if pendente is not None:
+            return list(pendente)
+        return obter_armazenamento().carregar_favoritos(email)
     except Exception as e:
-        logger.error(f"Erro ao salvar favoritos: {e}")
+        logger.error(f"Erro ao carregar favoritos: {e}")
+    return []
+
+def salvar_favoritos(favoritos: List[str], email: Optional[str] = None):
+    email = email or usuario_atual()
+    if not email:
+        return
+    favoritos = list(favoritos)
+    obter_persistencia().agendar(
+        f"favoritos:{email}", lambda: obter_armazenamento().salvar_favoritos(email, favoritos), favoritos
+    )
+
+class RegistroInteracoes:
+    """Eventos acumulados em memória e inseridos em lote no banco (só INSERTs, nunca reescrita)"""
+    
+    def __init__(self, armazenamento: ArmazenamentoUsuarios, tamanho_lote: int = 20,
+                 intervalo_flush: float = 5.0, max_por_usuario: int = 10_000,
+                 persistencia: Optional[PersistenciaAssincrona] = None):
+        self.armazenamento = armazenamento
+        self.persistencia = persistencia
+        self.tamanho_lote = tamanho_lote
+        self.intervalo_flush = intervalo_flush
+        self.max_por_usuario = max_por_usuario
+        self._buffer: List[Dict] = []
+        self._lock = threading.RLock()
+        self._ultimo_flush = time.monotonic()
+        self._desde_compactacao = 0
+    
+    def registrar(self, interacao: Dict):
+        with self._lock:
+            self._buffer.append(interacao)
+            if (len(self._buffer) >= self.tamanho_lote
+                    or time.monotonic() - self._ultimo_flush >= self.intervalo_flush):
+                self._ultimo_flush = time.monotonic()
+                if self.persistencia:
+                    self.persistencia.agendar("interacoes", self.flush)
+                else:
+                    self.flush()
+    
+    def flush(self):
+        with self._lock:
+            self._ultimo_flush = time.monotonic()
+            lote, self._buffer = self._buffer, []
+        if not lote:
+            return
+        try:
+            self.armazenamento.inserir_interacoes(lote)
+        except Exception as e:
+            logger.error(f"Erro ao salvar histórico: {e}")
+            with self._lock:
+                self._buffer = lote + self._buffer
+            return
+        
+        # Compactação periódica: custo amortizado constante por evento
+        self._desde_compactacao += len(lote)
+        if self._desde_compactacao >= self.max_por_usuario:
+            self._desde_compactacao = 0
+            self.armazenamento.compactar_interacoes(self.max_por_usuario)
+    
+    def carregar(self, email: str, limite: int = 100) -> List[Dict]:
+        self.flush()
+        return self.armazenamento.carregar_interacoes(email, limite)
+
+@st.cache_resource
+def obter_registro_interacoes() -> RegistroInteracoes:
+    # Uma instância por processo, compartilhada entre sessões e reruns
+    registro = RegistroInteracoes(obter_armazenamento(), persistencia=obter_persistencia())
+    atexit.register(registro.flush)
+    return registro
+
+# Campos numéricos da tabela de fundamentos usada por regras e consultas vetorizadas
+CAMPOS_FUNDAMENTOS = [
+    'preco_atual', 'dy', 'pl', 'pvp', 'roe', 'score', 'score_bruto', 'free_cash_flow',
+    'payout_ratio', 'debt_equity', 'margem_liquida', 'crescimento_dividendos', 'beta',
+    'volume_medio', 'dividend_cagr', 'volatilidade', 'max_drawdown'
+]
+# Sem dado, esses campos ficam NaN (exibidos como "n/d") em vez de 0
+CAMPOS_SEM_PADRAO = ['max_drawdown']
+
+def analises_para_dataframe(analises: List[AnaliseAtivo]) -> pd.DataFrame:
+    """Monta a tabela de fundamentos (uma linha por ativo, indexada pelo ticker)"""
+    df = pd.DataFrame({
+        'ticker': [a.ticker for a in analises],
+        'nome_empresa': [a.nome_empresa for a in analises],
+        'setor': [a.setor for a in analises],
+        'risco_nivel': [a.risco_nivel for a in analises],
+        'super_investimento': [bool(a.super_investimento) for a in analises],
+        **{campo: [getattr(a, campo) for a in analises] for campo in CAMPOS_FUNDAMENTOS}
+    })
+    # yfinance pode devolver None em campos numéricos (ex.: beta)
+    df[CAMPOS_FUNDAMENTOS] = df[CAMPOS_FUNDAMENTOS].apply(pd.to_numeric, errors='coerce')
+    preencher = [campo for campo in CAMPOS_FUNDAMENTOS if campo not in CAMPOS_SEM_PADRAO]
+    df[preencher] = df[preencher].fillna(0.0)
+    return df.set_index('ticker', drop=False)
+
+def _coluna(fundamentos, campo: str) -> np.ndarray:
+    return np.nan_to_num(np.asarray(fundamentos[campo], dtype=float))
+
+def pontuar_fundamentos(fundamentos) -> Dict[str, np.ndarray]:
+    """Score de 0 a 10 (e o bruto, sem teto) a partir dos fundamentos.
+    
+    `fundamentos` é a tabela de fundamentos ou um dict com os valores de um só
+    ativo; tudo é calculado por coluna, então o universo inteiro sai de uma vez."""
+    dy, pl, pvp, roe = (_coluna(fundamentos, c) for c in ('dy', 'pl', 'pvp', 'roe'))
+    payout = _coluna(fundamentos, 'payout_ratio')
+    with np.errstate(divide='ignore'):
+        score_pl = np.where(pl > 0, np.minimum(15 / pl, 1), 0) * 1.5
+        score_pvp = np.where(pvp > 0, np.minimum(2 / pvp, 1), 0) * 1.5
+    score_dy = np.where(dy > 0, np.minimum(dy / 0.08, 1), 0) * 4
+    score_roe = np.where(roe > 0, np.minimum(roe / 0.20, 1), 0) * 3
+    score_fcf = np.clip(_coluna(fundamentos, 'free_cash_flow') / 1e9, 0, 1) * 0.5
+    score_payout = np.select([(payout >= 0.3) & (payout <= 0.6), payout > 0], [1.0, 0.5], 0.0)
+    
+    score_bruto = score_dy + score_pl + score_pvp + score_roe + score_fcf + score_payout
+    return {
+        'score_bruto': score_bruto,
+        'score': np.minimum(score_bruto, 10),
+        'super_investimento': score_bruto > 10,
+    }
+
+def classificar_risco(fundamentos) -> np.ndarray:
+    """Nível de risco ('baixo', 'medio', 'alto') por pontos de endividamento, P/L, DY e beta"""
+    debt_equity, pl, dy, beta = (_coluna(fundamentos, c) for c in ('debt_equity', 'pl', 'dy', 'beta'))
+    pontos = (
+        np.select([debt_equity > 1.0, debt_equity > 0.5], [2, 1], 0)
+        + np.select([pl > 25, pl > 15], [2, 1], 0)
+        + (dy > 0.12)
+        + np.select([beta > 1.2, beta < 0.8], [1, -1], 0)
+    )
+    return np.select([pontos >= 4, pontos >= 2], ['alto', 'medio'], 'baixo')
+
+def volatilidade_anualizada(historico: Optional[pd.Series]) -> float:
+    if historico is None or len(historico) < 20:
+        return VOLATILIDADE_PADRAO
+    precos = np.asarray(historico, dtype=float)
+    retornos = np.diff(np.log(precos[precos > 0]))
+    vol = float(np.std(retornos, ddof=1) * np.sqrt(252)) if len(retornos) > 1 else 0.0
+    return vol if np.isfinite(vol) and vol > 0 else VOLATILIDADE_PADRAO
+
+def drawdown_maximo(historico: Optional[pd.Series]) -> float:
+    """Maior queda (negativa) desde um topo no período; NaN sem histórico"""
+    if historico is None or len(historico) < 2:
+        return float('nan')
+    precos = np.asarray(historico, dtype=float)
+    precos = precos[np.isfinite(precos) & (precos > 0)]
+    if len(precos) < 2:
+        return float('nan')
+    return float(np.min(precos / np.maximum.accumulate(precos) - 1))
+
+def covariancia_encolhida(retornos: np.ndarray) -> Optional[np.ndarray]:
+    """Covariância anual de log-retornos diários (dias x ativos), None se houver poucos pregões.
+    
+    Com muitos ativos para poucos pregões a amostra fica instável; encolhe em
+    direção à diagonal na proporção ativos/pregões."""
+    if len(retornos) <= 20:
+        return None
+    n = retornos.shape[1]
+    amostral = np.cov(retornos, rowvar=False).reshape(n, n) * 252
+    encolhimento = 0.5 * min(1.0, n / len(retornos))
+    return (1 - encolhimento) * amostral + encolhimento * np.diag(np.diag(amostral))
+
+def covariancia_anual(analises: List[AnaliseAtivo]) -> np.ndarray:
+    """Covariância anual dos log-retornos diários no histórico compartilhado.
+    
+    Sem pregões comuns suficientes, ativos independentes com a volatilidade de cada um."""
+    armazem = obter_armazem_historicos()
+    retornos = armazem.retornos([a.historico_ref for a in analises], inicio=armazem.inicio_janela())
+    covariancia = covariancia_encolhida(retornos)
+    if covariancia is not None:
+        return covariancia
+    vols = np.array([a.volatilidade or volatilidade_anualizada(a.historico) for a in analises])
+    return np.diag(vols ** 2)
+
+def fator_cholesky(covariancia: np.ndarray) -> np.ndarray:
+    # Covariâncias amostrais podem ser apenas semidefinidas; corta autovalores negativos
+    autovalores, autovetores = np.linalg.eigh(covariancia)
+    return autovetores * np.sqrt(np.clip(autovalores, 0, None))
+
+def trajetoria_composta(valor_inicial, crescimento: np.ndarray, periodo_anos: int) -> np.ndarray:
+    """Matriz (cenários x anos) com valor_inicial * (1 + g) ** ano, acumulada ano a ano"""
+    crescimento = np.asarray(crescimento, dtype=float)
+    fatores = np.repeat((1 + crescimento)[..., None], periodo_anos, axis=-1)
+    fatores[..., 0] *= valor_inicial
+    return np.cumprod(fatores, axis=-1)
+
+def reinvestir_dividendos(qtd_acoes_inicial, precos: np.ndarray, dys: np.ndarray,
+                          fracionario: bool = False) -> Dict[str, np.ndarray]:
+    """Reinveste os dividendos de cada ano em ações inteiras (ou frações, se `fracionario`).
+    
+    `precos` e `dys` têm formato (..., anos); o laço percorre apenas os anos,
+    todos os cenários/caminhos/ativos são atualizados juntos. As quantidades são
+    inteiras, mas guardadas em float64 para não estourar em horizontes longos."""
+    recompra = np.divide if fracionario else np.floor_divide
+    periodo_anos = precos.shape[-1]
+    qtd = np.broadcast_to(np.asarray(qtd_acoes_inicial, dtype=float), precos.shape[:-1]).copy()
+    qtd_acoes = np.empty(precos.shape, dtype=float)
+    dividendos = np.empty(precos.shape, dtype=float)
+    
+    for t in range(periodo_anos):
+        dividendos[..., t] = qtd * precos[..., t] * dys[..., t]
+        qtd += recompra(dividendos[..., t], precos[..., t])
+        qtd_acoes[..., t] = qtd
+    
+    valor_carteira = qtd_acoes * precos
+    return {
+        'qtd_acoes': qtd_acoes,
+        'preco_acao': precos,
+        'valor_carteira': valor_carteira,
+        'renda_anual': valor_carteira * dys,
+        'dividendos_recebidos': dividendos
+    }
+
+def reinvestir_por_pesos(qtd_acoes_inicial: np.ndarray, precos: np.ndarray, dys: np.ndarray,
+                         pesos_alvo: np.ndarray) -> Dict[str, np.ndarray]:
+    """Como `reinvestir_dividendos`, mas os dividendos de todos os ativos (eixo 0)
+    formam um caixa único, redistribuído em ações inteiras conforme os pesos-alvo."""
+    periodo_anos = precos.shape[-1]
+    pesos = np.asarray(pesos_alvo, dtype=float).reshape((-1,) + (1,) * (precos.ndim - 2))
+    qtd = np.broadcast_to(np.asarray(qtd_acoes_inicial, dtype=float), precos.shape[:-1]).copy()
+    qtd_acoes = np.empty(precos.shape, dtype=float)
+    dividendos = np.empty(precos.shape, dtype=float)
+    
+    for t in range(periodo_anos):
+        dividendos[..., t] = qtd * precos[..., t] * dys[..., t]
+        caixa = dividendos[..., t].sum(axis=0)
+        qtd += np.floor_divide(caixa * pesos, precos[..., t])
+        qtd_acoes[..., t] = qtd
+    
+    valor_carteira = qtd_acoes * precos
+    return {
+        'qtd_acoes': qtd_acoes,
+        'preco_acao': precos,
+        'valor_carteira': valor_carteira,
+        'renda_anual': valor_carteira * dys,
+        'dividendos_recebidos': dividendos
+    }
 
 # Função para paralelizar a análise de ativos
 def analisar_ativos_paralelamente(tickers: List[str], max_workers: int = 8) -> List[AnaliseAtivo]:
@@ -228,7 +1228,1366 @@ def analisar_ativos_paralelamente(tickers: List[str], max_workers: int = 8) -> L
             if analise and analise.preco_atual > 0:
                 analises.append(analise)
     
-    return analises
+    if analises:
+        memoria_media = np.mean([medir_memoria_analise(a) for a in analises])
+        if memoria_media > ORCAMENTO_MEMORIA_ANALISE:
+            logger.warning(f"Memória média por ativo ({memoria_media:.0f} B) acima do orçamento de {ORCAMENTO_MEMORIA_ANALISE} B")
+    
+    return analises
+
+# =================== SNAPSHOTS DE ANÁLISES ===================
+# Formato colunar: um .npy por campo (texto em unicode de largura fixa, números em
+# float64) e os históricos numa única matriz float32 ativos x datas com índice de
+# datas compartilhado. Tudo é aberto com mmap, sem copiar para a memória.
+CAMPOS_TEXTO_ANALISE = ['ticker', 'nome_empresa', 'alerta_dy', 'setor', 'risco_nivel']
+
+class SnapshotAnalises:
+    def __init__(self, colunas: Dict[str, np.ndarray], datas: np.ndarray, precos: np.ndarray,
+                 criado_em: float = 0.0):
+        self.colunas = colunas
+        self.datas = datas
+        self.precos = precos
+        self.criado_em = criado_em
+        self._indices: Optional[Dict[str, int]] = None
+    
+    def __len__(self) -> int:
+        return len(self.colunas['ticker'])
+    
+    def indice(self, ticker: str) -> Optional[int]:
+        if self._indices is None:
+            self._indices = {str(t): i for i, t in enumerate(self.colunas['ticker'])}
+        return self._indices.get(ticker)
+    
+    def historico(self, i: int) -> Optional[pd.Series]:
+        linha = self.precos[i]
+        validos = ~np.isnan(linha)
+        if not validos.any():
+            return None
+        return pd.Series(linha[validos], index=pd.DatetimeIndex(self.datas[validos]), name='Close')
+    
+    def analise(self, i: int, historico_ref: Optional[int] = None) -> AnaliseAtivo:
+        dados = {campo: str(self.colunas[campo][i]) for campo in CAMPOS_TEXTO_ANALISE}
+        dados.update({campo: float(self.colunas[campo][i]) for campo in CAMPOS_FUNDAMENTOS})
+        dados['super_investimento'] = bool(self.colunas['super_investimento'][i])
+        segundos = int(self.colunas['ultima_atualizacao'][i])
+        dados['ultima_atualizacao'] = datetime.fromtimestamp(segundos, FUSO_BR) if segundos else None
+        if historico_ref is None:
+            historico_ref = obter_armazem_historicos().registrar(dados['ticker'], self.historico(i))
+        return AnaliseAtivo(historico_ref=historico_ref, **dados)
+    
+    def para_analises(self) -> List[AnaliseAtivo]:
+        tickers = [str(t) for t in self.colunas['ticker']]
+        refs = obter_armazem_historicos().registrar_lote(tickers, self.datas, self.precos)
+        return [self.analise(i, refs[i]) for i in range(len(self))]
+    
+    def para_dataframe(self) -> pd.DataFrame:
+        df = pd.DataFrame({campo: self.colunas[campo] for campo in
+                           CAMPOS_TEXTO_ANALISE + ['super_investimento'] + CAMPOS_FUNDAMENTOS})
+        df[CAMPOS_TEXTO_ANALISE] = df[CAMPOS_TEXTO_ANALISE].astype(str)
+        return df.set_index('ticker', drop=False)
+
+def salvar_snapshot_analises(analises: List[AnaliseAtivo], nome: str = 'universo') -> str:
+    """Grava numa pasta nova e só então aponta `<nome>.json` para ela (troca atômica)"""
+    versao = f"{nome}.{time.time_ns()}"
+    diretorio = os.path.join(SNAPSHOTS_DIR, versao)
+    os.makedirs(diretorio)
+    
+    for campo in CAMPOS_TEXTO_ANALISE:
+        np.save(os.path.join(diretorio, f"{campo}.npy"), np.array([str(getattr(a, campo) or '') for a in analises]))
+    for campo in CAMPOS_FUNDAMENTOS:
+        valores = pd.to_numeric(pd.Series([getattr(a, campo) for a in analises], dtype=object), errors='coerce')
+        if campo not in CAMPOS_SEM_PADRAO:
+            valores = valores.fillna(0.0)
+        np.save(os.path.join(diretorio, f"{campo}.npy"), valores.to_numpy(dtype=np.float64))
+    np.save(os.path.join(diretorio, "super_investimento.npy"),
+            np.array([bool(a.super_investimento) for a in analises], dtype=bool))
+    np.save(os.path.join(diretorio, "ultima_atualizacao.npy"),
+            np.array([int(a.ultima_atualizacao.timestamp()) if a.ultima_atualizacao else 0 for a in analises],
+                     dtype=np.int64))
+    
+    # Mesmo layout do ArmazemHistoricos: linhas dos ativos sobre o calendário compartilhado
+    datas, precos = obter_armazem_historicos().periodo([max(a.historico_ref, 0) for a in analises])
+    precos = precos.copy()
+    precos[[a.historico_ref < 0 for a in analises]] = np.nan
+    np.save(os.path.join(diretorio, "datas.npy"), datas)
+    np.save(os.path.join(diretorio, "precos.npy"), precos)
+    
+    ponteiro = os.path.join(SNAPSHOTS_DIR, f"{nome}.json")
+    anterior = None
+    if os.path.exists(ponteiro):
+        with open(ponteiro, 'r', encoding='utf-8') as f:
+            anterior = json.load(f).get('versao')
+    escrever_json_atomico(ponteiro, {'versao': versao, 'criado_em': time.time(), 'total': len(analises)})
+    if anterior and anterior != versao:
+        shutil.rmtree(os.path.join(SNAPSHOTS_DIR, anterior), ignore_errors=True)
+    return diretorio
+
+def carregar_snapshot_analises(nome: str = 'universo', mmap: bool = True) -> Optional[SnapshotAnalises]:
+    ponteiro = os.path.join(SNAPSHOTS_DIR, f"{nome}.json")
+    try:
+        if not os.path.exists(ponteiro):
+            return None
+        with open(ponteiro, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        diretorio = os.path.join(SNAPSHOTS_DIR, meta['versao'])
+        modo = 'r' if mmap else None
+        carregar = lambda campo: np.load(os.path.join(diretorio, f"{campo}.npy"), mmap_mode=modo)
+        colunas = {campo: carregar(campo) for campo in
+                   CAMPOS_TEXTO_ANALISE + CAMPOS_FUNDAMENTOS + ['super_investimento', 'ultima_atualizacao']}
+        return SnapshotAnalises(colunas, carregar('datas'), carregar('precos'), meta.get('criado_em', 0.0))
+    except Exception as e:
+        logger.error(f"Erro ao carregar snapshot {nome}: {e}")
+        return None
+
+# =================== HISTÓRICO LONGO E ESTATÍSTICAS ===================
+# Job em lote (`python app.py --ingestao`): baixa anos de cotações e proventos de
+# cada ativo, guarda tudo em data/ e pré-calcula as estatísticas que
+# analisar_ativo apenas lê.
+ANOS_HISTORICO_LONGO = 10
+ANOS_CAGR_DIVIDENDOS = 5
+VALIDADE_PROVENTOS = 7 * 24 * 60 * 60  # Proventos baixados pelo app valem uma semana
+CAMPOS_ESTATISTICAS = ['dividend_cagr', 'yield_12m', 'volatilidade', 'max_drawdown', 'drawdown_atual', 'anos_historico']
+
+class ArmazemDividendos:
+    """Proventos de todos os ativos em vetores contíguos (formato CSR).
+    
+    Os eventos ficam ordenados por ativo e data; os do i-ésimo ativo ocupam
+    `datas[inicios[i]:inicios[i + 1]]` e `valores[inicios[i]:inicios[i + 1]]`."""
+    
+    def __init__(self, tickers: Optional[List[str]] = None, inicios: Optional[np.ndarray] = None,
+                 datas: Optional[np.ndarray] = None, valores: Optional[np.ndarray] = None,
+                 consultado_em: Optional[np.ndarray] = None):
+        self.tickers = list(tickers or [])
+        self.inicios = inicios if inicios is not None else np.zeros(len(self.tickers) + 1, dtype=np.int64)
+        self.datas = datas if datas is not None else np.array([], dtype='datetime64[D]')
+        self.valores = valores if valores is not None else np.array([], dtype=float)
+        # Momento (epoch) em que os proventos de cada ativo foram baixados
+        self.consultado_em = consultado_em if consultado_em is not None else np.full(len(self.tickers), time.time())
+        self._por_ticker = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self._lock = threading.Lock()
+        self.modificado_em = 0.0  # mtime do arquivo na última leitura/gravação feita por esta instância
+    
+    @classmethod
+    def de_series(cls, proventos: Dict[str, pd.Series]) -> 'ArmazemDividendos':
+        tickers = sorted(proventos)
+        series = [proventos[t][proventos[t] > 0].sort_index() for t in tickers]
+        tamanhos = np.array([len(serie) for serie in series], dtype=np.int64)
+        inicios = np.concatenate([[0], np.cumsum(tamanhos)])
+        if not len(series) or not tamanhos.sum():
+            return cls(tickers, inicios)
+        datas = np.concatenate([dias_do_indice(serie.index) for serie in series])
+        valores = np.concatenate([serie.to_numpy(dtype=float) for serie in series])
+        return cls(tickers, inicios, datas, valores)
+    
+    def __len__(self) -> int:
+        return len(self.tickers)
+    
+    def eventos(self, ticker: str) -> Tuple[np.ndarray, np.ndarray]:
+        i = self._por_ticker.get(ticker)
+        if i is None:
+            return self.datas[:0], self.valores[:0]
+        return self.datas[self.inicios[i]:self.inicios[i + 1]], self.valores[self.inicios[i]:self.inicios[i + 1]]
+    
+    def ativo_de_cada_evento(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self.tickers)), np.diff(self.inicios))
+    
+    def desatualizado(self, ticker: str) -> bool:
+        i = self._por_ticker.get(ticker)
+        return i is None or time.time() - self.consultado_em[i] > VALIDADE_PROVENTOS
+    
+    def registrar(self, ticker: str, serie: pd.Series):
+        """Substitui os proventos de `ticker`; os vetores são remontados (poucos milhares de eventos)"""
+        serie = serie[serie > 0].sort_index()
+        with self._lock:
+            i = self._por_ticker.get(ticker)
+            if i is None:
+                i = len(self.tickers)
+                self.tickers.append(ticker)
+                self._por_ticker[ticker] = i
+                self.inicios = np.append(self.inicios, self.inicios[-1])
+                self.consultado_em = np.append(self.consultado_em, 0.0)
+            a, b = self.inicios[i], self.inicios[i + 1]
+            self.datas = np.concatenate([self.datas[:a], dias_do_indice(serie.index), self.datas[b:]])
+            self.valores = np.concatenate([self.valores[:a], serie.to_numpy(dtype=float), self.valores[b:]])
+            self.inicios = np.concatenate([self.inicios[:i + 1], self.inicios[i + 1:] + len(serie) - (b - a)])
+            self.consultado_em[i] = time.time()
+    
+    def cagr(self, ano_final: Optional[int] = None, anos: int = ANOS_CAGR_DIVIDENDOS) -> np.ndarray:
+        """CAGR de dividendos de todos os ativos (na ordem de `tickers`)"""
+        return cagr_dividendos(self.ativo_de_cada_evento(), self.datas, self.valores, len(self.tickers),
+                               ano_final or agora_brasilia().year, anos)
+    
+    def salvar(self, caminho: Optional[str] = None):
+        caminho = caminho or DIVIDENDOS_NPZ
+        os.makedirs(os.path.dirname(caminho) or '.', exist_ok=True)
+        # Nome temporário único: a ingestão e outros processos do app gravam o mesmo arquivo
+        fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho) or '.', suffix='.npz')
+        # O lock cobre a troca do arquivo: quem compara mtimes nunca vê a própria gravação como externa
+        with self._lock:
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, tickers=np.array(self.tickers, dtype=str), inicios=self.inicios,
+                             datas=self.datas, valores=self.valores, consultado_em=self.consultado_em)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporario, caminho)
+            except Exception:
+                if os.path.exists(temporario):
+                    os.remove(temporario)
+                raise
+            self.modificado_em = os.path.getmtime(caminho)
+    
+    def recarregar_se_alterado(self, caminho: Optional[str] = None):
+        """Relê o arquivo nesta mesma instância se outro processo (ex.: a ingestão) o gravou"""
+        caminho = caminho or DIVIDENDOS_NPZ
+        modificado_em = os.path.getmtime(caminho) if os.path.exists(caminho) else 0.0
+        if modificado_em == self.modificado_em:
+            return
+        with self._lock:
+            if not os.path.exists(caminho) or os.path.getmtime(caminho) == self.modificado_em:
+                return
+            novo = ArmazemDividendos.carregar(caminho)
+            self.tickers, self.inicios, self.datas, self.valores = novo.tickers, novo.inicios, novo.datas, novo.valores
+            self.consultado_em, self._por_ticker = novo.consultado_em, novo._por_ticker
+            self.modificado_em = novo.modificado_em
+    
+    @classmethod
+    def carregar(cls, caminho: Optional[str] = None) -> 'ArmazemDividendos':
+        caminho = caminho or DIVIDENDOS_NPZ
+        if not os.path.exists(caminho):
+            return cls()
+        try:
+            modificado_em = os.path.getmtime(caminho)
+            with np.load(caminho) as dados:
+                armazem = cls([str(t) for t in dados['tickers']], dados['inicios'], dados['datas'], dados['valores'],
+                              dados['consultado_em'] if 'consultado_em' in dados else None)
+            armazem.modificado_em = modificado_em
+            return armazem
+        except Exception as e:
+            logger.error(f"Erro ao carregar proventos salvos: {e}")
+            return cls()
+
+@st.cache_resource
+def _armazem_dividendos() -> ArmazemDividendos:
+    return ArmazemDividendos.carregar()
+
+def obter_armazem_dividendos() -> ArmazemDividendos:
+    # Uma instância por processo; só é relida quando o arquivo muda por fora (ex.: ingestão em lote)
+    armazem = _armazem_dividendos()
+    armazem.recarregar_se_alterado()
+    return armazem
+
+def cagr_dividendos(ativo: np.ndarray, datas: np.ndarray, valores: np.ndarray, n_ativos: int,
+                    ano_final: int, anos: int = ANOS_CAGR_DIVIDENDOS) -> np.ndarray:
+    """CAGR dos proventos pagos por ano civil, para todos os ativos de uma vez.
+    
+    Usa os `anos` anos completos anteriores a `ano_final` (o ano corrente fica de
+    fora por estar incompleto) e compara o total do primeiro com o do último.
+    Ativos sem proventos em uma das pontas ficam com 0. Mesmos eventos, mesmo
+    resultado: nada aqui é aleatório."""
+    primeiro_ano = ano_final - anos
+    ano_evento = datas.astype('datetime64[Y]').astype(int) + 1970
+    no_periodo = (ano_evento >= primeiro_ano) & (ano_evento < ano_final)
+    totais = np.bincount(ativo[no_periodo] * anos + (ano_evento[no_periodo] - primeiro_ano),
+                         weights=valores[no_periodo], minlength=n_ativos * anos).reshape(n_ativos, anos)
+    com_proventos = (totais[:, 0] > 0) & (totais[:, -1] > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cagr = (totais[:, -1] / totais[:, 0]) ** (1 / (anos - 1)) - 1
+    return np.where(com_proventos, cagr, 0.0)
+
+def cagr_dividendos_ativo(ticker: str, acao=None) -> float:
+    """CAGR de um ativo a partir dos proventos guardados; baixa-os só se faltarem ou estiverem velhos"""
+    armazem = obter_armazem_dividendos()
+    if armazem.desatualizado(ticker):
+        try:
+            acao = acao or yf.Ticker(ticker)
+            armazem.registrar(ticker, acao.dividends)
+        except Exception as e:
+            # O ativo segue analisado com os proventos já guardados (ou CAGR 0 se não houver)
+            logger.error(f"Erro ao buscar proventos de {ticker}: {e}")
+        else:
+            obter_persistencia().agendar("dividendos", armazem.salvar)
+    datas, valores = armazem.eventos(ticker)
+    return float(cagr_dividendos(np.zeros(len(datas), dtype=int), datas, valores, 1, agora_brasilia().year)[0])
+
+def calcular_estatisticas(armazem: ArmazemHistoricos, dividendos: ArmazemDividendos) -> Dict[str, np.ndarray]:
+    """Estatísticas por ativo, todas calculadas de uma vez sobre a matriz ativos x pregões"""
+    datas, precos = armazem.periodo()
+    n = len(armazem)
+    resultado = {'tickers': np.array(armazem.tickers, dtype=str)}
+    if not n or not len(datas):
+        resultado.update({campo: np.zeros(n) for campo in CAMPOS_ESTATISTICAS})
+        return resultado
+    
+    # Repete o último fechamento conhecido nos pregões sem cotação
+    validos = ~np.isnan(precos)
+    posicoes = np.maximum.accumulate(np.where(validos, np.arange(len(datas)), 0), axis=1)
+    precos = np.take_along_axis(precos, posicoes, axis=1).astype(float)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        retornos = np.diff(np.log(precos), axis=1)
+        contagem = np.isfinite(retornos).sum(axis=1)
+        volatilidade = np.where(contagem > 20, np.nanstd(np.where(np.isfinite(retornos), retornos, np.nan),
+                                                         axis=1, ddof=1) * np.sqrt(252), 0.0)
+        drawdown = precos / np.fmax.accumulate(precos, axis=1) - 1
+    max_drawdown = np.nan_to_num(np.nanmin(np.where(np.isnan(drawdown), 0.0, drawdown), axis=1))
+    
+    primeiro = validos.argmax(axis=1)
+    ultimo = len(datas) - 1 - validos[:, ::-1].argmax(axis=1)
+    anos_historico = np.where(validos.any(axis=1), (datas[ultimo] - datas[primeiro]).astype(float) / 365.25, 0.0)
+    preco_final = precos[:, -1]
+    
+    # Proventos dos últimos 12 meses e totais por ano civil, somados por ativo
+    linhas = np.array([armazem.referencia(t) for t in dividendos.tickers], dtype=int)
+    ativo = linhas[dividendos.ativo_de_cada_evento()] if len(dividendos) else np.array([], dtype=int)
+    conhecidos = ativo >= 0
+    ativo, datas_eventos, valores = ativo[conhecidos], dividendos.datas[conhecidos], dividendos.valores[conhecidos]
+    
+    recentes = datas_eventos > datas[-1] - np.timedelta64(365, 'D')
+    proventos_12m = np.bincount(ativo[recentes], weights=valores[recentes], minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        yield_12m = np.where(preco_final > 0, proventos_12m / preco_final, 0.0)
+    
+    ano_final = int(datas[-1].astype('datetime64[Y]').astype(int)) + 1970
+    dividend_cagr = cagr_dividendos(ativo, datas_eventos, valores, n, ano_final)
+    
+    resultado.update({
+        'dividend_cagr': dividend_cagr,
+        'yield_12m': np.nan_to_num(yield_12m),
+        'volatilidade': np.nan_to_num(volatilidade),
+        'max_drawdown': max_drawdown,
+        'drawdown_atual': np.nan_to_num(drawdown[:, -1]),
+        'anos_historico': anos_historico
+    })
+    return resultado
+
+def salvar_estatisticas(estatisticas: Dict[str, np.ndarray], caminho: Optional[str] = None):
+    caminho = caminho or ESTATISTICAS_NPZ
+    os.makedirs(os.path.dirname(caminho) or '.', exist_ok=True)
+    fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho) or '.', suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, atualizado_em=np.array(time.time()), **estatisticas)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, caminho)
+    except Exception:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+
+@st.cache_resource
+def _carregar_estatisticas(caminho: str, modificado_em: float) -> Dict[str, Dict[str, float]]:
+    # `modificado_em` entra só na chave do cache: nova ingestão, nova leitura
+    with np.load(caminho) as dados:
+        colunas = {campo: dados[campo] for campo in CAMPOS_ESTATISTICAS}
+        return {
+            str(ticker): {campo: float(colunas[campo][i]) for campo in CAMPOS_ESTATISTICAS}
+            for i, ticker in enumerate(dados['tickers'])
+        }
+
+def estatisticas_ativo(ticker: str) -> Optional[Dict[str, float]]:
+    try:
+        if not os.path.exists(ESTATISTICAS_NPZ):
+            return None
+        return _carregar_estatisticas(ESTATISTICAS_NPZ, os.path.getmtime(ESTATISTICAS_NPZ)).get(ticker)
+    except Exception as e:
+        logger.error(f"Erro ao ler estatísticas pré-calculadas: {e}")
+        return None
+
+def ingerir_historicos_longos(tickers: List[str], anos: int = ANOS_HISTORICO_LONGO,
+                              max_workers: int = 8) -> Dict[str, np.ndarray]:
+    """Baixa cotações e proventos de `anos` anos (uma requisição por ativo) e grava
+    históricos, proventos e estatísticas em data/"""
+    armazem = ArmazemHistoricos()
+    proventos: Dict[str, pd.Series] = {}
+    
+    def baixar(ticker):
+        return yf.Ticker(ticker).history(period=f"{anos}y", actions=True)
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(baixar, ticker): ticker for ticker in tickers}
+        for future in concurrent.futures.as_completed(futures):
+            ticker = futures[future]
+            try:
+                historico = future.result()
+            except Exception as e:
+                logger.error(f"Erro ao baixar histórico longo de {ticker}: {e}")
+                continue
+            if historico.empty:
+                continue
+            armazem.registrar(ticker, historico['Close'])
+            if 'Dividends' in historico:
+                proventos[ticker] = historico['Dividends']
+    
+    dividendos = ArmazemDividendos.de_series(proventos)
+    estatisticas = calcular_estatisticas(armazem, dividendos)
+    armazem.salvar(HISTORICO_LONGO_NPZ)
+    dividendos.salvar()
+    salvar_estatisticas(estatisticas)
+    logger.info(f"Ingestão concluída: {len(armazem)} de {len(tickers)} ativos, {len(dividendos.valores)} proventos")
+    return estatisticas
+
+# =================== BUSCA TEXTUAL ===================
+STOPWORDS_PT = frozenset("""
+a o as os um uma uns umas de do da dos das em no na nos nas por pelo pela pelos pelas para pra
+com sem sob sobre e ou mas que se como qual quais quando onde quem porque por que eu tu ele ela
+nos vos eles elas meu minha meus minhas seu sua seus suas este esta isto esse essa isso aquele
+aquela ao aos ser sao e foi era estao esta estou ter tem tenho ha mais menos muito muita ja
+nao sim me te lhe o que oq voce voces vc vcs posso pode devo deve fazer faz
+""".split())
+PARAMETROS_BM25 = {'k1': 1.2, 'b': 0.75}
+# Uma única palavra em comum com a pergunta do FAQ (ex.: "score", "dividendos") pontua ~1-2;
+# abaixo do limiar, ou sem folga sobre a segunda colocada, a pergunta não é daquela entrada
+LIMIAR_BM25_FAQ = 2.5
+MARGEM_BM25_FAQ = 0.5
+DIMENSAO_EMBEDDING = 2048
+# Confiança mínima para o assistente responder. Numa amostra rotulada de 85 perguntas, as
+# respostas erradas pararam em 0,47 (cosseno) e a menor certa ficou em 0,498
+LIMIAR_SIMILARIDADE = 0.48
+# Perguntas de definição ("o que é P/L?", "ROE?") preferem o glossário às demais fontes
+PADRAO_DEFINICAO = re.compile(
+    r'^(?:o que (?:e|sao|significa|quer dizer)|qual (?:o )?significado de|significado de|defina|definicao de)\s+(?:o |a |os |as |um |uma )?'
+)
+PALAVRAS_INTERROGATIVAS = {'como', 'quando', 'quanto', 'quanta', 'quantos', 'quantas', 'qual', 'quais', 'onde', 'porque', 'por', 'vale', 'devo', 'posso'}
+# Só um verbete forte (termo exato ou prefixo de palavra do termo, score >= 2 no índice do
+# glossário) recebe o bônus; similaridades fracas de trigrama ou cosseno nunca recebem
+SCORE_GLOSSARIO_FORTE = 2.0
+BONUS_GLOSSARIO_DEFINICAO = 0.25
+# Verbete achado só por trigramas (erro de digitação) nunca passa de uma pergunta do FAQ
+# achada pelo BM25 (limiar 2,5 -> confiança 0,625)
+TETO_GLOSSARIO_APROXIMADO = 0.55
+CONFIANCA_PALAVRA_CHAVE = 0.5
+EMBEDDINGS_DIR = os.path.join(DATA_DIR, 'embeddings')
+GLOSSARIO_EXTERNO_JSON = os.path.join(DATA_DIR, 'glossario.json')  # {termo: definição}, opcional
+LIMIAR_BUSCA_GLOSSARIO = 0.3
+# Grupos de grafias equivalentes (já normalizadas); qualquer uma que apareça no termo
+# ou na busca acrescenta as demais antes de gerar trigramas
+SINONIMOS_GLOSSARIO = [
+    ('dy', 'dividend yield', 'rendimento de dividendos'),
+    ('p l', 'pl', 'preco lucro'),
+    ('p vp', 'pvp', 'preco valor patrimonial'),
+    ('roe', 'retorno sobre patrimonio'),
+    ('debt', 'divida', 'endividamento'),
+    ('equity', 'patrimonio'),
+    ('payout', 'distribuicao'),
+    ('free cash flow', 'fcf', 'fluxo de caixa livre'),
+    ('cagr', 'crescimento anual composto'),
+    ('ev', 'valor da empresa'),
+]
+CAPACIDADE_CACHE_RESPOSTAS = 1024
+MAX_TURNOS_CHAT = 50  # Turnos guardados por sessão
+TURNOS_CHAT_VISIVEIS = 5  # Os anteriores aparecem recolhidos num único bloco
+
+def remover_acentos(texto: str) -> str:
+    decomposto = unicodedata.normalize('NFKD', texto)
+    return ''.join(c for c in decomposto if not unicodedata.combining(c))
+
+def normalizar_texto(texto: str) -> str:
+    """Minúsculas, sem acentos e só com letras/dígitos separados por espaço"""
+    return re.sub(r'[^a-z0-9]+', ' ', remover_acentos(texto.lower())).strip()
+
+def variantes_sinonimos(texto: str) -> List[str]:
+    """Texto normalizado seguido, uma a uma, das grafias equivalentes às que ele contém"""
+    preenchido = f" {texto} "
+    extras = [
+        variante
+        for grupo in SINONIMOS_GLOSSARIO if any(f" {g} " in preenchido for g in grupo)
+        for variante in grupo if f" {variante} " not in preenchido
+    ]
+    return [texto, *extras]
+
+def expandir_sinonimos(texto: str) -> str:
+    return ' '.join(variantes_sinonimos(texto))
+
+def assunto_definicao(pergunta: str) -> Tuple[Optional[str], bool]:
+    """(termo perguntado, se a pergunta pede a definição explicitamente).
+    
+    "o que é P/L?" e "significado de payout" dão o termo e True; uma pergunta
+    curta sem palavra interrogativa ("ROE?", "dividend yield") dá o termo e
+    False: só é tratada como definição se o termo estiver no glossário."""
+    texto = normalizar_texto(pergunta)
+    assunto = PADRAO_DEFINICAO.sub('', texto)
+    if assunto != texto:
+        return (assunto or None), bool(assunto)
+    palavras = texto.split()
+    if 0 < len(palavras) <= 3 and not PALAVRAS_INTERROGATIVAS.intersection(palavras):
+        return texto, False
+    return None, False
+
+def tokenizar(texto: str) -> List[str]:
+    # Plural simples ("dividendos" -> "dividendo") para casar singular e plural
+    return [
+        token[:-1] if len(token) > 3 and token.endswith('s') else token
+        for token in normalizar_texto(texto).split()
+        if token not in STOPWORDS_PT
+    ]
+
+class IndiceBM25:
+    """Índice invertido com ranking BM25: cada termo aponta para os documentos
+    que o contêm e a frequência nele; a busca só toca as listas dos termos da consulta."""
+    
+    def __init__(self, documentos: List[str], k1: float = PARAMETROS_BM25['k1'], b: float = PARAMETROS_BM25['b']):
+        postagens: Dict[str, Dict[int, int]] = defaultdict(dict)
+        comprimentos = np.zeros(len(documentos))
+        for doc_id, documento in enumerate(documentos):
+            tokens = tokenizar(documento)
+            comprimentos[doc_id] = len(tokens)
+            for token in tokens:
+                postagens[token][doc_id] = postagens[token].get(doc_id, 0) + 1
+        
+        self.n_documentos = len(documentos)
+        media = comprimentos.mean() if len(documentos) and comprimentos.mean() > 0 else 1.0
+        normalizacao = k1 * (1 - b + b * comprimentos / media)
+        self.postagens: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for token, frequencias in postagens.items():
+            docs = np.fromiter(frequencias.keys(), dtype=np.int64, count=len(frequencias))
+            tf = np.fromiter(frequencias.values(), dtype=float, count=len(frequencias))
+            idf = np.log1p((self.n_documentos - len(docs) + 0.5) / (len(docs) + 0.5))
+            # Peso BM25 de cada (termo, documento) já pronto; a consulta só soma
+            self.postagens[token] = (docs, idf * tf * (k1 + 1) / (tf + normalizacao[docs]))
+    
+    def buscar(self, consulta: str, k: int = 1) -> List[Tuple[int, float]]:
+        listas = [self.postagens[token] for token in set(tokenizar(consulta)) if token in self.postagens]
+        if not listas:
+            return []
+        docs = np.concatenate([docs for docs, _ in listas])
+        pesos = np.concatenate([pesos for _, pesos in listas])
+        candidatos, posicoes = np.unique(docs, return_inverse=True)
+        scores = np.bincount(posicoes, weights=pesos)
+        melhores = np.argsort(-scores, kind='stable')[:k]
+        return [(int(candidatos[i]), float(scores[i])) for i in melhores]
+
+@st.cache_resource
+def obter_indice_faq(perguntas: Tuple[str, ...]) -> IndiceBM25:
+    # Só o texto da pergunta: as respostas citam DY, P/L, ROE... e puxariam perguntas de definição
+    return IndiceBM25(list(perguntas))
+
+def vetorizar_texto(texto: str, dimensao: int = DIMENSAO_EMBEDDING) -> np.ndarray:
+    """Embedding local por hashing: palavras e n-gramas de 3 a 5 caracteres caem em
+    `dimensao` posições (crc32, com sinal para compensar colisões). Tolera erros de
+    digitação e variações de flexão sem nenhum modelo ou rede."""
+    tokens = tokenizar(texto)
+    ngramas = list(tokens)
+    for token in tokens:
+        palavra = f" {token} "
+        ngramas.extend(palavra[i:i + n] for n in (3, 4, 5) for i in range(len(palavra) - n + 1))
+    if not ngramas:
+        return np.zeros(dimensao, dtype=np.float32)
+    hashes = np.array([zlib.crc32(ngrama.encode()) for ngrama in ngramas], dtype=np.uint32)
+    sinais = np.where(hashes & 0x80000000, -1.0, 1.0)
+    vetor = np.bincount(hashes % dimensao, weights=sinais, minlength=dimensao)
+    vetor = np.sign(vetor) * np.log1p(np.abs(vetor))
+    norma = np.linalg.norm(vetor)
+    return (vetor / norma if norma > 0 else vetor).astype(np.float32)
+
+class BuscaSemantica:
+    """Top-k por produto escalar sobre a matriz (documentos x dimensão) de vetores
+    normalizados, aberta por mmap a partir de data/embeddings."""
+    
+    def __init__(self, textos: List[str], respostas: List[str], origens: List[str], matriz: np.ndarray):
+        self.textos = textos
+        self.respostas = respostas
+        self.origens = origens
+        self.matriz = matriz
+    
+    @classmethod
+    def construir(cls, documentos: List[Tuple[str, str, str]], diretorio: Optional[str] = None) -> 'BuscaSemantica':
+        """`documentos` são (texto indexado, resposta, origem); os vetores ficam em disco,
+        num arquivo identificado pelo conteúdo, e só são recalculados quando ele muda."""
+        diretorio = diretorio or EMBEDDINGS_DIR
+        textos, respostas, origens = (list(coluna) for coluna in zip(*documentos)) if documentos else ([], [], [])
+        assinatura = hashlib.sha1(json.dumps([DIMENSAO_EMBEDDING, textos]).encode('utf-8')).hexdigest()[:16]
+        caminho = os.path.join(diretorio, f"{assinatura}.npy")
+        if not os.path.exists(caminho):
+            matriz = np.vstack([vetorizar_texto(t) for t in textos]) if textos else np.zeros((0, DIMENSAO_EMBEDDING), np.float32)
+            os.makedirs(diretorio, exist_ok=True)
+            temporario = f"{caminho}.{os.getpid()}.tmp.npy"
+            np.save(temporario, matriz)
+            os.replace(temporario, caminho)
+        return cls(textos, respostas, origens, np.load(caminho, mmap_mode='r'))
+    
+    def buscar(self, consulta: str, k: int = 3) -> List[Tuple[int, float]]:
+        if not len(self.textos):
+            return []
+        similaridades = self.matriz @ vetorizar_texto(consulta)
+        k = min(k, len(similaridades))
+        melhores = np.argpartition(-similaridades, k - 1)[:k]
+        melhores = melhores[np.argsort(-similaridades[melhores], kind='stable')]
+        return [(int(i), float(similaridades[i])) for i in melhores]
+
+def documentos_assistente(faq: Dict[str, str]) -> List[Tuple[str, str, str]]:
+    """FAQ, glossário e regras da explicação do score (XAI) como documentos de busca"""
+    documentos = [(f"{pergunta} {resposta}", resposta, 'faq') for pergunta, resposta in faq.items()]
+    documentos += [(f"{termo} {termo} {definicao}", f"**{termo}:** {definicao}", 'glossario')
+                   for termo, definicao in GLOSSARIO.items()]
+    rotulos = {'fatores_positivos': 'um ponto positivo', 'fatores_neutros': 'um ponto neutro',
+               'fatores_negativos': 'um ponto negativo', 'riscos': 'um risco'}
+    for regra in REGRAS_XAI:
+        texto = re.sub(r'\s*de \{[^}]+\}', '', regra['mensagem'])
+        documentos.append((texto, f"Na explicação do score, isto conta como {rotulos[regra['categoria']]}: {texto}.", 'xai'))
+    return documentos
+
+@st.cache_resource
+def obter_busca_semantica(perguntas: Tuple[str, ...], respostas: Tuple[str, ...]) -> BuscaSemantica:
+    return BuscaSemantica.construir(documentos_assistente(dict(zip(perguntas, respostas))))
+
+def trigramas(texto: str) -> List[str]:
+    preenchido = f"  {texto} "
+    return sorted({preenchido[i:i + 3] for i in range(len(preenchido) - 2)})
+
+class IndiceGlossario:
+    """Busca no glossário por prefixo e por trigramas (tolerante a erros de digitação).
+    
+    Termos, definições e busca são normalizados sem acentos e com as abreviações
+    expandidas (SINONIMOS_GLOSSARIO); cada trigrama aponta para os verbetes que o
+    contêm. A ordem vem de termo exato ou prefixo de alguma palavra do termo, depois
+    das palavras da busca presentes no termo e só então da similaridade de trigramas:
+    a fração dos trigramas da busca contida no termo ou em um dos seus sinônimos,
+    cada grafia comparada separadamente, mais quanto da busca aparece na definição."""
+    
+    def __init__(self, itens: List[Tuple[str, str]]):
+        self.termos = [termo for termo, _ in itens]
+        self.definicoes = [definicao for _, definicao in itens]
+        termos_normalizados = [normalizar_texto(termo) for termo in self.termos]
+        self._termos_normalizados = np.array(termos_normalizados, dtype=str)
+        termos_expandidos = [expandir_sinonimos(termo) for termo in termos_normalizados]
+        # Grafias aceitas como termo exato: o próprio termo e as do seu grupo de sinônimos
+        self._grafias_exatas = [
+            {termo}.union(*(grupo for grupo in SINONIMOS_GLOSSARIO if termo in grupo))
+            for termo in termos_normalizados
+        ]
+        self._palavras_termo = [set(termo.split()) for termo in termos_expandidos]
+        
+        palavras = sorted({(palavra, i) for i, termo in enumerate(termos_expandidos) for palavra in termo.split()})
+        self._palavras = np.array([p for p, _ in palavras], dtype=str)
+        self._palavra_verbete = np.array([i for _, i in palavras], dtype=np.int64)
+        
+        # Cada grafia é indexada à parte: uma expansão longa não dilui a de um termo curto
+        grafias = [(grafia, i) for i, termo in enumerate(termos_normalizados) for grafia in variantes_sinonimos(termo)]
+        self._trigramas_grafia = self._indexar([grafia for grafia, _ in grafias])
+        self._grafia_verbete = np.array([i for _, i in grafias], dtype=np.int64)
+        self._trigramas_definicao = self._indexar([normalizar_texto(d) for d in self.definicoes])
+    
+    @staticmethod
+    def _indexar(textos: List[str]) -> Dict[str, np.ndarray]:
+        postagens: Dict[str, List[int]] = defaultdict(list)
+        for i, texto in enumerate(textos):
+            for trigrama in trigramas(texto):
+                postagens[trigrama].append(i)
+        return {trigrama: np.array(ids, dtype=np.int64) for trigrama, ids in postagens.items()}
+    
+    @staticmethod
+    def _contar(indice: Dict[str, np.ndarray], consulta: List[str], tamanho: int) -> np.ndarray:
+        listas = [indice[t] for t in consulta if t in indice]
+        if not listas:
+            return np.zeros(tamanho)
+        return np.bincount(np.concatenate(listas), minlength=tamanho).astype(float)
+    
+    def _contencao(self, consulta: str) -> np.ndarray:
+        similaridade = np.zeros(len(self.termos))
+        for grafia in variantes_sinonimos(consulta):
+            trigramas_grafia = trigramas(grafia)
+            contido = self._contar(self._trigramas_grafia, trigramas_grafia, len(self._grafia_verbete)) / len(trigramas_grafia)
+            np.maximum.at(similaridade, self._grafia_verbete, contido)
+        return similaridade
+    
+    def semelhanca(self, busca: str, termo: str) -> float:
+        """Fração dos trigramas da busca contida no termo (ou num sinônimo dele), de 0 a 1"""
+        consulta = normalizar_texto(busca)
+        if not consulta or termo not in self.termos:
+            return 0.0
+        return float(self._contencao(consulta)[self.termos.index(termo)])
+    
+    def buscar(self, busca: str, limite: Optional[int] = None) -> List[Tuple[str, str, float]]:
+        consulta = normalizar_texto(busca)
+        if not consulta or not self.termos:
+            return []
+        
+        exato = np.array([consulta in grafias for grafias in self._grafias_exatas])
+        # Prefixo: busca binária no vetor ordenado de palavras dos termos
+        inicio = np.searchsorted(self._palavras, consulta, side='left')
+        fim = np.searchsorted(self._palavras, consulta + '\uffff', side='left')
+        com_prefixo = np.zeros(len(self.termos), dtype=bool)
+        com_prefixo[self._palavra_verbete[inicio:fim]] = True
+        com_prefixo |= np.char.startswith(self._termos_normalizados, consulta)
+        forte = 3.0 * exato + 2.0 * com_prefixo
+        
+        palavras_consulta = set(consulta.split())
+        palavras_exatas = np.array([len(palavras_consulta & termo) for termo in self._palavras_termo]) / len(palavras_consulta)
+        
+        similaridade = self._contencao(consulta)
+        trigramas_consulta = trigramas(consulta)
+        similaridade += 0.5 * self._contar(self._trigramas_definicao, trigramas_consulta, len(self.termos)) / len(trigramas_consulta)
+        
+        score = forte + palavras_exatas + similaridade
+        ordem = np.lexsort((-similaridade, -palavras_exatas, -forte))
+        ordem = ordem[score[ordem] >= LIMIAR_BUSCA_GLOSSARIO][:limite]
+        return [(self.termos[i], self.definicoes[i], float(score[i])) for i in ordem]
+
+def carregar_glossario() -> Dict[str, str]:
+    """GLOSSARIO embutido mais os verbetes de data/glossario.json, se existir"""
+    glossario = dict(GLOSSARIO)
+    if os.path.exists(GLOSSARIO_EXTERNO_JSON):
+        try:
+            with open(GLOSSARIO_EXTERNO_JSON, 'r', encoding='utf-8') as f:
+                glossario.update({str(k): str(v) for k, v in json.load(f).items()})
+        except Exception as e:
+            logger.error(f"Erro ao carregar glossário externo: {e}")
+    return glossario
+
+@st.cache_resource
+def obter_indice_glossario(itens: Tuple[Tuple[str, str], ...]) -> IndiceGlossario:
+    return IndiceGlossario(list(itens))
+
+class CacheRespostas:
+    """LRU de respostas do assistente, compartilhado entre sessões e seguro entre threads"""
+    
+    def __init__(self, capacidade: int = CAPACIDADE_CACHE_RESPOSTAS):
+        self.capacidade = capacidade
+        self._itens: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+    
+    def obter(self, chave: str) -> Optional[str]:
+        with self._lock:
+            if chave not in self._itens:
+                self.falhas += 1
+                return None
+            self._itens.move_to_end(chave)
+            self.acertos += 1
+            return self._itens[chave]
+    
+    def guardar(self, chave: str, resposta: str):
+        with self._lock:
+            self._itens[chave] = resposta
+            self._itens.move_to_end(chave)
+            if len(self._itens) > self.capacidade:
+                self._itens.popitem(last=False)
+
+@st.cache_resource
+def obter_cache_respostas() -> CacheRespostas:
+    return CacheRespostas()
+
+# =================== OTIMIZAÇÃO DE CARTEIRA ===================
+def limites_viaveis(setores: np.ndarray, limite_ativo: float, limite_setor: float) -> Tuple[float, float]:
+    """Afrouxa os limites só o necessário para alocar 100% (ex.: poucos ativos ou setores).
+    
+    Cada limite é afrouxado à parte: o por ativo só sobe até 1/n (com n ativos é
+    impossível ficar abaixo disso) e o por setor sobe em passos de 5 p.p. até os
+    setores, cada um limitado também pela soma dos seus ativos, comportarem 100%."""
+    _, grupo = np.unique(setores, return_inverse=True)
+    tamanhos = np.bincount(grupo)
+    limite_ativo = max(limite_ativo, 1 / len(setores))
+    while limite_setor < 1.0 and np.minimum(limite_setor, tamanhos * limite_ativo).sum() < 1 - 1e-9:
+        limite_setor = min(1.0, limite_setor + 0.05)
+    return limite_ativo, limite_setor
+
+def projetar_simplex_limitado(x: np.ndarray, limite: float) -> np.ndarray:
+    """Projeção exata em {0 <= w <= limite, soma 1}: w = clip(x - τ, 0, limite).
+    
+    A soma é linear por partes em τ, com quebras em x e x - limite; avalia todas
+    as quebras de uma vez (ordenação + somas acumuladas) e interpola no trecho certo."""
+    n = len(x)
+    ordenado = np.sort(x)
+    acumulado = np.concatenate([[0.0], np.cumsum(ordenado)])
+    quebras = np.sort(np.concatenate([x, x - limite]))
+    
+    def soma(tau):
+        # Ativos no teto (x - τ >= limite), no meio (0 < x - τ < limite) e zerados
+        no_teto = n - np.searchsorted(ordenado, tau + limite, side='left')
+        ativos = n - np.searchsorted(ordenado, tau, side='right')
+        no_meio = ativos - no_teto
+        soma_meio = acumulado[n - no_teto] - acumulado[n - ativos]
+        return no_teto * limite + soma_meio - no_meio * tau
+    
+    valores = soma(quebras)  # Decrescente em τ
+    j = np.searchsorted(-valores, -1.0, side='left')
+    if j == 0:
+        tau = quebras[0]
+    elif j == len(quebras):
+        tau = quebras[-1]
+    else:
+        t0, t1, f0, f1 = quebras[j - 1], quebras[j], valores[j - 1], valores[j]
+        tau = t0 if f0 == f1 else t0 + (f0 - 1.0) * (t1 - t0) / (f0 - f1)
+    return np.clip(x - tau, 0, limite)
+
+def projetar_pesos(v: np.ndarray, grupo: np.ndarray, limite_ativo: float, limite_setor: float,
+                   iteracoes: int = 100, tolerancia: float = 1e-10) -> np.ndarray:
+    """Projeção euclidiana de `v` em {w >= 0, soma 1, w <= limite_ativo, soma por setor <= limite_setor}.
+    
+    Algoritmo de Dykstra alternando entre o simplex com teto por ativo e os tetos
+    por setor (semiespaços disjuntos, projetados todos de uma vez)."""
+    n_grupos = grupo.max() + 1 if len(grupo) else 0
+    simplex_limitado = lambda x: projetar_simplex_limitado(x, limite_ativo)
+    
+    def tetos_setor(x):
+        excesso = np.maximum(np.bincount(grupo, weights=x, minlength=n_grupos) - limite_setor, 0)
+        return x - (excesso / np.bincount(grupo, minlength=n_grupos))[grupo]
+    
+    x = v.astype(float)
+    p = np.zeros_like(x)
+    q = np.zeros_like(x)
+    for _ in range(iteracoes):
+        y = simplex_limitado(x + p)
+        p = x + p - y
+        x_novo = tetos_setor(y + q)
+        q = y + q - x_novo
+        if np.abs(x_novo - x).max() < tolerancia:
+            x = x_novo
+            break
+        x = x_novo
+    return simplex_limitado(x)
+
+def alocar_quantidades(valor_total: float, precos: np.ndarray, pesos_alvo: np.ndarray, lote: int = 1,
+                       max_compras: int = 100_000) -> Dict:
+    """Converte pesos-alvo em quantidades inteiras (múltiplas de `lote`) para a carteira toda.
+    
+    Parte do piso de cada alvo e gasta o caixa que sobrou comprando, um lote por vez,
+    o ativo que mais reduz o erro quadrático em relação ao alvo, tratando o caixa como
+    uma posição de alvo zero. Comprar um lote de custo c com déficit d e caixa k muda
+    o erro em 2c(c - d - k); para quando nenhum lote cabe ou nenhuma compra reduz o erro."""
+    precos = np.asarray(precos, dtype=float)
+    pesos = np.asarray(pesos_alvo, dtype=float)
+    pesos = pesos / pesos.sum() if pesos.sum() > 0 else np.zeros_like(precos)
+    custo = precos * lote
+    alvo = valor_total * pesos
+    validos = custo > 0
+    lotes = np.where(validos, np.floor(np.divide(alvo, custo, out=np.zeros_like(alvo), where=validos)), 0.0)
+    caixa = valor_total - float((lotes * custo).sum())
+    
+    for _ in range(max_compras):
+        variacao = custo * (custo - (alvo - lotes * custo) - caixa)
+        candidatos = validos & (custo <= caixa + 1e-9) & (variacao < 0)
+        if not candidatos.any():
+            break
+        i = int(np.argmin(np.where(candidatos, variacao, np.inf)))
+        lotes[i] += 1
+        caixa -= custo[i]
+    
+    qtd_acoes = (lotes * lote).astype(np.int64)
+    valor_investido = qtd_acoes * precos
+    pesos_efetivos = valor_investido / valor_total if valor_total > 0 else np.zeros_like(precos)
+    return {
+        'qtd_acoes': qtd_acoes,
+        'valor_investido': valor_investido,
+        'sobra': max(caixa, 0.0),
+        'pesos_efetivos': pesos_efetivos,
+        'erro_rastreamento': float(np.sqrt(((pesos_efetivos - pesos) ** 2).sum()))
+    }
+
+def calcular_rebalanceamento(quantidades: np.ndarray, precos: np.ndarray, pesos_alvo: np.ndarray,
+                             caixa: float = 0.0, lote: int = 1, custo_percentual: float = CUSTO_OPERACAO,
+                             custo_fixo: float = CUSTO_FIXO_OPERACAO, valor_minimo: float = VALOR_MINIMO_OPERACAO,
+                             banda_absoluta: float = BANDA_ABSOLUTA_REBALANCEAMENTO,
+                             banda_relativa: float = BANDA_RELATIVA_REBALANCEAMENTO) -> Dict:
+    """Ordens de compra e venda (em lotes) que levam a carteira aos pesos-alvo.
+    
+    Só entram ativos fora da banda de tolerância e ordens acima do valor mínimo.
+    As vendas, descontados os custos, somadas ao caixa pagam as compras; se não
+    bastarem, todas as compras são reduzidas na mesma proporção."""
+    quantidades = np.asarray(quantidades, dtype=float)
+    precos = np.asarray(precos, dtype=float)
+    pesos_alvo = np.asarray(pesos_alvo, dtype=float)
+    pesos_alvo = pesos_alvo / pesos_alvo.sum() if pesos_alvo.sum() > 0 else pesos_alvo
+    custo_lote = precos * lote
+    
+    valores = quantidades * precos
+    patrimonio = valores.sum() + caixa
+    pesos_atuais = valores / patrimonio if patrimonio > 0 else np.zeros_like(valores)
+    diferenca = pesos_alvo * patrimonio - valores
+    banda = np.minimum(banda_absoluta, banda_relativa * pesos_alvo)
+    operar = (np.abs(pesos_alvo - pesos_atuais) > banda) & (np.abs(diferenca) >= valor_minimo) & (custo_lote > 0)
+    
+    lotes = np.zeros_like(quantidades)
+    np.floor(np.divide(np.abs(diferenca), custo_lote, out=np.zeros_like(diferenca), where=custo_lote > 0),
+             out=lotes, where=operar)
+    vendas = np.where(diferenca < 0, np.minimum(lotes * lote, quantidades), 0.0)
+    compras = np.where(diferenca > 0, lotes * lote, 0.0)
+    
+    def aplicar_minimo(qtd):
+        return np.where(qtd * precos >= valor_minimo, qtd, 0.0)
+    
+    vendas = aplicar_minimo(vendas)
+    disponivel = caixa + (vendas * precos).sum() * (1 - custo_percentual) - custo_fixo * np.count_nonzero(vendas)
+    compras = aplicar_minimo(compras)
+    necessario = (compras * precos).sum() * (1 + custo_percentual) + custo_fixo * np.count_nonzero(compras)
+    if necessario > disponivel and necessario > 0:
+        compras = aplicar_minimo(np.floor(compras * max(disponivel, 0) / necessario / lote) * lote)
+    
+    ordens = compras - vendas
+    valor_ordens = ordens * precos
+    custos = np.abs(valor_ordens) * custo_percentual + custo_fixo * (ordens != 0)
+    caixa_final = caixa - valor_ordens.sum() - custos.sum()
+    quantidades_finais = quantidades + ordens
+    valores_finais = quantidades_finais * precos
+    patrimonio_final = valores_finais.sum() + caixa_final
+    pesos_finais = valores_finais / patrimonio_final if patrimonio_final > 0 else np.zeros_like(valores_finais)
+    return {
+        'ordens': ordens,
+        'valor_ordens': valor_ordens,
+        'custos': custos,
+        'custo_total': float(custos.sum()),
+        'quantidades_finais': quantidades_finais,
+        'precos': precos,
+        'caixa_final': float(caixa_final),
+        'pesos_atuais': pesos_atuais,
+        'pesos_alvo': pesos_alvo,
+        'pesos_finais': pesos_finais,
+        'desvio_antes': float(np.abs(pesos_atuais - pesos_alvo).sum() / 2),
+        'desvio_depois': float(np.abs(pesos_finais - pesos_alvo).sum() / 2)
+    }
+
+def otimizar_alocacao(analises: List[AnaliseAtivo], metodo: str = 'min_variancia', aversao_risco: float = 4.0,
+                      limite_ativo: float = LIMITE_PESO_ATIVO, limite_setor: float = LIMITE_PESO_SETOR,
+                      covariancia: Optional[np.ndarray] = None, iteracoes: int = 500) -> np.ndarray:
+    """Pesos ótimos (somam 1) respeitando os tetos por ativo e por setor.
+    
+    - min_variancia: menor w'Σw
+    - media_variancia: maior μ'w - (aversão/2) w'Σw, com μ = DY + CAGR dos dividendos
+    - paridade_risco: cada ativo contribui igualmente para o risco (depois projetado nos tetos)
+    - max_dy: maior DY médio ponderado (preenchimento guloso, ótimo para esses tetos)"""
+    n = len(analises)
+    if n == 0:
+        return np.array([])
+    if metodo not in METODOS_ALOCACAO:
+        raise ValueError(f"Método de alocação desconhecido: {metodo}")
+    setores = np.array([a.setor or 'Não informado' for a in analises])
+    _, grupo = np.unique(setores, return_inverse=True)
+    limite_ativo, limite_setor = limites_viaveis(setores, limite_ativo, limite_setor)
+    dys = np.array([a.dy for a in analises], dtype=float)
+    
+    if metodo == 'max_dy':
+        pesos = np.zeros(n)
+        usado_setor = np.zeros(grupo.max() + 1)
+        for i in np.argsort(-dys, kind='stable'):
+            pesos[i] = min(limite_ativo, limite_setor - usado_setor[grupo[i]], 1 - pesos.sum())
+            usado_setor[grupo[i]] += pesos[i]
+        return pesos
+    
+    sigma = covariancia_anual(analises) if covariancia is None else covariancia
+    
+    if metodo == 'paridade_risco':
+        # Newton em min ½y'Σy - Σ log(y)/n (convexa); w = y / soma(y) tem contribuições iguais
+        orcamento = np.full(n, 1 / n)
+        y = 1 / np.sqrt(np.diag(sigma)) / n
+        for _ in range(50):
+            gradiente = sigma @ y - orcamento / y
+            direcao = np.linalg.solve(sigma + np.diag(orcamento / y ** 2), gradiente)
+            # Passo amortecido para manter y > 0
+            negativos = direcao > 0
+            passo_maximo = 0.95 * np.min(y[negativos] / direcao[negativos]) if negativos.any() else 1.0
+            y = y - min(1.0, passo_maximo) * direcao
+            if np.abs(gradiente).max() < 1e-10:
+                break
+        return projetar_pesos(y / y.sum(), grupo, limite_ativo, limite_setor)
+    
+    # Gradiente projetado acelerado (FISTA) para as formas quadráticas
+    if metodo == 'media_variancia':
+        retorno_esperado = dys + np.clip([a.dividend_cagr for a in analises], -0.1, 0.2)
+        hessiana = aversao_risco * sigma
+    else:
+        retorno_esperado = np.zeros(n)
+        hessiana = 2 * sigma
+    passo = 1 / max(np.linalg.eigvalsh(hessiana)[-1], 1e-12)
+    
+    w = projetar_pesos(np.full(n, 1 / n), grupo, limite_ativo, limite_setor)
+    z, t = w.copy(), 1.0
+    for _ in range(iteracoes):
+        w_novo = projetar_pesos(z - passo * (hessiana @ z - retorno_esperado), grupo, limite_ativo, limite_setor)
+        t_novo = 0.5 * (1 + np.sqrt(1 + 4 * t * t))
+        z = w_novo + ((t - 1) / t_novo) * (w_novo - w)
+        if np.abs(w_novo - w).max() < 1e-9:
+            w = w_novo
+            break
+        w, t = w_novo, t_novo
+    return w
+
+# =================== RISCO DA CARTEIRA ===================
+INDICE_REFERENCIA = '^BVSP'
+CONFIANCA_VAR = 0.95
+MINIMO_PREGOES_RISCO = 20  # Com menos pregões comuns, só volatilidade e concentração
+LIMITE_VOLATILIDADE_CARTEIRA = 0.30
+LIMITE_DRAWDOWN_CARTEIRA = 0.35
+
+def metricas_risco(retornos: np.ndarray, pesos: np.ndarray, covariancia: np.ndarray,
+                   retornos_indice: Optional[np.ndarray] = None, confianca: float = CONFIANCA_VAR) -> Dict:
+    """Risco de uma carteira de pesos fixos a partir dos log-retornos diários (dias x ativos).
+    
+    VaR e CVaR são históricos, de um dia, como perda positiva; o drawdown é o da
+    curva de valor da carteira no período. `retornos_indice` (alinhado aos dias,
+    NaN onde o índice não tem cotação) dá o beta."""
+    pesos = np.asarray(pesos, dtype=float)
+    sigma_w = covariancia @ pesos
+    volatilidade = float(np.sqrt(max(pesos @ sigma_w, 0.0)))
+    resultado = {
+        'volatilidade': volatilidade,
+        'contribuicao_risco': pesos * sigma_w / volatilidade if volatilidade > 0 else np.zeros_like(pesos),
+        'herfindahl': float(np.sum(pesos ** 2)),
+        'var': None, 'cvar': None, 'max_drawdown': None, 'beta': None,
+        'pregoes': len(retornos),
+    }
+    resultado['n_efetivo'] = 1 / resultado['herfindahl'] if resultado['herfindahl'] > 0 else 0.0
+    if len(retornos) < MINIMO_PREGOES_RISCO:
+        return resultado
+    
+    carteira = np.expm1(retornos) @ pesos
+    limiar = np.quantile(carteira, 1 - confianca)
+    resultado['var'] = float(-limiar)
+    resultado['cvar'] = float(-carteira[carteira <= limiar].mean())
+    valor = np.cumprod(1 + carteira)
+    resultado['max_drawdown'] = float(np.max(1 - valor / np.maximum.accumulate(valor)))
+    
+    if retornos_indice is not None:
+        indice = np.expm1(retornos_indice)
+        validos = np.isfinite(indice)
+        if validos.sum() >= MINIMO_PREGOES_RISCO:
+            x, y = indice[validos], carteira[validos]
+            variancia = np.var(x)
+            resultado['beta'] = float(np.mean((x - x.mean()) * (y - y.mean())) / variancia) if variancia > 0 else None
+    return resultado
+
+@st.cache_data(show_spinner=False, ttl=60*30)
+def risco_quantitativo(tickers: Tuple[str, ...], pesos: Tuple[float, ...], volatilidades: Tuple[float, ...]) -> Dict:
+    """Métricas de risco da composição (tickers, pesos) numa única leitura da matriz de preços.
+    
+    `volatilidades` só é usada se faltarem pregões comuns. O cache é por
+    composição: mudar um peso ou um ativo recalcula, reabrir a aba não."""
+    armazem = obter_armazem_historicos()
+    refs = [armazem.referencia(t) for t in tickers]
+    if any(ref < 0 for ref in refs):
+        return {'erro': 'Histórico indisponível para algum ativo da carteira'}
+    ref_indice = armazem.referencia(INDICE_REFERENCIA)
+    if ref_indice < 0:
+        try:
+            ref_indice = atualizar_historico(INDICE_REFERENCIA)
+        except Exception as e:
+            logger.error(f"Erro ao buscar histórico do {INDICE_REFERENCIA}: {e}")
+    
+    n = len(refs)
+    _, precos = armazem.periodo(refs + ([ref_indice] if ref_indice >= 0 else []), inicio=armazem.inicio_janela())
+    # Pregões em que todos os ativos têm cotação; o índice pode faltar em alguns (beta só usa os dele)
+    comuns = ~np.isnan(precos[:n]).any(axis=0)
+    log_precos = np.log(precos[:, comuns].astype(float))
+    retornos = np.diff(log_precos[:n], axis=1).T
+    retornos_indice = np.diff(log_precos[n]) if ref_indice >= 0 else None
+    
+    pesos = np.asarray(pesos, dtype=float)
+    pesos = pesos / pesos.sum()
+    covariancia = covariancia_encolhida(retornos)
+    if covariancia is None:
+        covariancia = np.diag(np.asarray(volatilidades, dtype=float) ** 2)
+    return metricas_risco(retornos, pesos, covariancia, retornos_indice)
+
+# =================== SIMULAÇÕES CONTRAFACTUAIS ===================
+# "E se o DY cair 10%?": choques aplicados à tabela de fundamentos e score, risco e
+# renda recalculados para o universo e para a carteira numa única passada.
+PISO_DY_SELIC = 0.04  # Limita a sensibilidade do preço à Selic em ações de DY muito baixo
+PISO_DY_CORTE_SELIC = 0.02  # DY exigido após um corte da Selic nunca fica abaixo disso (limita a alta a DY / 2%)
+
+@dataclass
+class CenarioEstresse:
+    variacao_dividendos: float = 0.0  # -0.10 = dividendos 10% menores
+    variacao_preco: float = 0.0  # Movimento de todo o mercado
+    variacao_setor: Dict[str, float] = field(default_factory=dict)  # Movimento extra por setor
+    variacao_selic: float = 0.0  # Em pontos percentuais absolutos (0.01 = +1 p.p.)
+    
+    def neutro(self) -> bool:
+        return (not self.variacao_dividendos and not self.variacao_preco and not self.variacao_selic
+                and not any(self.variacao_setor.values()))
+
+def aplicar_cenario(df: pd.DataFrame, cenario: CenarioEstresse) -> pd.DataFrame:
+    """Fundamentos depois dos choques, com score e risco recalculados.
+    
+    Pela fórmula de Gordon (P = D / (r - g), logo DY = r - g), mudar a Selic em
+    Δ leva o DY exigido a DY + Δ e o preço ao fator exato DY / (DY + Δ). P/L e
+    P/VP acompanham o preço; o DY acompanha dividendos e preço."""
+    dy = df['dy'].to_numpy(dtype=float)
+    fator_preco = (1 + cenario.variacao_preco) * (1 + df['setor'].map(cenario.variacao_setor).fillna(0.0).to_numpy())
+    dy_base = np.maximum(dy, PISO_DY_SELIC)
+    dy_exigido = np.maximum(dy_base + cenario.variacao_selic, PISO_DY_CORTE_SELIC)
+    fator_preco = fator_preco * np.clip(dy_base / dy_exigido, 0.05, None)
+    fator_preco = np.maximum(fator_preco, 0.01)
+    fator_dividendos = max(1 + cenario.variacao_dividendos, 0.0)
+    
+    estressado = df.copy()
+    estressado['preco_atual'] = df['preco_atual'].to_numpy() * fator_preco
+    estressado['dy'] = dy * fator_dividendos / fator_preco
+    estressado['pl'] = df['pl'].to_numpy() * fator_preco
+    estressado['pvp'] = df['pvp'].to_numpy() * fator_preco
+    estressado['fator_preco'] = fator_preco
+    estressado['fator_dividendos'] = fator_dividendos
+    for campo, valores in pontuar_fundamentos(estressado).items():
+        estressado[campo] = valores
+    estressado['risco_nivel'] = classificar_risco(estressado)
+    return estressado
+
+def simular_cenario(df: pd.DataFrame, cenario: CenarioEstresse,
+                    quantidades: Optional[Dict[str, float]] = None) -> Dict:
+    """Universo e carteira (ticker -> quantidade de ações) antes e depois do cenário.
+    
+    O lado "antes" também é repontuado, para que as diferenças venham só dos choques."""
+    base = df.copy()
+    for campo, valores in pontuar_fundamentos(df).items():
+        base[campo] = valores
+    base['risco_nivel'] = classificar_risco(base)
+    estressado = aplicar_cenario(df, cenario)
+    
+    universo = pd.DataFrame({
+        'ticker': df['ticker'],
+        'setor': df['setor'],
+        'score_base': base['score'],
+        'score_cenario': estressado['score'],
+        'delta_score': estressado['score'] - base['score'],
+        'dy_base': base['dy'],
+        'dy_cenario': estressado['dy'],
+        'risco_base': base['risco_nivel'],
+        'risco_cenario': estressado['risco_nivel'],
+        'variacao_preco': estressado['fator_preco'] - 1,
+    })
+    resultado = {
+        'universo': universo,
+        'resumo': {
+            'ativos': len(universo),
+            'score_medio_base': float(universo['score_base'].mean()),
+            'score_medio_cenario': float(universo['score_cenario'].mean()),
+            'super_base': int(base['super_investimento'].sum()),
+            'super_cenario': int(estressado['super_investimento'].sum()),
+            'alto_risco_base': int((universo['risco_base'] == 'alto').sum()),
+            'alto_risco_cenario': int((universo['risco_cenario'] == 'alto').sum()),
+        },
+    }
+    
+    if quantidades:
+        qtd = df['ticker'].map(quantidades).fillna(0.0).to_numpy(dtype=float)
+        na_carteira = qtd > 0
+        valor_base = qtd * base['preco_atual'].to_numpy()
+        valor_cenario = qtd * estressado['preco_atual'].to_numpy()
+        renda_base = valor_base * base['dy'].to_numpy()
+        renda_cenario = valor_cenario * estressado['dy'].to_numpy()
+        
+        def agregados(valor, renda, tabela):
+            total = valor.sum()
+            pesos = valor / total if total > 0 else np.zeros_like(valor)
+            return {
+                'valor': float(total),
+                'renda_anual': float(renda.sum()),
+                'yield': float(renda.sum() / total) if total > 0 else 0.0,
+                'score_medio': float(pesos @ tabela['score'].to_numpy()),
+                'percentual_alto_risco': float(np.mean(tabela['risco_nivel'].to_numpy()[na_carteira] == 'alto')) if na_carteira.any() else 0.0,
+            }
+        resultado['carteira'] = {
+            'base': agregados(valor_base, renda_base, base),
+            'cenario': agregados(valor_cenario, renda_cenario, estressado),
+            'ativos': universo[na_carteira].assign(
+                renda_base=renda_base[na_carteira], renda_cenario=renda_cenario[na_carteira]
+            ),
+        }
+    return resultado
+
+# =================== CONSULTAS DO ASSISTENTE ===================
+# Perguntas sobre dados ("qual o DY de ITUB4?", "ações com score acima de 8") viram
+# consultas sobre o DataFrame do último snapshot do universo, sem chamar o yfinance.
+# métrica -> (rótulo, formato, sinônimos já normalizados)
+METRICAS_ASSISTENTE = {
+    'dy': ('Dividend Yield', 'percentual', ['dividend yield', 'dy', 'yield', 'dividendo']),
+    'pl': ('P/L', 'numero', ['p l', 'pl', 'preco lucro', 'preco sobre lucro']),
+    'pvp': ('P/VP', 'numero', ['p vp', 'pvp', 'preco valor patrimonial', 'valor patrimonial']),
+    'roe': ('ROE', 'percentual', ['roe', 'retorno sobre patrimonio']),
+    'score': ('Score', 'numero', ['score', 'nota', 'pontuacao']),
+    'preco_atual': ('Preço', 'moeda', ['preco', 'cotacao', 'valor da acao']),
+    'payout_ratio': ('Payout', 'percentual', ['payout']),
+    'beta': ('Beta', 'numero', ['beta']),
+    'margem_liquida': ('Margem Líquida', 'percentual', ['margem liquida', 'margem']),
+    'debt_equity': ('Dívida/Patrimônio', 'numero', ['divida patrimonio', 'debt equity', 'endividamento', 'divida']),
+    'dividend_cagr': ('CAGR de Dividendos', 'percentual', ['cagr', 'crescimento de dividendo', 'crescimento dos dividendo', 'crescimento']),
+    'volatilidade': ('Volatilidade', 'percentual', ['volatilidade']),
+    'max_drawdown': ('Drawdown Máximo', 'percentual', ['drawdown', 'queda maxima']),
+}
+OPERADORES_ASSISTENTE = [
+    ('>', ['acima de', 'maior que', 'maiores que', 'mais de', 'superior a', 'superiores a', 'pelo menos', 'no minimo']),
+    ('<', ['abaixo de', 'menor que', 'menores que', 'menos de', 'inferior a', 'inferiores a', 'no maximo', 'ate']),
+]
+AGREGACOES_ASSISTENTE = {
+    'media': ['media', 'medio', 'em media'], 'mediana': ['mediana'],
+    'maximo': ['maximo', 'maxima'], 'minimo': ['minimo', 'minima'],
+}
+# Palavras em português -> setor como o Yahoo Finance devolve
+SETORES_ASSISTENTE = {
+    'banco': 'Financial Services', 'bancos': 'Financial Services', 'financeiro': 'Financial Services',
+    'financas': 'Financial Services', 'eletrica': 'Utilities', 'eletrico': 'Utilities', 'saneamento': 'Utilities',
+    'utilidades': 'Utilities', 'petroleo': 'Energy', 'gas': 'Energy', 'mineracao': 'Basic Materials',
+    'siderurgia': 'Basic Materials', 'celulose': 'Basic Materials', 'quimicos': 'Basic Materials',
+    'materiais': 'Basic Materials', 'varejo': 'Consumer Cyclical', 'alimentacao': 'Consumer Defensive',
+    'alimentos': 'Consumer Defensive', 'industrial': 'Industrials', 'industriais': 'Industrials',
+    'transporte': 'Industrials', 'saude': 'Healthcare', 'telecomunicacoes': 'Communication Services',
+    'telecom': 'Communication Services', 'imobiliario': 'Real Estate', 'construcao': 'Real Estate',
+    'tecnologia': 'Technology',
+}
+LIMITE_RESPOSTA_ASSISTENTE = 10
+# Sem métrica, "melhor"/"maior" só vira ranking com um pedido explícito de lista
+# ("quais as melhores ações?", "top 5 empresas"); "qual o melhor momento para comprar ações?" não
+PISTAS_LISTA_ASSISTENTE = ['quais', 'top', 'ranking', 'liste', 'listar', 'lista']
+
+@dataclass(slots=True)
+class ConsultaAssistente:
+    intencao: str  # 'consulta', 'filtro', 'ranking' ou 'agregado'
+    metrica: Optional[str] = None
+    tickers: Tuple[str, ...] = ()
+    operador: Optional[str] = None
+    valor: float = 0.0
+    decrescente: bool = True
+    limite: int = 5
+    agregacao: str = 'media'
+    setor: Optional[str] = None
+    contagem: bool = False
+
+def _contem(texto: str, expressao: str) -> bool:
+    return re.search(rf'\b{re.escape(expressao)}\b', texto) is not None
+
+def interpretar_pergunta(pergunta: str, setores: Optional[List[str]] = None) -> Optional[ConsultaAssistente]:
+    """Identifica a intenção, a métrica, os tickers e os filtros de uma pergunta; None se não for sobre dados"""
+    normalizada = normalizar_texto(pergunta)
+    tickers = tuple(dict.fromkeys(
+        f"{t.upper()}.SA" for t in re.findall(r'\b([A-Za-z]{4}\d{1,2})(?:\.SA)?\b', pergunta, flags=re.IGNORECASE)
+    ))
+    
+    metrica = None
+    sinonimos = sorted(((sinonimo, chave) for chave, (_, _, lista) in METRICAS_ASSISTENTE.items() for sinonimo in lista),
+                       key=lambda par: -len(par[0]))
+    for sinonimo, chave in sinonimos:
+        if _contem(normalizada, sinonimo) or _contem(normalizada, sinonimo + 's'):
+            metrica = chave
+            break
+    
+    setor = None
+    for palavra in normalizada.split():
+        if palavra in SETORES_ASSISTENTE:
+            setor = SETORES_ASSISTENTE[palavra]
+            break
+    if setor is None:
+        setor = next((s for s in (setores or []) if s and normalizar_texto(s) and _contem(normalizada, normalizar_texto(s))), None)
+    
+    if tickers:
+        return ConsultaAssistente('consulta', metrica=metrica, tickers=tickers)
+    
+    fala_de_acoes = any(_contem(normalizada, p) for p in ['acao', 'acoes', 'ativo', 'ativos', 'empresa', 'empresas', 'papeis'])
+    contagem = _contem(normalizada, 'quantas') or _contem(normalizada, 'quantos')
+    numeros = re.findall(r'(\d+(?:[.,]\d+)?)\s*(%)?', remover_acentos(pergunta.lower()))
+    
+    for operador, expressoes in OPERADORES_ASSISTENTE:
+        if metrica and numeros and any(_contem(normalizada, e) for e in expressoes):
+            texto_numero, percentual = numeros[-1]
+            valor = float(texto_numero.replace(',', '.'))
+            if METRICAS_ASSISTENTE[metrica][1] == 'percentual' and (percentual or valor > 1):
+                valor /= 100
+            return ConsultaAssistente('filtro', metrica=metrica, operador=operador, valor=valor,
+                                      setor=setor, contagem=contagem)
+    
+    for agregacao, expressoes in AGREGACOES_ASSISTENTE.items():
+        if metrica and any(_contem(normalizada, e) for e in expressoes):
+            return ConsultaAssistente('agregado', metrica=metrica, agregacao=agregacao, setor=setor)
+    
+    crescente = any(_contem(normalizada, p) for p in ['menor', 'menores', 'pior', 'piores', 'mais baixo', 'mais baixos'])
+    decrescente = any(_contem(normalizada, p) for p in ['maior', 'maiores', 'melhor', 'melhores', 'top', 'ranking', 'mais alto', 'mais altos'])
+    pede_lista = any(_contem(normalizada, p) for p in PISTAS_LISTA_ASSISTENTE)
+    if (crescente or decrescente) and (metrica or (fala_de_acoes and pede_lista)):
+        limite = int(float(numeros[0][0].replace(',', '.'))) if numeros else 5
+        return ConsultaAssistente('ranking', metrica=metrica or 'score', decrescente=not crescente,
+                                  limite=max(1, min(limite, LIMITE_RESPOSTA_ASSISTENTE)), setor=setor)
+    
+    if contagem and fala_de_acoes:
+        return ConsultaAssistente('agregado', metrica=metrica or 'score', agregacao='contagem', setor=setor)
+    return None
+
+def formatar_metrica(metrica: str, valor: float) -> str:
+    if not np.isfinite(valor):
+        return "n/d"
+    formato = METRICAS_ASSISTENTE[metrica][1]
+    if formato == 'percentual':
+        return f"{valor:.2%}"
+    if formato == 'moeda':
+        return f"R$ {valor:,.2f}"
+    return f"{valor:.2f}"
+
+def executar_consulta(consulta: ConsultaAssistente, df: pd.DataFrame) -> str:
+    """Executa a consulta no DataFrame de fundamentos (um ativo por linha) e devolve a resposta em markdown"""
+    nome = lambda ticker: ticker.replace('.SA', '')
+    
+    if consulta.intencao == 'consulta':
+        linhas = []
+        for ticker in consulta.tickers:
+            if ticker not in df.index:
+                linhas.append(f"- **{nome(ticker)}**: sem dados no momento.")
+                continue
+            ativo = df.loc[ticker]
+            metricas = [consulta.metrica] if consulta.metrica else ['score', 'dy', 'pl', 'pvp', 'preco_atual']
+            valores = " · ".join(f"{METRICAS_ASSISTENTE[m][0]} {formatar_metrica(m, ativo[m])}" for m in metricas)
+            linhas.append(f"- **{nome(ticker)}** ({ativo['nome_empresa']}): {valores}")
+        return "\n".join(linhas)
+    
+    if consulta.setor:
+        df = df[df['setor'] == consulta.setor]
+    sufixo_setor = f" do setor {consulta.setor}" if consulta.setor else ""
+    if df.empty:
+        return f"Não encontrei ações{sufixo_setor} nos dados carregados."
+    rotulo = METRICAS_ASSISTENTE[consulta.metrica][0]
+    
+    if consulta.intencao == 'filtro':
+        mascara = df[consulta.metrica] > consulta.valor if consulta.operador == '>' else df[consulta.metrica] < consulta.valor
+        filtrado = df[mascara].sort_values(consulta.metrica, ascending=consulta.operador == '<')
+        condicao = f"{rotulo} {'acima' if consulta.operador == '>' else 'abaixo'} de {formatar_metrica(consulta.metrica, consulta.valor)}"
+        if filtrado.empty:
+            return f"Nenhuma ação{sufixo_setor} tem {condicao}."
+        titulo = f"**{len(filtrado)} ações**{sufixo_setor} têm {condicao}"
+        if consulta.contagem:
+            return titulo + "."
+        itens = ", ".join(f"{nome(t)} ({formatar_metrica(consulta.metrica, v)})"
+                          for t, v in filtrado[consulta.metrica].head(LIMITE_RESPOSTA_ASSISTENTE).items())
+        return f"{titulo}: {itens}" + ("…" if len(filtrado) > LIMITE_RESPOSTA_ASSISTENTE else "")
+    
+    if consulta.intencao == 'ranking':
+        coluna = df[consulta.metrica]
+        selecionados = coluna.nlargest(consulta.limite) if consulta.decrescente else coluna.nsmallest(consulta.limite)
+        linhas = [f"{i}. **{nome(t)}** — {formatar_metrica(consulta.metrica, v)}"
+                  for i, t, v in zip(range(1, len(selecionados) + 1), selecionados.index, selecionados.values)]
+        ordem = "maiores" if consulta.decrescente else "menores"
+        return f"{ordem.capitalize()} valores de {rotulo}{sufixo_setor}:\n" + "\n".join(linhas)
+    
+    if consulta.agregacao == 'contagem':
+        return f"Tenho dados de **{len(df)} ações**{sufixo_setor}."
+    funcoes = {'media': ('médio', np.mean), 'mediana': ('mediano', np.median),
+               'maximo': ('máximo', np.max), 'minimo': ('mínimo', np.min)}
+    adjetivo, funcao = funcoes[consulta.agregacao]
+    valores = df[consulta.metrica].dropna().to_numpy()
+    if not len(valores):
+        return f"{rotulo}{sufixo_setor}: sem dados no momento."
+    return f"{rotulo} {adjetivo}{sufixo_setor}: **{formatar_metrica(consulta.metrica, float(funcao(valores)))}** ({len(valores)} ações)."
+
+@st.cache_resource(max_entries=1)
+def _dataframe_snapshot(modificado_em: float) -> Tuple[Optional[pd.DataFrame], float]:
+    snapshot = carregar_snapshot_analises()
+    if snapshot is None:
+        return None, 0.0
+    return snapshot.para_dataframe(), snapshot.criado_em
+
+def dataframe_universo() -> Tuple[Optional[pd.DataFrame], float]:
+    """Fundamentos do último snapshot do universo (e quando foi criado), sem consultar o yfinance"""
+    ponteiro = os.path.join(SNAPSHOTS_DIR, 'universo.json')
+    if not os.path.exists(ponteiro):
+        return None, 0.0
+    return _dataframe_snapshot(os.path.getmtime(ponteiro))
+
+def responder_com_dados(pergunta: str) -> Optional[str]:
+    df, criado_em = dataframe_universo()
+    consulta = interpretar_pergunta(pergunta, list(df['setor'].unique()) if df is not None else None)
+    if consulta is None:
+        return None
+    if df is None:
+        return "Ainda não tenho os dados de mercado carregados. Abra a aba de ranking para atualizá-los e pergunte de novo."
+    rodape = f"\n\n_Dados de {datetime.fromtimestamp(criado_em, FUSO_BR):%d/%m %H:%M}._"
+    return executar_consulta(consulta, df) + rodape
 
 # =================== AGENTES ESPECIALIZADOS ===================
 class RendyFinanceAgent:
@@ -240,10 +2599,13 @@ class RendyFinanceAgent:
         try:
             acao = yf.Ticker(ticker)
             info = acao.info
-            historico = acao.history(period="1y")
-            historico_close = historico['Close'] if not historico.empty else None
+            armazem = obter_armazem_historicos()
+            historico_ref = atualizar_historico(ticker, acao)
+            historico_close = armazem.serie(historico_ref, inicio=armazem.inicio_janela())
+            estatisticas = estatisticas_ativo(ticker)
             
-            dy_raw = info.get('dividendYield', 0) or 0
+            # Sem DY no Yahoo, usa o yield dos proventos dos últimos 12 meses
+            dy_raw = info.get('dividendYield', 0) or (estatisticas or {}).get('yield_12m', 0) or 0
             dy, alerta_dy = validar_dy(float(dy_raw))
             pl = info.get('trailingPE', 0) or 0
             pvp = info.get('priceToBook', 0) or 0
@@ -261,20 +2623,24 @@ class RendyFinanceAgent:
             beta = info.get('beta', 0)
             volume_medio = info.get('averageVolume', 0)
             
-            score_dy = min(dy / 0.08, 1) * 4 if dy > 0 else 0
-            score_pl = min(15 / pl if pl > 0 else 0, 1) * 1.5
-            score_pvp = min(2 / pvp if pvp > 0 else 0, 1) * 1.5
-            score_roe = min(roe / 0.20, 1) * 3 if roe > 0 else 0
-            
-            score_fcf = min(free_cash_flow / 1e9 if free_cash_flow > 0 else 0, 1) * 0.5
-            score_payout = 1 if 0.3 <= payout_ratio <= 0.6 else 0.5 if payout_ratio > 0 else 0
-            
-            score_bruto = score_dy + score_pl + score_pvp + score_roe + score_fcf + score_payout
-            score_total = min(score_bruto, 10)
-            is_super = score_bruto > 10
+            fundamentos = {
+                'dy': dy, 'pl': pl, 'pvp': pvp, 'roe': roe, 'free_cash_flow': free_cash_flow,
+                'payout_ratio': payout_ratio, 'debt_equity': debt_equity, 'beta': beta
+            }
+            pontuacao = pontuar_fundamentos(fundamentos)
+            score_bruto = float(pontuacao['score_bruto'])
+            score_total = float(pontuacao['score'])
+            is_super = bool(pontuacao['super_investimento'])
             
-            crescimento_dividendos = np.random.uniform(0.02, 0.15) if dy > 0 else 0
-            risco_nivel = _self._classificar_risco(debt_equity, pl, dy, beta)
+            if estatisticas:
+                crescimento_dividendos = estatisticas['dividend_cagr']
+                volatilidade = estatisticas['volatilidade']
+                max_drawdown = estatisticas['max_drawdown']
+            else:
+                crescimento_dividendos = cagr_dividendos_ativo(ticker, acao)
+                volatilidade = volatilidade_anualizada(historico_close)
+                max_drawdown = drawdown_maximo(historico_close)  # Só o último ano, sem a ingestão longa
+            risco_nivel = str(classificar_risco(fundamentos))
             
             analise = AnaliseAtivo(
                 ticker=ticker,
@@ -287,7 +2653,7 @@ class RendyFinanceAgent:
                 score=score_total,
                 score_bruto=score_bruto,
                 super_investimento=is_super,
-                historico=historico_close,
+                historico_ref=historico_ref,
                 alerta_dy=alerta_dy,
                 free_cash_flow=float(free_cash_flow),
                 payout_ratio=float(payout_ratio),
@@ -299,6 +2665,8 @@ class RendyFinanceAgent:
                 beta=beta,
                 volume_medio=volume_medio,
                 dividend_cagr=crescimento_dividendos,
+                volatilidade=volatilidade,
+                max_drawdown=max_drawdown,
                 ultima_atualizacao=agora_brasilia()
             )
             
@@ -320,59 +2688,42 @@ class RendyFinanceAgent:
                 ultima_atualizacao=agora_brasilia()
             )
     
-    def _classificar_risco(self, debt_equity: float, pl: float, dy: float, beta: float) -> str:
-        pontos_risco = 0
-        
-        if debt_equity > 1.0:
-            pontos_risco += 2
-        elif debt_equity > 0.5:
-            pontos_risco += 1
-            
-        if pl > 25:
-            pontos_risco += 2
-        elif pl > 15:
-            pontos_risco += 1
-            
-        if dy > 0.12:
-            pontos_risco += 1
-            
-        if beta > 1.2:
-            pontos_risco += 1
-        elif beta < 0.8:
-            pontos_risco -= 1
-            
-        if pontos_risco >= 4:
-            return "alto"
-        elif pontos_risco >= 2:
-            return "medio"
-        else:
-            return "baixo"
-    
-    def analisar_carteira(self, tickers: List[str], valores: List[float]) -> Dict:
+    def analisar_carteira(self, tickers: List[str], valores: List[float], lote: int = 1) -> Dict:
         analises = []
         valor_total = sum(valores)
-        renda_total = 0
         
+        validos = []
         for ticker, valor in zip(tickers, valores):
             analise = self.analisar_ativo(ticker)
             if analise.preco_atual > 0:
-                qtd_acoes = int(valor // analise.preco_atual)
-                valor_investido = qtd_acoes * analise.preco_atual
-                renda_anual = valor_investido * analise.dy
-                renda_total += renda_anual
-                
-                analises.append({
-                    'analise': analise,
-                    'valor_alocado': valor,
-                    'valor_investido': valor_investido,
-                    'qtd_acoes': qtd_acoes,
-                    'renda_anual': renda_anual,
-                    'peso_carteira': valor / valor_total if valor_total > 0 else 0
-                })
+                validos.append((analise, valor))
+        
+        # Quantidades decididas para a carteira inteira: a sobra de um ativo compra ações de outro
+        alocacao = alocar_quantidades(
+            valor_total,
+            np.array([a.preco_atual for a, _ in validos]),
+            np.array([v for _, v in validos]),
+            lote=lote
+        ) if validos else {'qtd_acoes': [], 'valor_investido': [], 'sobra': valor_total}
+        
+        renda_total = 0
+        for (analise, valor), qtd_acoes, valor_investido in zip(validos, alocacao['qtd_acoes'], alocacao['valor_investido']):
+            renda_anual = float(valor_investido) * analise.dy
+            renda_total += renda_anual
+            analises.append({
+                'analise': analise,
+                'valor_alocado': valor,
+                'valor_investido': float(valor_investido),
+                'qtd_acoes': int(qtd_acoes),
+                'renda_anual': renda_anual,
+                'peso_carteira': valor / valor_total if valor_total > 0 else 0
+            })
         
         return {
             'analises': analises,
             'valor_total': valor_total,
+            'valor_investido': sum(a['valor_investido'] for a in analises),
+            'sobra_caixa': alocacao['sobra'],
             'renda_total_anual': renda_total,
             'yield_carteira': renda_total / valor_total if valor_total > 0 else 0,
             'diversificacao': len(set([a['analise'].setor for a in analises]))
@@ -457,143 +2808,171 @@ class RendyInvestAgent:
         
         return min(score, 10)
     
-    def gerar_sugestao_alocacao(self, valor_total: float, ativos_recomendados: List[AnaliseAtivo]) -> Dict:
+    def gerar_sugestao_alocacao(self, valor_total: float, ativos_recomendados: List[AnaliseAtivo],
+                                metodo: Optional[str] = None) -> Dict:
         if not self.perfil_usuario or not ativos_recomendados:
             return {}
         
         perfil = self.perfil_usuario
-        num_ativos = min(len(ativos_recomendados), 5)
+        metodo = metodo or METODO_ALOCACAO_PERFIL.get(perfil.tolerancia_risco, 'paridade_risco')
+        pesos = otimizar_alocacao(
+            ativos_recomendados, metodo,
+            aversao_risco=AVERSAO_RISCO_PERFIL.get(perfil.tolerancia_risco, 4.0)
+        )
+        
+        # Descarta pesos residuais e redistribui o que sobrou entre os demais
+        pesos = np.where(pesos >= PESO_MINIMO_SUGESTAO, pesos, 0.0)
+        if pesos.sum() <= 0:
+            return {}
+        pesos = pesos / pesos.sum()
         
-        if perfil.tolerancia_risco == "conservador":
-            pesos = [0.4, 0.25, 0.2, 0.1, 0.05][:num_ativos]
-        elif perfil.tolerancia_risco == "agressivo":
-            pesos = [1/num_ativos] * num_ativos
+        return {
+            ativo.ticker: valor_total * peso
+            for ativo, peso in sorted(zip(ativos_recomendados, pesos), key=lambda par: -par[1])
+            if peso > 0
+        }
+
+    def planejar_rebalanceamento(self, analises: List[AnaliseAtivo], quantidades: np.ndarray,
+                                 caixa: float = 0.0, lote: int = 1, metodo: Optional[str] = None) -> Dict:
+        """Rebalanceia para os pesos do otimizador (método do perfil) ou, sem perfil, pesos iguais"""
+        if not analises:
+            return {'erro': 'Carteira vazia'}
+        if self.perfil_usuario:
+            metodo = metodo or METODO_ALOCACAO_PERFIL.get(self.perfil_usuario.tolerancia_risco, 'paridade_risco')
+            pesos_alvo = otimizar_alocacao(
+                analises, metodo,
+                aversao_risco=AVERSAO_RISCO_PERFIL.get(self.perfil_usuario.tolerancia_risco, 4.0)
+            )
         else:
-            pesos = [0.3, 0.25, 0.2, 0.15, 0.1][:num_ativos]
+            metodo = 'pesos_iguais'
+            pesos_alvo = np.full(len(analises), 1 / len(analises))
+        resultado = calcular_rebalanceamento(
+            quantidades, np.array([a.preco_atual for a in analises]), pesos_alvo, caixa=caixa, lote=lote
+        )
+        resultado['tickers'] = [a.ticker for a in analises]
+        resultado['metodo'] = metodo
+        return resultado
+
+class RendyXAI:
+    CATEGORIAS = ['fatores_positivos', 'fatores_negativos', 'fatores_neutros', 'riscos']
+    
+    def avaliar_regras(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Avalia todas as regras XAI de uma vez: uma coluna booleana por regra"""
+        return pd.DataFrame(
+            {regra['id']: regra['condicao'](df).to_numpy(dtype=bool) for regra in REGRAS_XAI},
+            index=df.index
+        )
+    
+    def consultar_fator(self, df: pd.DataFrame, regra_id: str) -> List[str]:
+        """Tickers que disparam uma regra (ex.: 'payout_insustentavel')"""
+        regra = next((r for r in REGRAS_XAI if r['id'] == regra_id), None)
+        if regra is None:
+            raise KeyError(f"Regra XAI desconhecida: {regra_id}")
+        mascara = regra['condicao'](df).to_numpy(dtype=bool)
+        return df.index[mascara].tolist()
+    
+    def classificar_fatores(self, df: pd.DataFrame) -> Dict[str, Dict[str, List[str]]]:
+        if df.empty:
+            return {}
         
-        soma_pesos = sum(pesos)
-        pesos = [p/soma_pesos for p in pesos]
+        fatores = [{categoria: [] for categoria in self.CATEGORIAS} for _ in range(len(df))]
+        mascaras = self.avaliar_regras(df).to_numpy()
+        registros = df.to_dict('records')
         
-        alocacao = {}
-        for i, ativo in enumerate(ativos_recomendados[:num_ativos]):
-            alocacao[ativo.ticker] = valor_total * pesos[i]
+        for j, regra in enumerate(REGRAS_XAI):
+            for i in np.flatnonzero(mascaras[:, j]):
+                fatores[i][regra['categoria']].append(regra['mensagem'].format(**registros[i]))
         
-        return alocacao
-
-class RendyXAI:
+        return dict(zip(df.index, fatores))
+    
+    def recomendacoes(self, scores: pd.Series) -> np.ndarray:
+        return np.select(
+            [scores.to_numpy() >= limite for limite, _ in FAIXAS_RECOMENDACAO],
+            [texto for _, texto in FAIXAS_RECOMENDACAO],
+            default=RECOMENDACAO_PADRAO
+        )
+    
     def explicacao_score_detalhada(self, analise: AnaliseAtivo) -> Dict[str, str]:
+        df = analises_para_dataframe([analise])
+        fatores = self.classificar_fatores(df)[analise.ticker]
+        
         explicacoes = {
-            'resumo': '',
-            'fatores_positivos': [],
-            'fatores_negativos': [],
-            'fatores_neutros': [],
-            'recomendacao': '',
-            'riscos': []
+            'resumo': f"Análise de {analise.ticker.replace('.SA', '')} - {analise.nome_empresa}",
+            'fatores_positivos': fatores['fatores_positivos'],
+            'fatores_negativos': fatores['fatores_negativos'],
+            'fatores_neutros': fatores['fatores_neutros'],
+            'recomendacao': str(self.recomendacoes(df['score'])[0]),
+            'riscos': fatores['riscos']
         }
         
-        # Resumo
-        explicacoes['resumo'] = f"Análise de {analise.ticker.replace('.SA', '')} - {analise.nome_empresa}"
-        
-        # Fatores
-        if analise.dy > 0.08:
-            explicacoes['fatores_positivos'].append(f"Dividend Yield de {analise.dy:.2%} está acima da média do mercado (8%)")
-        elif analise.dy > 0.05:
-            explicacoes['fatores_neutros'].append(f"Dividend Yield de {analise.dy:.2%} está na média do mercado")
-        else:
-            explicacoes['fatores_negativos'].append(f"Dividend Yield de {analise.dy:.2%} está abaixo da média desejável")
-        
-        if analise.pl > 0 and analise.pl < 15:
-            explicacoes['fatores_positivos'].append(f"P/L de {analise.pl:.1f} indica ação com preço atrativo")
-        elif analise.pl > 25:
-            explicacoes['fatores_negativos'].append(f"P/L de {analise.pl:.1f} pode indicar ação cara")
-        
-        if analise.roe > 0.15:
-            explicacoes['fatores_positivos'].append(f"ROE de {analise.roe:.2%} demonstra boa eficiência da empresa")
-        elif analise.roe < 0.10:
-            explicacoes['fatores_negativos'].append(f"ROE de {analise.roe:.2%} está abaixo do ideal")
-        
-        if analise.payout_ratio > 0.6:
-            explicacoes['fatores_negativos'].append(f"Payout ratio de {analise.payout_ratio:.1%} pode ser insustentável")
-        elif 0.3 <= analise.payout_ratio <= 0.6:
-            explicacoes['fatores_positivos'].append(f"Payout ratio de {analise.payout_ratio:.1%} está em nível saudável")
-        
-        if analise.beta < 0.8:
-            explicacoes['fatores_positivos'].append(f"Beta de {analise.beta:.2f} indica menor volatilidade que o mercado")
-        elif analise.beta > 1.2:
-            explicacoes['riscos'].append(f"Beta de {analise.beta:.2f} indica maior volatilidade que o mercado")
-        
-        # Risco
-        if analise.risco_nivel == "baixo":
-            explicacoes['fatores_positivos'].append("Classificado como investimento de baixo risco")
-        elif analise.risco_nivel == "alto":
-            explicacoes['riscos'].append("Classificado como investimento de alto risco")
-        
-        # Recomendação
-        if analise.score >= 8:
-            explicacoes['recomendacao'] = "Excelente oportunidade de investimento"
-        elif analise.score >= 6:
-            explicacoes['recomendacao'] = "Boa opção para carteira diversificada"
-        elif analise.score >= 4:
-            explicacoes['recomendacao'] = "Considere com cautela, analise outros fatores"
-        else:
-            explicacoes['recomendacao'] = "Não recomendado no momento atual"
-        
         return explicacoes
 
 class RendyAutoAgent:
-    @st.cache_data(show_spinner="Simulando investimento...", ttl=60*30)  # Cache de 30 minutos
-    def simular_investimento(_self, ticker: str, valor_inicial: float, periodo_anos: int = 5) -> Dict:
+    # Cache por (ativo, cotação, quantidade, cenários) no horizonte máximo: mudar o prazo
+    # serve um prefixo e, no reinvestimento fracionário, mudar o valor apenas reescala
+    @st.cache_data(show_spinner="Simulando investimento...", ttl=60*60, max_entries=512)
+    def _projetar_horizonte_maximo(_self, ticker: str, preco_atual: float, dy: float, qtd_acoes: float,
+                                   chave_cenarios: Tuple[Tuple[str, float, float], ...],
+                                   fracionario: bool) -> Dict[str, np.ndarray]:
+        crescimento_preco = np.array([c[1] for c in chave_cenarios])
+        crescimento_dividendo = np.array([c[2] for c in chave_cenarios])
+        
+        # Matrizes cenários x anos
+        precos = trajetoria_composta(preco_atual, crescimento_preco, HORIZONTE_MAXIMO_SIMULACAO)
+        dys = trajetoria_composta(dy, crescimento_dividendo, HORIZONTE_MAXIMO_SIMULACAO)
+        return reinvestir_dividendos(qtd_acoes, precos, dys, fracionario)
+    
+    def simular_investimento(self, ticker: str, valor_inicial: float, periodo_anos: int = 5,
+                             cenarios: Optional[Dict[str, Dict[str, float]]] = None,
+                             reinvestimento_fracionario: bool = False) -> Dict:
         finance_agent = RendyFinanceAgent()
         analise = finance_agent.analisar_ativo(ticker)
         
         if analise.preco_atual <= 0:
             return {'erro': 'Não foi possível obter dados do ativo'}
         
-        qtd_acoes_inicial = int(valor_inicial // analise.preco_atual)
+        if not 1 <= periodo_anos <= HORIZONTE_MAXIMO_SIMULACAO:
+            return {'erro': f'Período deve estar entre 1 e {HORIZONTE_MAXIMO_SIMULACAO} anos'}
+        
+        if reinvestimento_fracionario:
+            # Sem arredondamento a projeção é linear na quantidade: calcula 1 ação e reescala
+            qtd_acoes_inicial = valor_inicial / analise.preco_atual
+            qtd_base, escala = 1.0, qtd_acoes_inicial
+        else:
+            qtd_acoes_inicial = int(valor_inicial // analise.preco_atual)
+            qtd_base, escala = float(qtd_acoes_inicial), 1.0
         valor_investido = qtd_acoes_inicial * analise.preco_atual
         
-        cenarios = {
-            'conservador': {'crescimento_preco': 0.05, 'crescimento_dividendo': 0.02},
-            'realista': {'crescimento_preco': 0.08, 'crescimento_dividendo': 0.05},
-            'otimista': {'crescimento_preco': 0.12, 'crescimento_dividendo': 0.08}
+        if qtd_acoes_inicial == 0:
+            return {'erro': 'Valor inicial insuficiente para comprar ao menos uma ação'}
+        
+        cenarios = cenarios or CENARIOS_SIMULACAO
+        nomes = list(cenarios.keys())
+        chave_cenarios = tuple(
+            (n, float(cenarios[n]['crescimento_preco']), float(cenarios[n]['crescimento_dividendo'])) for n in nomes
+        )
+        
+        base = self._projetar_horizonte_maximo(
+            ticker, analise.preco_atual, analise.dy, qtd_base, chave_cenarios, reinvestimento_fracionario
+        )
+        matrizes = {
+            campo: m[:, :periodo_anos] * escala if campo in CAMPOS_PROPORCIONAIS_QTD else m[:, :periodo_anos]
+            for campo, m in base.items()
         }
+        anos = np.arange(1, periodo_anos + 1)
         
-        resultados = {}
+        valor_final = matrizes['valor_carteira'][:, -1]
+        renda_final = matrizes['renda_anual'][:, -1]
+        retorno_total = (valor_final - valor_investido) / valor_investido
         
-        for nome_cenario, params in cenarios.items():
-            qtd_acoes = qtd_acoes_inicial
-            preco_acao = analise.preco_atual
-            dy_atual = analise.dy
-            
-            historico_anual = []
-            
-            for ano in range(1, periodo_anos + 1):
-                preco_acao *= (1 + params['crescimento_preco'])
-                dy_atual *= (1 + params['crescimento_dividendo'])
-                dividendos_ano = qtd_acoes * preco_acao * dy_atual
-                novas_acoes = int(dividendos_ano // preco_acao)
-                qtd_acoes += novas_acoes
-                
-                valor_carteira = qtd_acoes * preco_acao
-                renda_anual = qtd_acoes * preco_acao * dy_atual
-                
-                historico_anual.append({
-                    'ano': ano,
-                    'qtd_acoes': qtd_acoes,
-                    'preco_acao': preco_acao,
-                    'valor_carteira': valor_carteira,
-                    'renda_anual': renda_anual,
-                    'dividendos_recebidos': dividendos_ano
-                })
-            
-            valor_final = qtd_acoes * preco_acao
-            renda_final_anual = qtd_acoes * preco_acao * dy_atual
-            
+        resultados = {}
+        for i, nome_cenario in enumerate(nomes):
             resultados[nome_cenario] = {
-                'valor_final': valor_final,
-                'renda_anual_final': renda_final_anual,
-                'retorno_total': (valor_final - valor_investido) / valor_investido,
-                'historico': historico_anual
+                'valor_final': float(valor_final[i]),
+                'renda_anual_final': float(renda_final[i]),
+                'retorno_total': float(retorno_total[i]),
+                # Visões das linhas da matriz, sem cópia
+                'historico': {'ano': anos, **{campo: m[i] for campo, m in matrizes.items()}}
             }
         
         return {
@@ -602,8 +2981,170 @@ class RendyAutoAgent:
             'qtd_acoes_inicial': qtd_acoes_inicial,
             'preco_inicial': analise.preco_atual,
             'dy_inicial': analise.dy,
+            'anos': anos,
+            'nomes_cenarios': nomes,
+            'matrizes': matrizes,
             'cenarios': resultados
         }
+    
+    @st.cache_data(show_spinner="Rodando simulação Monte Carlo...", ttl=60*30)
+    def simular_monte_carlo(_self, ticker: str, valor_inicial: float, periodo_anos: int = 20,
+                            n_caminhos: int = 10_000, semente: int = 42,
+                            tamanho_lote: int = TAMANHO_LOTE_MONTE_CARLO) -> Dict:
+        finance_agent = RendyFinanceAgent()
+        analise = finance_agent.analisar_ativo(ticker)
+        
+        if analise.preco_atual <= 0:
+            return {'erro': 'Não foi possível obter dados do ativo'}
+        
+        qtd_acoes_inicial = int(valor_inicial // analise.preco_atual)
+        valor_investido = qtd_acoes_inicial * analise.preco_atual
+        
+        if qtd_acoes_inicial == 0:
+            return {'erro': 'Valor inicial insuficiente para comprar ao menos uma ação'}
+        
+        # Crescimento médio do cenário realista; dispersão do histórico longo (ou de 1 ano)
+        base = CENARIOS_SIMULACAO['realista']
+        vol_preco = analise.volatilidade or volatilidade_anualizada(analise.historico)
+        vol_dividendo = vol_preco * FATOR_VOL_DIVIDENDO
+        deriva_preco = np.log1p(base['crescimento_preco']) - 0.5 * vol_preco ** 2
+        deriva_dividendo = np.log1p(base['crescimento_dividendo']) - 0.5 * vol_dividendo ** 2
+        
+        rng = np.random.default_rng(semente)
+        valor_carteira = np.empty((n_caminhos, periodo_anos), dtype=np.float32)
+        renda_anual = np.empty((n_caminhos, periodo_anos), dtype=np.float32)
+        
+        for inicio in range(0, n_caminhos, tamanho_lote):
+            fim = min(inicio + tamanho_lote, n_caminhos)
+            choques = rng.standard_normal((2, fim - inicio, periodo_anos))
+            precos = analise.preco_atual * np.exp(np.cumsum(deriva_preco + vol_preco * choques[0], axis=1))
+            dys = analise.dy * np.exp(np.cumsum(deriva_dividendo + vol_dividendo * choques[1], axis=1))
+            lote = reinvestir_dividendos(qtd_acoes_inicial, precos, dys)
+            valor_carteira[inicio:fim] = lote['valor_carteira']
+            renda_anual[inicio:fim] = lote['renda_anual']
+        
+        return {
+            'ticker': ticker,
+            'valor_inicial': valor_investido,
+            'qtd_acoes_inicial': qtd_acoes_inicial,
+            'n_caminhos': n_caminhos,
+            'volatilidade_preco': vol_preco,
+            'volatilidade_dividendo': vol_dividendo,
+            'anos': np.arange(1, periodo_anos + 1),
+            'percentis': PERCENTIS_MONTE_CARLO,
+            'bandas_valor': np.percentile(valor_carteira, PERCENTIS_MONTE_CARLO, axis=0),
+            'bandas_renda': np.percentile(renda_anual, PERCENTIS_MONTE_CARLO, axis=0),
+            'valor_final_medio': float(valor_carteira[:, -1].mean()),
+            'prob_perda': float((valor_carteira[:, -1] < valor_investido).mean())
+        }
+
+    @st.cache_data(show_spinner="Simulando carteira...", ttl=60*30)
+    def simular_carteira(_self, tickers: List[str], valores: List[float], periodo_anos: int = 5,
+                         reinvestimento: str = "mesmo_ativo", pesos_alvo: Optional[List[float]] = None,
+                         choques_correlacionados: bool = False, n_caminhos: int = 5_000,
+                         semente: int = 42) -> Dict:
+        finance_agent = RendyFinanceAgent()
+        analises = [finance_agent.analisar_ativo(t) for t in tickers]
+        validos = [i for i, a in enumerate(analises) if a.preco_atual > 0]
+        
+        if not validos:
+            return {'erro': 'Não foi possível obter dados dos ativos da carteira'}
+        
+        analises = [analises[i] for i in validos]
+        tickers = [tickers[i] for i in validos]
+        valores = np.array([valores[i] for i in validos], dtype=float)
+        precos_iniciais = np.array([a.preco_atual for a in analises])
+        dys_iniciais = np.array([a.dy for a in analises])
+        
+        qtd_acoes_inicial = alocar_quantidades(valores.sum(), precos_iniciais, valores)['qtd_acoes'].astype(float)
+        valor_investido = float((qtd_acoes_inicial * precos_iniciais).sum())
+        
+        if valor_investido <= 0:
+            return {'erro': 'Valores insuficientes para comprar ao menos uma ação'}
+        
+        if reinvestimento == "pesos_alvo":
+            pesos = np.array([pesos_alvo[i] for i in validos], dtype=float) if pesos_alvo else valores
+            pesos = pesos / pesos.sum()
+            reinvestir = lambda qtd, p, d: reinvestir_por_pesos(qtd, p, d, pesos)
+        else:
+            reinvestir = reinvestir_dividendos
+        
+        # Tensores ativos x cenários x anos
+        nomes = list(CENARIOS_SIMULACAO.keys())
+        formato = (len(tickers), len(nomes))
+        crescimento_preco = np.broadcast_to([CENARIOS_SIMULACAO[n]['crescimento_preco'] for n in nomes], formato)
+        crescimento_dividendo = np.broadcast_to([CENARIOS_SIMULACAO[n]['crescimento_dividendo'] for n in nomes], formato)
+        precos = trajetoria_composta(precos_iniciais[:, None], crescimento_preco, periodo_anos)
+        dys = trajetoria_composta(dys_iniciais[:, None], crescimento_dividendo, periodo_anos)
+        tensores = reinvestir(qtd_acoes_inicial[:, None], precos, dys)
+        anos = np.arange(1, periodo_anos + 1)
+        
+        valor_total = tensores['valor_carteira'].sum(axis=0)
+        renda_total = tensores['renda_anual'].sum(axis=0)
+        
+        resultados = {}
+        for i, nome_cenario in enumerate(nomes):
+            resultados[nome_cenario] = {
+                'valor_final': float(valor_total[i, -1]),
+                'renda_anual_final': float(renda_total[i, -1]),
+                'retorno_total': float((valor_total[i, -1] - valor_investido) / valor_investido),
+                'historico': {'ano': anos, 'valor_carteira': valor_total[i], 'renda_anual': renda_total[i]}
+            }
+        
+        resultado = {
+            'tickers': tickers,
+            'valor_inicial': valor_investido,
+            'qtd_acoes_inicial': qtd_acoes_inicial,
+            'anos': anos,
+            'nomes_cenarios': nomes,
+            'tensores': tensores,
+            'cenarios': resultados,
+            'monte_carlo': None
+        }
+        
+        if choques_correlacionados:
+            resultado['monte_carlo'] = _self._monte_carlo_carteira(
+                analises, qtd_acoes_inicial, valor_investido, periodo_anos, reinvestir, n_caminhos, semente
+            )
+        
+        return resultado
+    
+    def _monte_carlo_carteira(self, analises: List[AnaliseAtivo], qtd_acoes_inicial: np.ndarray,
+                              valor_investido: float, periodo_anos: int, reinvestir, n_caminhos: int,
+                              semente: int) -> Dict:
+        covariancia = covariancia_anual(analises)
+        vols = np.sqrt(np.diag(covariancia))
+        fator = fator_cholesky(covariancia)
+        base = CENARIOS_SIMULACAO['realista']
+        deriva_preco = (np.log1p(base['crescimento_preco']) - 0.5 * vols ** 2)[:, None, None]
+        deriva_dividendo = (np.log1p(base['crescimento_dividendo']) - 0.5 * (vols * FATOR_VOL_DIVIDENDO) ** 2)[:, None, None]
+        precos_iniciais = np.array([a.preco_atual for a in analises])[:, None, None]
+        dys_iniciais = np.array([a.dy for a in analises])[:, None, None]
+        
+        rng = np.random.default_rng(semente)
+        valor_total = np.empty((n_caminhos, periodo_anos), dtype=np.float32)
+        renda_total = np.empty((n_caminhos, periodo_anos), dtype=np.float32)
+        lote = max(1, TAMANHO_LOTE_MONTE_CARLO // len(analises))
+        
+        for inicio in range(0, n_caminhos, lote):
+            fim = min(inicio + lote, n_caminhos)
+            # Choques correlacionados entre ativos: ativos x caminhos x anos
+            choques = np.einsum('ak,kny->any', fator, rng.standard_normal((len(analises), fim - inicio, periodo_anos)))
+            choques_div = np.einsum('ak,kny->any', fator, rng.standard_normal((len(analises), fim - inicio, periodo_anos)))
+            precos = precos_iniciais * np.exp(np.cumsum(deriva_preco + choques, axis=-1))
+            dys = dys_iniciais * np.exp(np.cumsum(deriva_dividendo + FATOR_VOL_DIVIDENDO * choques_div, axis=-1))
+            tensores = reinvestir(qtd_acoes_inicial[:, None], precos, dys)
+            valor_total[inicio:fim] = tensores['valor_carteira'].sum(axis=0)
+            renda_total[inicio:fim] = tensores['renda_anual'].sum(axis=0)
+        
+        return {
+            'n_caminhos': n_caminhos,
+            'correlacao': covariancia / np.outer(vols, vols).clip(1e-12),
+            'percentis': PERCENTIS_MONTE_CARLO,
+            'bandas_valor': np.percentile(valor_total, PERCENTIS_MONTE_CARLO, axis=0),
+            'bandas_renda': np.percentile(renda_total, PERCENTIS_MONTE_CARLO, axis=0),
+            'prob_perda': float((valor_total[:, -1] < valor_investido).mean())
+        }
 
 class RendySupportAgent:
     def __init__(self):
@@ -621,20 +3162,72 @@ class RendySupportAgent:
         }
     
     def responder_pergunta(self, pergunta: str) -> str:
+        # Respostas com dados mudam a cada snapshot; não entram no cache
+        resposta = responder_com_dados(pergunta)
+        if resposta is not None:
+            return resposta
+        
+        # Perguntas iguais a menos de acentos, caixa e pontuação têm a mesma resposta
+        chave = normalizar_texto(pergunta)
+        cache = obter_cache_respostas()
+        resposta = cache.obter(chave)
+        if resposta is None:
+            resposta = self._responder(pergunta)
+            cache.guardar(chave, resposta)
+        return resposta
+    
+    def _candidatos(self, pergunta: str) -> List[Tuple[float, str]]:
+        """(confiança de 0 a ~1, resposta) de cada fonte, na mesma escala para poderem ser comparadas"""
         pergunta_lower = pergunta.lower().strip()
+        assunto, explicita = assunto_definicao(pergunta)
+        glossario = carregar_glossario()
+        indice_glossario = obter_indice_glossario(tuple(glossario.items()))
+        verbetes = indice_glossario.buscar(assunto or pergunta, limite=1)
+        verbete_forte = bool(verbetes) and verbetes[0][2] >= SCORE_GLOSSARIO_FORTE
+        definicao = explicita or (assunto is not None and verbete_forte)
+        candidatos = []
         
-        for chave, resposta in self.faq.items():
-            if any(palavra in pergunta_lower for palavra in chave.split()):
-                return resposta
+        respostas = tuple(self.faq.values())
+        resultado = obter_indice_faq(tuple(self.faq)).buscar(pergunta, k=2)
+        if resultado and resultado[0][1] >= LIMIAR_BM25_FAQ:
+            segundo = resultado[1][1] if len(resultado) > 1 else 0.0
+            if resultado[0][1] - segundo >= MARGEM_BM25_FAQ:
+                # Pergunta igual à do FAQ pontua ~4; o limiar (2,5) já dá confiança acima da palavra-chave
+                candidatos.append((min(1.0, resultado[0][1] / 4), respostas[resultado[0][0]]))
         
-        if any(palavra in pergunta_lower for palavra in ['rendy', 'aplicativo', 'app', 'plataforma']):
-            return "A Rendy AI é uma plataforma inteligente que ajuda você a investir em ações que pagam dividendos. Usamos algoritmos avançados para analisar e ranquear as melhores oportunidades do mercado brasileiro, considerando seu perfil de investidor."
+        # Perguntas longas ("quando caem os dividendos") casam palavras soltas com algum verbete; o
+        # glossário só concorre quando a pergunta é o próprio termo ou pede a definição dele
+        if verbetes and assunto is not None:
+            termo, texto, score = verbetes[0]
+            if verbete_forte:
+                confianca = min(1.0, score / 3) + (BONUS_GLOSSARIO_DEFINICAO if definicao else 0.0)
+            else:
+                # Sem termo exato nem prefixo, só conta quanto da pergunta é o termo com erro de digitação
+                confianca = min(indice_glossario.semelhanca(assunto, termo), TETO_GLOSSARIO_APROXIMADO)
+            candidatos.append((confianca, f"**{termo}:** {texto}"))
         
-        if any(palavra in pergunta_lower for palavra in ['segurança', 'dados', 'privacidade']):
-            return "Sua privacidade é nossa prioridade. Não coletamos dados pessoais desnecessários e todas as informações são processadas localmente. Seus dados de perfil ficam armazenados apenas no seu dispositivo."
+        palavras_chave = [
+            (['segurança', 'seguro', 'segura', 'dados', 'privacidade'], "Sua privacidade é nossa prioridade. Não coletamos dados pessoais desnecessários nem os compartilhamos com terceiros. Perfil, favoritos e histórico ficam no banco de dados do servidor que hospeda o app, protegidos pela sua senha (guardada apenas como hash)."),
+            (['rendy', 'aplicativo', 'app', 'plataforma'], "A Rendy AI é uma plataforma inteligente que ajuda você a investir em ações que pagam dividendos. Usamos algoritmos avançados para analisar e ranquear as melhores oportunidades do mercado brasileiro, considerando seu perfil de investidor."),
+            (['começar', 'iniciar', 'primeiro'], "Para começar: 1) Preencha seu perfil de investidor, 2) Explore nosso ranking de ações, 3) Use a simulação para entender o potencial, 4) Monte sua carteira com nossa ajuda. Sempre invista apenas o que pode perder!"),
+        ]
+        for palavras, resposta in palavras_chave:
+            if any(palavra in pergunta_lower for palavra in palavras):
+                candidatos.append((CONFIANCA_PALAVRA_CHAVE, resposta))
+                break
         
-        if any(palavra in pergunta_lower for palavra in ['começar', 'iniciar', 'primeiro']):
-            return "Para começar: 1) Preencha seu perfil de investidor, 2) Explore nosso ranking de ações, 3) Use a simulação para entender o potencial, 4) Monte sua carteira com nossa ajuda. Sempre invista apenas o que pode perder!"
+        # Busca semântica local em FAQ, glossário e textos do XAI
+        busca = obter_busca_semantica(tuple(self.faq), respostas)
+        for i, similaridade in busca.buscar(assunto if definicao else pergunta, k=3):
+            candidatos.append((similaridade, busca.respostas[i]))
+        return candidatos
+    
+    def _responder(self, pergunta: str) -> str:
+        candidatos = self._candidatos(pergunta)
+        if candidatos:
+            confianca, resposta = max(candidatos, key=lambda candidato: candidato[0])
+            if confianca >= LIMIAR_SIMILARIDADE:
+                return resposta
         
         return "Desculpe, não encontrei uma resposta específica para sua pergunta. Tente perguntar sobre: dividend yield, score, perfil de risco, como escolher ações, super investimentos, tributação, simulação ou reinvestimento. Nossa equipe está sempre trabalhando para melhorar o atendimento!"
     
@@ -710,35 +3303,24 @@ class RendyComplianceAgent:
         if not analises_carteira:
             return {'risco': 'indefinido', 'recomendacoes': []}
         
-        riscos_altos = sum(1 for a in analises_carteira if a['analise'].risco_nivel == 'alto')
-        total_ativos = len(analises_carteira)
-        percentual_alto_risco = riscos_altos / total_ativos
+        analises = [item['analise'] for item in analises_carteira]
+        tickers = [a.ticker for a in analises]
+        pesos = np.array([item['peso_carteira'] for item in analises_carteira], dtype=float)
+        total_ativos = len(analises)
+        percentual_alto_risco = float(np.mean([a.risco_nivel == 'alto' for a in analises]))
         
-        setores = set(a['analise'].setor for a in analises_carteira)
+        setores, grupo = np.unique([a.setor for a in analises], return_inverse=True)
+        pesos_setor = np.bincount(grupo, weights=pesos, minlength=len(setores))
         diversificacao_setorial = len(setores)
         
         recomendacoes = []
-        
-        # Análise de concentração por setor
-        setores_dist = {}
-        for item in analises_carteira:
-            setor = item['analise'].setor
-            peso = item['peso_carteira']
-            setores_dist[setor] = setores_dist.get(setor, 0) + peso
-        
-        for setor, peso in setores_dist.items():
-            if peso > 0.4:
-                recomendacoes.append(f"Concentração excessiva no setor {setor} ({peso*100:.1f}%)")
-        
-        # Análise de concentração por ativo
-        for item in analises_carteira:
-            if item['peso_carteira'] > 0.3:
-                recomendacoes.append(
-                    f"Concentração excessiva em {item['analise'].ticker} ({item['peso_carteira']*100:.1f}%)"
-                )
+        for setor, peso in zip(setores[pesos_setor > LIMITE_PESO_SETOR], pesos_setor[pesos_setor > LIMITE_PESO_SETOR]):
+            recomendacoes.append(f"Concentração excessiva no setor {setor} ({peso*100:.1f}%)")
+        for i in np.flatnonzero(pesos > LIMITE_PESO_ATIVO):
+            recomendacoes.append(f"Concentração excessiva em {tickers[i]} ({pesos[i]*100:.1f}%)")
         
         # Análise de DY excessivo
-        dy_medio = np.mean([item['analise'].dy for item in analises_carteira])
+        dy_medio = float(np.mean([a.dy for a in analises]))
         if dy_medio > 0.15:
             recomendacoes.append(f"Dividend Yield médio muito alto ({dy_medio*100:.1f}%)")
         
@@ -751,6 +3333,19 @@ class RendyComplianceAgent:
         if total_ativos < 5:
             recomendacoes.append("Carteira com poucos ativos. Considere diversificar mais.")
         
+        quantitativo = {}
+        if pesos.sum() > 0:
+            quantitativo = risco_quantitativo(
+                tuple(tickers), tuple(np.round(pesos, 6)),
+                tuple(a.volatilidade or VOLATILIDADE_PADRAO for a in analises)
+            )
+        if 'erro' in quantitativo:
+            quantitativo = {}
+        if quantitativo.get('volatilidade', 0) > LIMITE_VOLATILIDADE_CARTEIRA:
+            recomendacoes.append(f"Volatilidade anual elevada ({quantitativo['volatilidade']*100:.1f}%)")
+        if (quantitativo.get('max_drawdown') or 0) > LIMITE_DRAWDOWN_CARTEIRA:
+            recomendacoes.append(f"Queda máxima de {quantitativo['max_drawdown']*100:.1f}% no último ano")
+        
         if percentual_alto_risco > 0.7:
             nivel_risco = 'muito_alto'
         elif percentual_alto_risco > 0.4:
@@ -764,6 +3359,8 @@ class RendyComplianceAgent:
             'risco': nivel_risco,
             'percentual_alto_risco': percentual_alto_risco,
             'diversificacao_setorial': diversificacao_setorial,
+            'pesos_setor': dict(zip(setores.tolist(), pesos_setor.tolist())),
+            'quantitativo': quantitativo,
             'recomendacoes': recomendacoes
         }
 
@@ -799,17 +3396,23 @@ class RendyOrchestrator:
     def salvar_interacao(self, tipo: str, dados: Dict):
         interacao = {
             'timestamp': agora_brasilia().isoformat(),
+            'usuario': usuario_atual(),
             'tipo': tipo,
             'dados': dados
         }
         st.session_state.historico_interacoes.append(interacao)
-        
-        try:
-            with open(HISTORICO_JSON, 'w', encoding='utf-8') as f:
-                json.dump(st.session_state.historico_interacoes, f, 
-                         ensure_ascii=False, indent=2, default=str)
-        except Exception as e:
-            logger.error(f"Erro ao salvar histórico: {e}")
+        obter_registro_interacoes().registrar(interacao)
+    
+    def entrar(self, perfil: PerfilUsuario):
+        st.session_state.usuario_email = perfil.email
+        st.session_state.favoritos = carregar_favoritos(perfil.email)
+        st.session_state.perfil_completo = True
+        self.invest_agent.definir_perfil(perfil)
+    
+    def sair(self):
+        for chave in ['usuario_email', 'favoritos', 'carteira', 'historico_interacoes', 'chat_history',
+                      'sugestoes_carteira', 'simulacao_cache', 'rebalanceamento', 'ranking_gerado', 'perfil_completo', 'mostrar_boas_vindas']:
+            st.session_state.pop(chave, None)
     
     def toggle_favorito(self, ticker: str):
         if ticker in st.session_state.favoritos:
@@ -842,6 +3445,18 @@ class RendyOrchestrator:
         
         return dividend_tickers
     
+    def obter_analises_universo(self) -> List[AnaliseAtivo]:
+        # Snapshot recente em disco evita refazer ~85 consultas ao yfinance após reinícios
+        snapshot = carregar_snapshot_analises()
+        if snapshot is not None and time.time() - snapshot.criado_em < VALIDADE_SNAPSHOT:
+            return snapshot.para_analises()
+        
+        # Usar paralelismo para análise de ativos
+        analises = analisar_ativos_paralelamente(LISTA_TICKERS_IBOV, max_workers=10)
+        if analises:
+            obter_persistencia().agendar("snapshot:universo", lambda: salvar_snapshot_analises(analises))
+        return analises
+    
     def run(self):
         inicializar_ambiente()
         perfil = carregar_perfil_usuario()
@@ -859,6 +3474,7 @@ class RendyOrchestrator:
             self.tela_perfil_obrigatorio()
             return
         
+        self.avisar_falhas_gravacao()
         self.render_sidebar(perfil)
         self.interface_principal()
     
@@ -881,7 +3497,7 @@ class RendyOrchestrator:
             
             **Compromisso com a Segurança:**
             • **Não coletamos dados pessoais** desnecessários
-            • **Processamento local** - suas informações ficam no seu dispositivo
+            • **Conta protegida por senha** - perfil, favoritos e histórico ficam no servidor do app, acessíveis só com a sua senha
             • **Sem compartilhamento** de dados com terceiros
             • **Conformidade com a LGPD** - Lei Geral de Proteção de Dados
             
@@ -912,12 +3528,30 @@ class RendyOrchestrator:
         </div>
         """, unsafe_allow_html=True)
         
+        with st.expander("🔑 Já tenho cadastro", expanded=False):
+            with st.form("entrar_usuario"):
+                email_existente = st.text_input("E-mail cadastrado", placeholder="seu@email.com")
+                senha_existente = st.text_input("Senha", type="password")
+                if st.form_submit_button("Entrar"):
+                    perfil_existente = None
+                    if email_existente and senha_existente:
+                        perfil_existente = autenticar_usuario(email_existente.strip(), senha_existente)
+                    if perfil_existente:
+                        self.entrar(perfil_existente)
+                        st.rerun()
+                    else:
+                        # Mesma mensagem para e-mail inexistente e senha errada
+                        st.error("E-mail ou senha inválidos. Contas criadas antes das senhas precisam que o "
+                                 "administrador defina uma (python app.py --definir-senha EMAIL).")
+        
         with st.form("perfil_usuario"):
             col1, col2 = st.columns(2)
             
             with col1:
                 nome = st.text_input("Nome Completo*", placeholder="Seu nome")
                 email = st.text_input("E-mail*", placeholder="seu@email.com")
+                senha = st.text_input(f"Senha* (mínimo {TAMANHO_MINIMO_SENHA} caracteres)", type="password")
+                confirmacao_senha = st.text_input("Confirme a senha*", type="password")
                 
                 tolerancia_risco = st.selectbox(
                     "Tolerância ao Risco*",
@@ -981,6 +3615,8 @@ class RendyOrchestrator:
                     st.error("Por favor, preencha nome e e-mail.")
                 elif not validar_email(email):
                     st.error("Por favor, insira um e-mail válido.")
+                elif validar_senha(senha, confirmacao_senha):
+                    st.error(validar_senha(senha, confirmacao_senha))
                 else:
                     perfil = PerfilUsuario(
                         nome=nome,
@@ -993,11 +3629,22 @@ class RendyOrchestrator:
                         setores_preferidos=setores if setores else ["Todos"]
                     )
                     
-                    salvar_perfil_usuario(perfil)
-                    self.invest_agent.definir_perfil(perfil)
-                    st.session_state.perfil_completo = True
-                    st.success("✅ Perfil salvo com sucesso! Redirecionando...")
-                    st.rerun()
+                    try:
+                        salvar_perfil_usuario(perfil, novo=True, senha=senha)
+                    except ValueError as e:
+                        st.error(f"{e} Use 'Já tenho cadastro' para entrar.")
+                    else:
+                        self.entrar(perfil)
+                        st.success("✅ Perfil salvo com sucesso! Redirecionando...")
+                        st.rerun()
+    
+    def avisar_falhas_gravacao(self):
+        email = usuario_atual()
+        if not email:
+            return
+        falhas = obter_persistencia().consumir_falhas([f"favoritos:{email}"])
+        for chave, erro in falhas.items():
+            st.warning(f"⚠️ Não foi possível salvar {chave.split(':')[0]}: {erro}. Tente novamente.")
     
     def render_sidebar(self, perfil: PerfilUsuario):
         st.sidebar.header("👤 Perfil do Investidor")
@@ -1017,6 +3664,14 @@ class RendyOrchestrator:
         st.sidebar.markdown("📊 **Estatísticas da Sessão**")
         st.sidebar.markdown(f"Análises realizadas: {len(st.session_state.historico_interacoes)}")
         st.sidebar.markdown(f"Ativos monitorados: {len(LISTA_TICKERS_IBOV)}")
+        cache = obter_cache_respostas()
+        consultas = cache.acertos + cache.falhas
+        if consultas:
+            st.sidebar.markdown(f"Respostas do assistente em cache: {cache.acertos}/{consultas} ({cache.acertos / consultas:.0%})")
+        
+        if st.sidebar.button("🚪 Sair", key="sair"):
+            self.sair()
+            st.rerun()
         
         st.sidebar.markdown("---")
         st.sidebar.markdown(self.compliance_agent.gerar_disclaimer())
@@ -1145,8 +3800,7 @@ class RendyOrchestrator:
             with st.spinner("🤖 IA analisando mercado. Aguarde, isso pode levar alguns minutos..."):
                 perfil = carregar_perfil_usuario()
                 
-                # Usar paralelismo para análise de ativos
-                analises = analisar_ativos_paralelamente(LISTA_TICKERS_IBOV, max_workers=10)
+                analises = self.obter_analises_universo()
                 
                 analises_filtradas = []
                 for analise in analises:
@@ -1166,67 +3820,82 @@ class RendyOrchestrator:
                         analises_filtradas, key=lambda x: x.score, reverse=True
                     )[:limite_resultados]
                 
-                if analises_recomendadas:
-                    st.success(f"✅ Encontradas {len(analises_recomendadas)} oportunidades!")
-                    
-                    dados_ranking = []
-                    for i, analise in enumerate(analises_recomendadas):
-                        dados_ranking.append({
-                            'Posição': i + 1,
-                            'Ticker': analise.ticker,
-                            'Empresa': analise.nome_empresa[:30] + "..." if len(analise.nome_empresa) > 30 else analise.nome_empresa,
-                            'Score': f"{analise.score:.1f}",
-                            'DY': f"{analise.dy*100:.2f}%",
-                            'ROE': f"{analise.roe*100:.2f}%",
-                            'P/L': f"{analise.pl:.2f}" if analise.pl > 0 else "N/A",
-                            'Risco': analise.risco_nivel.title(),
-                            'Setor': analise.setor,
-                            'Super': "🔥" if analise.super_investimento else "",
-                            'Favorito': "⭐" if analise.ticker in st.session_state.favoritos else ""
-                        })
-                    
-                    df_ranking = pd.DataFrame(dados_ranking)
-                    
-                    # Adicionar coluna de ações com botões
-                    def formatar_linha(row):
-                        return st.button(
-                            "⭐" if row['Favorito'] else "🤍", 
-                            key=f"fav_{row['Ticker']}",
-                            help="Clique para favoritar/desfavoritar"
-                        )
-                    
-                    # Remover colunas que não serão exibidas
-                    df_display = df_ranking.drop(columns=['Ticker', 'Favorito'])
-                    
-                    # Exibir tabela
-                    st.dataframe(df_display, use_container_width=True, hide_index=True)
-                    
-                    # Sugestão de carteira
-                    if perfil and len(analises_recomendadas) >= 3:
-                        st.markdown("### 💼 Sugestão de Carteira Personalizada")
-                        valor_total = perfil.valor_disponivel
-                        if valor_total > 0:
-                            alocacao = self.invest_agent.gerar_sugestao_alocacao(
-                                valor_total, analises_recomendadas[:5]
-                            )
-                            
-                            if alocacao:
-                                col1, col2 = st.columns(2)
-                                with col1:
-                                    st.markdown("**Alocação Sugerida:**")
-                                    for ticker, valor in alocacao.items():
-                                        percentual = (valor / valor_total) * 100
-                                        st.markdown(f"• {ticker.replace('.SA', '')}: R$ {valor:,.2f} ({percentual:.1f}%)")
-                                with col2:
-                                    fig = px.pie(
-                                        values=list(alocacao.values()),
-                                        names=[t.replace('.SA', '') for t in alocacao.keys()],
-                                        title="Distribuição da Carteira"
-                                    )
-                                    st.plotly_chart(fig, use_container_width=True)
-                else:
-                    st.warning("Nenhum ativo encontrado com os filtros aplicados.")
+                # Fica na sessão: trocar o método de alocação abaixo reexecuta o script sem o clique no botão
+                st.session_state.ranking_gerado = analises_recomendadas
         
+        analises_recomendadas = st.session_state.get('ranking_gerado')
+        if analises_recomendadas is not None:
+            perfil = carregar_perfil_usuario()
+            if analises_recomendadas:
+                st.success(f"✅ Encontradas {len(analises_recomendadas)} oportunidades!")
+                
+                dados_ranking = []
+                for i, analise in enumerate(analises_recomendadas):
+                    dados_ranking.append({
+                        'Posição': i + 1,
+                        'Ticker': analise.ticker,
+                        'Empresa': analise.nome_empresa[:30] + "..." if len(analise.nome_empresa) > 30 else analise.nome_empresa,
+                        'Score': f"{analise.score:.1f}",
+                        'DY': f"{analise.dy*100:.2f}%",
+                        'ROE': f"{analise.roe*100:.2f}%",
+                        'P/L': f"{analise.pl:.2f}" if analise.pl > 0 else "N/A",
+                        'Risco': analise.risco_nivel.title(),
+                        'Setor': analise.setor,
+                        'Super': "🔥" if analise.super_investimento else "",
+                        'Favorito': "⭐" if analise.ticker in st.session_state.favoritos else ""
+                    })
+                
+                df_ranking = pd.DataFrame(dados_ranking)
+                
+                # Adicionar coluna de ações com botões
+                def formatar_linha(row):
+                    return st.button(
+                        "⭐" if row['Favorito'] else "🤍", 
+                        key=f"fav_{row['Ticker']}",
+                        help="Clique para favoritar/desfavoritar"
+                    )
+                
+                # Remover colunas que não serão exibidas
+                df_display = df_ranking.drop(columns=['Ticker', 'Favorito'])
+                
+                # Exibir tabela
+                st.dataframe(df_display, use_container_width=True, hide_index=True)
+                
+                # Sugestão de carteira
+                if perfil and len(analises_recomendadas) >= 3:
+                    st.markdown("### 💼 Sugestão de Carteira Personalizada")
+                    valor_total = perfil.valor_disponivel
+                    if valor_total > 0:
+                        metodos = list(METODOS_ALOCACAO)
+                        metodo_padrao = METODO_ALOCACAO_PERFIL.get(perfil.tolerancia_risco, 'paridade_risco')
+                        metodo = st.selectbox(
+                            "Método de alocação",
+                            metodos,
+                            index=metodos.index(metodo_padrao),
+                            format_func=METODOS_ALOCACAO.get,
+                            help=f"Respeita no máximo {LIMITE_PESO_ATIVO:.0%} por ativo e {LIMITE_PESO_SETOR:.0%} por setor"
+                        )
+                        alocacao = self.invest_agent.gerar_sugestao_alocacao(
+                            valor_total, analises_recomendadas, metodo
+                        )
+                        
+                        if alocacao:
+                            col1, col2 = st.columns(2)
+                            with col1:
+                                st.markdown("**Alocação Sugerida:**")
+                                for ticker, valor in alocacao.items():
+                                    percentual = (valor / valor_total) * 100
+                                    st.markdown(f"• {ticker.replace('.SA', '')}: R$ {valor:,.2f} ({percentual:.1f}%)")
+                            with col2:
+                                fig = px.pie(
+                                    values=list(alocacao.values()),
+                                    names=[t.replace('.SA', '') for t in alocacao.keys()],
+                                    title="Distribuição da Carteira"
+                                )
+                                st.plotly_chart(fig, use_container_width=True)
+            else:
+                st.warning("Nenhum ativo encontrado com os filtros aplicados.")
+    
         st.markdown(self.compliance_agent.gerar_disclaimer())
     
     def aba_simulacao_ia(self):
@@ -1269,11 +3938,38 @@ class RendyOrchestrator:
                 value=5
             )
             
-            simular = st.button("🚀 Simular Investimento", type="primary")
+            modo_simulacao = st.radio(
+                "Modo de Simulação",
+                ["Cenários", "Monte Carlo"],
+                horizontal=True,
+                help="Monte Carlo sorteia milhares de trajetórias de preço e dividendos com base na volatilidade do último ano"
+            )
+            if modo_simulacao == "Monte Carlo":
+                n_caminhos = st.select_slider(
+                    "Número de Trajetórias",
+                    options=[10_000, 25_000, 50_000, 100_000],
+                    value=10_000
+                )
+            
+            reinvestimento_fracionario = st.checkbox(
+                "Reinvestir em frações de ação",
+                help="Compra frações de ação com os dividendos em vez de apenas ações inteiras"
+            )
+            
+            if st.button("🚀 Simular Investimento", type="primary"):
+                st.session_state.simulacao_ativa = True
+        
+        # Após a primeira simulação, mudanças de prazo/valor recalculam direto do cache
+        simular = st.session_state.get('simulacao_ativa', False)
         
-        if simular and ticker_input:
+        if simular and ticker_input and modo_simulacao == "Monte Carlo":
+            self.exibir_monte_carlo(ticker_input, valor_inicial, periodo_anos, n_caminhos)
+        elif simular and ticker_input:
             with st.spinner("Processando simulação..."):
-                resultado = self.auto_agent.simular_investimento(ticker_input, valor_inicial, periodo_anos)
+                resultado = self.auto_agent.simular_investimento(
+                    ticker_input, valor_inicial, periodo_anos,
+                    reinvestimento_fracionario=reinvestimento_fracionario
+                )
                 
                 if 'erro' in resultado:
                     st.error(resultado['erro'])
@@ -1286,7 +3982,8 @@ class RendyOrchestrator:
                     with col1:
                         st.metric("Valor Investido", f"R$ {resultado['valor_inicial']:,.2f}")
                     with col2:
-                        st.metric("Ações Iniciais", f"{resultado['qtd_acoes_inicial']:,}")
+                        qtd_inicial = resultado['qtd_acoes_inicial']
+                        st.metric("Ações Iniciais", f"{qtd_inicial:,}" if isinstance(qtd_inicial, int) else f"{qtd_inicial:,.4f}")
                     with col3:
                         st.metric("DY Inicial", f"{resultado['dy_inicial']:.2%}")
                     
@@ -1305,8 +4002,8 @@ class RendyOrchestrator:
                     st.markdown("#### 📈 Evolução do Patrimônio")
                     fig = go.Figure()
                     for nome, dados in resultado['cenarios'].items():
-                        anos = [h['ano'] for h in dados['historico']]
-                        valores = [h['valor_carteira'] for h in dados['historico']]
+                        anos = dados['historico']['ano']
+                        valores = dados['historico']['valor_carteira']
                         fig.add_trace(go.Scatter(
                             x=anos,
                             y=valores,
@@ -1335,6 +4032,7 @@ class RendyOrchestrator:
                             }
                             if not any(acao['ticker'] == ticker_input for acao in st.session_state.carteira):
                                 st.session_state.carteira.append(nova_acao)
+                                self.descartar_rebalanceamento()
                                 st.success(f"✅ {ticker_input.replace('.SA', '')} adicionada à carteira!")
                             else:
                                 st.warning("Esta ação já está na sua carteira.")
@@ -1354,8 +4052,57 @@ class RendyOrchestrator:
                     with col3:
                         if st.button(f"🗑️ Limpar", key=f"clear_{ticker}"):
                             del st.session_state.simulacao_cache[ticker]
+                            st.session_state.simulacao_ativa = False
                             st.rerun()
     
+    def exibir_monte_carlo(self, ticker: str, valor_inicial: float, periodo_anos: int, n_caminhos: int):
+        resultado = self.auto_agent.simular_monte_carlo(ticker, valor_inicial, periodo_anos, n_caminhos)
+        
+        if 'erro' in resultado:
+            st.error(resultado['erro'])
+            return
+        
+        st.success(f"✅ {resultado['n_caminhos']:,} trajetórias simuladas para {ticker.replace('.SA', '')}")
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Valor Investido", f"R$ {resultado['valor_inicial']:,.2f}")
+        with col2:
+            st.metric("Volatilidade Anual", f"{resultado['volatilidade_preco']:.1%}")
+        with col3:
+            st.metric("Valor Final Médio", f"R$ {resultado['valor_final_medio']:,.2f}")
+        with col4:
+            st.metric("Chance de Perda", f"{resultado['prob_perda']:.1%}")
+        
+        anos = resultado['anos']
+        percentis = resultado['percentis']
+        
+        for chave, titulo in [('bandas_valor', "Valor da Carteira"), ('bandas_renda', "Renda Anual")]:
+            bandas = resultado[chave]
+            fig = go.Figure()
+            fig.add_trace(go.Scatter(x=anos, y=bandas[-1], line=dict(width=0), showlegend=False, hoverinfo='skip'))
+            fig.add_trace(go.Scatter(x=anos, y=bandas[0], fill='tonexty', fillcolor='rgba(0,123,255,0.15)',
+                                     line=dict(width=0), name=f"P{percentis[0]}–P{percentis[-1]}"))
+            fig.add_trace(go.Scatter(x=anos, y=bandas[-2], line=dict(width=0), showlegend=False, hoverinfo='skip'))
+            fig.add_trace(go.Scatter(x=anos, y=bandas[1], fill='tonexty', fillcolor='rgba(0,123,255,0.35)',
+                                     line=dict(width=0), name=f"P{percentis[1]}–P{percentis[-2]}"))
+            fig.add_trace(go.Scatter(x=anos, y=bandas[len(percentis) // 2], mode='lines',
+                                     line=dict(width=3, color='#007bff'), name="Mediana"))
+            fig.update_layout(
+                title=f"{titulo} - Faixas de Probabilidade",
+                xaxis_title="Anos",
+                yaxis_title="Valor (R$)",
+                height=400
+            )
+            st.plotly_chart(fig, use_container_width=True)
+        
+        df_percentis = pd.DataFrame({
+            'Percentil': [f"P{p}" for p in percentis],
+            'Valor Final': [f"R$ {v:,.2f}" for v in resultado['bandas_valor'][:, -1]],
+            'Renda Anual Final': [f"R$ {v:,.2f}" for v in resultado['bandas_renda'][:, -1]]
+        })
+        st.dataframe(df_percentis, use_container_width=True, hide_index=True)
+    
     def aba_carteira_agentica(self):
         st.markdown("### 💼 Minha Carteira IA")
         st.info("""
@@ -1400,12 +4147,14 @@ class RendyOrchestrator:
                                 for a in st.session_state.carteira:
                                     if a == acao:
                                         a['valor'] = novo_valor
+                                self.descartar_rebalanceamento()
                                 st.success(f"✅ Valor atualizado para {acao['ticker'].replace('.SA', '')}")
                                 st.rerun()
                         with col_btn2:
                             if st.button("🗑️ Remover", key=f"remove_sim_{acao['ticker']}_{i}", 
                                        help="Remover ação da carteira", type="secondary", use_container_width=True):
                                 st.session_state.carteira = [a for a in st.session_state.carteira if a != acao]
+                                self.descartar_rebalanceamento()
                                 st.success(f"✅ {acao['ticker'].replace('.SA', '')} removida da carteira")
                                 st.rerun()
                     st.markdown("---")
@@ -1443,12 +4192,13 @@ class RendyOrchestrator:
                     st.rerun()
             with col3:
                 if st.button("📈 Rebalancear Carteira", type="secondary", use_container_width=True, key="rebalancear_top"):
-                    st.info("💡 Dica: Para rebalancear, ajuste os valores individuais de cada ação usando os campos 'Atualizar Valor' na seção de detalhes da carteira abaixo.")
+                    st.session_state.rebalanceamento = self.planejar_rebalanceamento_carteira()
             with col4:
                 if st.button("🗑️ Limpar Carteira", type="secondary", use_container_width=True, key="limpar_carteira_top"):
                     if st.session_state.get('confirm_clear', False):
                         st.session_state.carteira = []
                         st.session_state.confirm_clear = False
+                        self.descartar_rebalanceamento()
                         st.success("✅ Carteira limpa com sucesso!")
                         st.rerun()
                     else:
@@ -1457,6 +4207,8 @@ class RendyOrchestrator:
             # Reset do estado de confirmação após um tempo
             if st.session_state.get('confirm_clear', False):
                 st.markdown("⚠️ **Atenção:** Clique novamente em 'Limpar Carteira' para confirmar a remoção de todas as ações.")
+            if st.session_state.get('rebalanceamento'):
+                self.exibir_rebalanceamento(st.session_state.rebalanceamento)
         
         # Exibir sugestões
         if 'sugestoes_carteira' in st.session_state and st.session_state.sugestoes_carteira:
@@ -1496,6 +4248,7 @@ class RendyOrchestrator:
                                 }
                                 if not any(acao['ticker'] == analise.ticker for acao in st.session_state.carteira):
                                     st.session_state.carteira.append(nova_acao)
+                                    self.descartar_rebalanceamento()
                                     st.success(f"✅ {analise.ticker.replace('.SA', '')} adicionada à carteira!")
                                 else:
                                     st.warning("Esta ação já está na sua carteira")
@@ -1529,6 +4282,7 @@ class RendyOrchestrator:
                     }
                     if not any(acao['ticker'] == ticker_manual for acao in st.session_state.carteira):
                         st.session_state.carteira.append(nova_acao)
+                        self.descartar_rebalanceamento()
                         st.success(f"✅ {ticker_manual.replace('.SA', '')} adicionada à carteira!")
                     else:
                         st.warning("Esta ação já está na sua carteira.")
@@ -1541,8 +4295,15 @@ class RendyOrchestrator:
             tickers = [acao['ticker'] for acao in st.session_state.carteira]
             valores = [acao['valor'] for acao in st.session_state.carteira]
 
+            st.checkbox(
+                f"Comprar em lotes padrão ({LOTE_PADRAO_B3} ações)",
+                value=False,
+                key="lote_padrao_carteira",
+                on_change=self.descartar_rebalanceamento,
+                help="Desmarcado, considera o mercado fracionário (a partir de 1 ação)"
+            )
             with st.spinner("Analisando sua carteira..."):
-                analise_carteira = self.finance_agent.analisar_carteira(tickers, valores)
+                analise_carteira = self.finance_agent.analisar_carteira(tickers, valores, lote=self.lote_carteira())
                 col1, col2, col3, col4 = st.columns(4)
                 with col1:
                     st.metric("Valor Total", f"R$ {analise_carteira['valor_total']:,.2f}")
@@ -1552,6 +4313,10 @@ class RendyOrchestrator:
                     st.metric("Yield da Carteira", f"{analise_carteira['yield_carteira']:.2%}")
                 with col4:
                     st.metric("Diversificação", f"{analise_carteira['diversificacao']} setores")
+                st.caption(
+                    f"Investido em ações: R$ {analise_carteira['valor_investido']:,.2f} · "
+                    f"sobra em caixa: R$ {analise_carteira['sobra_caixa']:,.2f}"
+                )
 
                 st.markdown("##### 📋 Detalhes por Ação")
                 for i, item in enumerate(analise_carteira['analises']):
@@ -1586,6 +4351,7 @@ class RendyOrchestrator:
                             if st.button("🗑️ Remover", key=f"remove_{i}", 
                                        help="Remover ação da carteira", type="secondary", use_container_width=True):
                                 st.session_state.carteira.pop(i)
+                                self.descartar_rebalanceamento()
                                 st.success(f"✅ {analise.ticker.replace('.SA', '')} removida da carteira")
                                 st.rerun()
                             
@@ -1626,19 +4392,275 @@ class RendyOrchestrator:
                             st.markdown(f"• {rec}")
                     else:
                         st.success("✅ Sua carteira está bem balanceada!")
+                self.exibir_risco_quantitativo(avaliacao_risco.get('quantitativo', {}), analise_carteira['analises'])
+                self.exibir_simulacao_contrafactual(analise_carteira['analises'])
+            
+            self.exibir_simulacao_carteira(tickers, valores)
         else:
             st.info("📝 Sua carteira está vazia. Adicione algumas ações para começar a análise!")
 
         st.markdown("---")
         st.markdown(self.compliance_agent.gerar_disclaimer())
     
+    def exibir_risco_quantitativo(self, risco: Dict, itens: List[Dict]):
+        if not risco:
+            return
+        
+        def percentual(valor):
+            return f"{valor:.1%}" if valor is not None else "—"
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("📉 Volatilidade Anual", percentual(risco['volatilidade']))
+            st.metric("🔻 Queda Máxima", percentual(risco['max_drawdown']))
+        with col2:
+            st.metric(f"⚠️ VaR {CONFIANCA_VAR:.0%} (1 dia)", percentual(risco['var']),
+                      help=f"Perda diária superada em apenas {1 - CONFIANCA_VAR:.0%} dos pregões do último ano")
+            st.metric(f"🧨 CVaR {CONFIANCA_VAR:.0%} (1 dia)", percentual(risco['cvar']),
+                      help="Perda média nesses piores pregões")
+        with col3:
+            st.metric("📈 Beta (Ibovespa)", f"{risco['beta']:.2f}" if risco['beta'] is not None else "—")
+            st.metric("🎯 Nº Efetivo de Ativos", f"{risco['n_efetivo']:.1f}",
+                      help="Inverso do índice de Herfindahl: quantos ativos de mesmo peso teriam a mesma concentração")
+        
+        if risco['volatilidade'] > 0:
+            contribuicao = risco['contribuicao_risco'] / risco['volatilidade']
+            df_risco = pd.DataFrame({
+                'Ativo': [item['analise'].ticker.replace('.SA', '') for item in itens],
+                'Peso (%)': [item['peso_carteira'] * 100 for item in itens],
+                'Risco (%)': contribuicao * 100,
+            })
+            fig = px.bar(df_risco, x='Ativo', y=['Peso (%)', 'Risco (%)'], barmode='group',
+                         title='Peso x Contribuição para a Volatilidade')
+            fig.update_layout(height=350, legend_title_text='')
+            st.plotly_chart(fig, use_container_width=True)
+        st.caption(f"Calculado sobre {risco['pregoes']} pregões do último ano em que todos os ativos negociaram.")
+    
+    def exibir_simulacao_contrafactual(self, itens: List[Dict]):
+        with st.expander("🧪 E se...? Simulações Contrafactuais"):
+            # Universo do último snapshot mais os ativos da carteira (estes, com os dados mais recentes)
+            df_carteira = analises_para_dataframe([item['analise'] for item in itens])
+            df_universo, _ = dataframe_universo()
+            df = df_carteira if df_universo is None else pd.concat(
+                [df_universo.drop(df_carteira.index, errors='ignore'), df_carteira])
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                variacao_dividendos = st.slider("Variação dos dividendos (%)", -50, 30, -10, step=5, key="cenario_dividendos")
+                variacao_preco = st.slider("Variação do mercado (%)", -50, 30, 0, step=5, key="cenario_preco")
+            with col2:
+                variacao_selic = st.slider("Variação da Selic (p.p.)", -5.0, 5.0, 0.0, step=0.25, key="cenario_selic")
+                setor = st.selectbox("Setor com choque próprio", ["Nenhum"] + sorted(df['setor'].unique()), key="cenario_setor")
+                variacao_setor = st.slider("Variação do setor (%)", -50, 30, 0, step=5, key="cenario_var_setor",
+                                           disabled=setor == "Nenhum")
+            
+            cenario = CenarioEstresse(
+                variacao_dividendos=variacao_dividendos / 100,
+                variacao_preco=variacao_preco / 100,
+                variacao_setor={setor: variacao_setor / 100} if setor != "Nenhum" else {},
+                variacao_selic=variacao_selic / 100
+            )
+            if cenario.neutro():
+                st.info("Mova os controles para ver o efeito do cenário na sua carteira e no ranking.")
+                return
+            
+            resultado = simular_cenario(df, cenario, {item['analise'].ticker: item['qtd_acoes'] for item in itens})
+            base, estressada = resultado['carteira']['base'], resultado['carteira']['cenario']
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("💼 Valor da Carteira", f"R$ {estressada['valor']:,.2f}",
+                          f"R$ {estressada['valor'] - base['valor']:,.2f}")
+            with col2:
+                st.metric("💸 Renda Anual", f"R$ {estressada['renda_anual']:,.2f}",
+                          f"R$ {estressada['renda_anual'] - base['renda_anual']:,.2f}")
+            with col3:
+                st.metric("⭐ Score Médio", f"{estressada['score_medio']:.1f}",
+                          f"{estressada['score_medio'] - base['score_medio']:+.1f}")
+            with col4:
+                st.metric("🔴 Ativos de Alto Risco", f"{estressada['percentual_alto_risco']:.0%}",
+                          f"{(estressada['percentual_alto_risco'] - base['percentual_alto_risco']) * 100:+.0f} p.p.",
+                          delta_color="inverse")
+            
+            ativos = resultado['carteira']['ativos']
+            st.dataframe(pd.DataFrame({
+                'Ativo': ativos['ticker'].str.replace('.SA', '', regex=False),
+                'Preço (%)': (ativos['variacao_preco'] * 100).round(1),
+                'DY': (ativos['dy_cenario'] * 100).round(2),
+                'Score': ativos['score_cenario'].round(1),
+                'Δ Score': ativos['delta_score'].round(1),
+                'Risco': ativos['risco_cenario'].str.title(),
+                'Renda (R$)': ativos['renda_cenario'].round(2),
+            }), use_container_width=True, hide_index=True)
+            
+            resumo = resultado['resumo']
+            st.caption(
+                f"No universo de {resumo['ativos']} ações: score médio {resumo['score_medio_base']:.1f} → "
+                f"{resumo['score_medio_cenario']:.1f}, super investimentos {resumo['super_base']} → {resumo['super_cenario']}, "
+                f"alto risco {resumo['alto_risco_base']} → {resumo['alto_risco_cenario']}. "
+                "Subir a Selic derruba mais o preço das ações de DY baixo (modelo de Gordon)."
+            )
+    
+    @staticmethod
+    def lote_carteira() -> int:
+        """Lote escolhido na aba da carteira; o botão de rebalancear fica acima do checkbox, por isso vem da sessão"""
+        return LOTE_PADRAO_B3 if st.session_state.get('lote_padrao_carteira', False) else 1
+    
+    @staticmethod
+    def descartar_rebalanceamento():
+        """O plano vale para a carteira e o lote de quando foi gerado; qualquer mudança o invalida"""
+        st.session_state.pop('rebalanceamento', None)
+    
+    def planejar_rebalanceamento_carteira(self) -> Dict:
+        tickers = [acao['ticker'] for acao in st.session_state.carteira]
+        valores = [acao['valor'] for acao in st.session_state.carteira]
+        lote = self.lote_carteira()
+        analise_carteira = self.finance_agent.analisar_carteira(tickers, valores, lote=lote)
+        itens = analise_carteira['analises']
+        perfil = carregar_perfil_usuario()
+        if perfil:
+            self.invest_agent.definir_perfil(perfil)
+        return self.invest_agent.planejar_rebalanceamento(
+            [item['analise'] for item in itens],
+            np.array([item['qtd_acoes'] for item in itens]),
+            caixa=analise_carteira['sobra_caixa'],
+            lote=lote
+        )
+    
+    def exibir_rebalanceamento(self, plano: Dict):
+        st.markdown("##### 📈 Plano de Rebalanceamento")
+        if 'erro' in plano:
+            st.warning(plano['erro'])
+            return
+        
+        nome_metodo = METODOS_ALOCACAO.get(plano['metodo'], 'Pesos iguais')
+        ordens = plano['ordens']
+        if not np.any(ordens):
+            st.success(f"✅ Sua carteira já está próxima dos pesos-alvo ({nome_metodo}); nenhuma ordem necessária.")
+        else:
+            df_ordens = pd.DataFrame({
+                'Ativo': [t.replace('.SA', '') for t in plano['tickers']],
+                'Operação': np.select([ordens > 0, ordens < 0], ['Comprar', 'Vender'], 'Manter'),
+                'Quantidade': np.abs(ordens).astype(int),
+                'Valor (R$)': np.abs(plano['valor_ordens']).round(2),
+                'Peso Atual': (plano['pesos_atuais'] * 100).round(1),
+                'Peso Alvo': (plano['pesos_alvo'] * 100).round(1),
+                'Peso Final': (plano['pesos_finais'] * 100).round(1),
+            })
+            st.dataframe(df_ordens, use_container_width=True, hide_index=True)
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Desvio do alvo", f"{plano['desvio_depois']:.1%}", f"{(plano['desvio_depois'] - plano['desvio_antes']) * 100:.1f} p.p.", delta_color="inverse")
+            with col2:
+                st.metric("Custos estimados", f"R$ {plano['custo_total']:,.2f}")
+            with col3:
+                st.metric("Caixa após ordens", f"R$ {plano['caixa_final']:,.2f}")
+            st.caption(
+                f"Alvo: {nome_metodo}. Só são negociados ativos com desvio acima de "
+                f"{BANDA_ABSOLUTA_REBALANCEAMENTO:.0%} ou de {BANDA_RELATIVA_REBALANCEAMENTO:.0%} do peso-alvo "
+                f"e ordens a partir de R$ {VALOR_MINIMO_OPERACAO:,.0f}."
+            )
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if np.any(ordens) and st.button("✅ Aplicar Rebalanceamento", type="primary", key="aplicar_rebalanceamento"):
+                # A carteira guarda valores: passa a ser o valor das quantidades finais
+                valores_finais = dict(zip(plano['tickers'], plano['quantidades_finais'] * plano['precos']))
+                for acao in st.session_state.carteira:
+                    if acao['ticker'] in valores_finais:
+                        acao['valor'] = float(valores_finais[acao['ticker']])
+                self.descartar_rebalanceamento()
+                st.success("✅ Carteira rebalanceada!")
+                st.rerun()
+        with col2:
+            if st.button("Fechar", key="fechar_rebalanceamento"):
+                st.session_state.rebalanceamento = None
+                st.rerun()
+    
+    def exibir_simulacao_carteira(self, tickers: List[str], valores: List[float]):
+        st.markdown("##### 🔮 Simulação da Carteira Completa")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            periodo_anos = st.slider("Período (anos)", min_value=1, max_value=20, value=10, key="periodo_carteira")
+        with col2:
+            reinvestimento = st.radio(
+                "Reinvestimento dos Dividendos",
+                ["mesmo_ativo", "pesos_alvo"],
+                format_func=lambda x: {
+                    "mesmo_ativo": "No próprio ativo",
+                    "pesos_alvo": "Pelos pesos da carteira"
+                }[x],
+                key="reinvestimento_carteira"
+            )
+        with col3:
+            correlacionado = st.checkbox(
+                "Choques correlacionados (Monte Carlo)",
+                help="Sorteia trajetórias com a correlação histórica entre os ativos da carteira",
+                key="correlacao_carteira"
+            )
+        
+        if not st.button("🔮 Simular Carteira", type="primary", key="simular_carteira"):
+            return
+        
+        resultado = self.auto_agent.simular_carteira(
+            tickers, valores, periodo_anos, reinvestimento, choques_correlacionados=correlacionado
+        )
+        if 'erro' in resultado:
+            st.error(resultado['erro'])
+            return
+        
+        st.dataframe(pd.DataFrame([
+            {
+                'Cenário': nome.title(),
+                'Valor Final': f"R$ {dados['valor_final']:,.2f}",
+                'Renda Anual': f"R$ {dados['renda_anual_final']:,.2f}",
+                'Retorno Total': f"{dados['retorno_total']:.1%}"
+            }
+            for nome, dados in resultado['cenarios'].items()
+        ]), use_container_width=True, hide_index=True)
+        
+        fig = go.Figure()
+        for nome, dados in resultado['cenarios'].items():
+            fig.add_trace(go.Scatter(
+                x=dados['historico']['ano'],
+                y=dados['historico']['valor_carteira'],
+                mode='lines+markers',
+                name=nome.title()
+            ))
+        
+        monte_carlo = resultado['monte_carlo']
+        if monte_carlo:
+            bandas = monte_carlo['bandas_valor']
+            fig.add_trace(go.Scatter(x=resultado['anos'], y=bandas[-1], line=dict(width=0), showlegend=False, hoverinfo='skip'))
+            fig.add_trace(go.Scatter(x=resultado['anos'], y=bandas[0], fill='tonexty', fillcolor='rgba(0,123,255,0.15)',
+                                     line=dict(width=0), name=f"Monte Carlo P{monte_carlo['percentis'][0]}–P{monte_carlo['percentis'][-1]}"))
+        
+        fig.update_layout(
+            title="Evolução do Valor da Carteira",
+            xaxis_title="Anos",
+            yaxis_title="Valor (R$)",
+            height=400
+        )
+        st.plotly_chart(fig, use_container_width=True)
+        
+        if monte_carlo:
+            st.metric("Chance de Perda (Monte Carlo)", f"{monte_carlo['prob_perda']:.1%}")
+    
     def aba_assistente_ia(self):
         st.markdown("### 🤖 Assistente IA")
         
-        if 'chat_history' not in st.session_state:
-            st.session_state.chat_history = []
+        if not isinstance(st.session_state.get('chat_history'), deque):
+            st.session_state.chat_history = deque(st.session_state.get('chat_history', []), maxlen=MAX_TURNOS_CHAT)
+        
+        historico = list(st.session_state.chat_history)
+        anteriores, recentes = historico[:-TURNOS_CHAT_VISIVEIS], historico[-TURNOS_CHAT_VISIVEIS:]
+        if anteriores:
+            # Um único elemento para todos os turnos antigos, em vez de três por turno
+            with st.expander(f"🕘 Conversas anteriores ({len(anteriores)})"):
+                st.markdown("\n\n---\n\n".join(
+                    f"**👤 Você:** {pergunta}\n\n**🤖 Rendy AI:** {resposta}" for pergunta, resposta in anteriores
+                ))
         
-        for i, (pergunta, resposta) in enumerate(st.session_state.chat_history):
+        for i, (pergunta, resposta) in enumerate(recentes):
             with st.container():
                 st.markdown(f"**👤 Você:** {pergunta}")
                 st.markdown(f"**🤖 Rendy AI:** {resposta}")
@@ -1709,7 +4731,7 @@ class RendyOrchestrator:
         if st.session_state.chat_history:
             st.markdown("---")
             if st.button("🗑️ Limpar Histórico do Chat"):
-                st.session_state.chat_history = []
+                st.session_state.chat_history.clear()
                 st.rerun()
     
     def aba_perfil_usuario(self):
@@ -1806,21 +4828,26 @@ class RendyOrchestrator:
                             valor_disponivel=novo_valor,
                             setores_preferidos=novos_setores if novos_setores else ["Todos"]
                         )
-                        salvar_perfil_usuario(novo_perfil)
-                        st.success("✅ Perfil atualizado com sucesso!")
-                        st.rerun()
+                        novo_perfil.favoritos = perfil.favoritos
+                        try:
+                            salvar_perfil_usuario(novo_perfil, email_anterior=perfil.email)
+                        except ValueError as e:
+                            st.error(f"❌ {e} Escolha outro e-mail.")
+                        else:
+                            st.session_state.usuario_email = novo_perfil.email
+                            st.success("✅ Perfil atualizado com sucesso!")
+                            st.rerun()
         else:
             st.error("❌ Perfil não encontrado. Por favor, configure seu perfil.")
     
     def aba_glossario(self):
         st.markdown("### 📚 Glossário de Investimentos")
         busca = st.text_input("🔍 Buscar termo:", placeholder="Digite um termo para buscar...")
-        termos_filtrados = GLOSSARIO
+        glossario = carregar_glossario()
+        termos_filtrados = glossario
         if busca:
-            termos_filtrados = {
-                k: v for k, v in GLOSSARIO.items() 
-                if busca.lower() in k.lower() or busca.lower() in v.lower()
-            }
+            indice = obter_indice_glossario(tuple(glossario.items()))
+            termos_filtrados = {termo: definicao for termo, definicao, _ in indice.buscar(busca)}
         for termo, definicao in termos_filtrados.items():
             with st.expander(f"📖 {termo}"):
                 st.markdown(definicao)
@@ -1879,8 +4906,8 @@ class RendyOrchestrator:
             st.markdown("#### 🛡️ Segurança e Conformidade")
             st.markdown("""
             - Conformidade com LGPD
-            - Dados criptografados
-            - Armazenamento local seguro
+            - Senhas guardadas apenas como hash (PBKDF2)
+            - Dados de cada usuário acessíveis só com a senha dele
             - Transparência algorítmica
             - Disclaimers de investimento
             """)
@@ -1912,5 +4939,20 @@ class RendyOrchestrator:
 
 # =================== EXECUÇÃO PRINCIPAL ===================
 if __name__ == "__main__":
-    orchestrator = RendyOrchestrator()
-    orchestrator.run()
+    if '--ingestao' in sys.argv:
+        # Job em lote: python app.py --ingestao [TICKER ...]; sem tickers, todo o IBOV
+        tickers = [arg for arg in sys.argv[sys.argv.index('--ingestao') + 1:] if not arg.startswith('-')]
+        ingerir_historicos_longos(tickers or LISTA_TICKERS_IBOV)
+    elif '--definir-senha' in sys.argv:
+        # Administração: python app.py --definir-senha EMAIL (também libera contas criadas sem senha)
+        email = sys.argv[sys.argv.index('--definir-senha') + 1]
+        senha = getpass.getpass(f"Nova senha para {email}: ")
+        erro = validar_senha(senha, getpass.getpass("Confirme: "))
+        if erro:
+            sys.exit(erro)
+        if not obter_armazenamento().definir_senha(email, senha):
+            sys.exit(f"Usuário {email} não encontrado")
+        print(f"Senha de {email} definida")
+    else:
+        orchestrator = RendyOrchestrator()
+        orchestrator.run()